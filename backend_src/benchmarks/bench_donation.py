@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+bench_donation.py - Donation latency as a function of donated quantity
+
+Compares the lot-based ingestion path behind /api/machines/<id>/report_donation with the
+previous one-FoodItem-per-unit loop, on a scratch SQLite database.
+
+Usage:
+    python benchmarks/bench_donation.py [--rounds N]
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Add backend directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import create_app
+from models.models import db, Machine, FoodItem
+
+QUANTITIES = [1, 10, 50, 200, 1000]
+
+
+def legacy_donation(machine_id, expiry_date, quantity):
+    """The per-unit loop report_donation used before lots were introduced."""
+    machine = db.session.get(Machine, machine_id)
+    for _ in range(quantity):
+        if machine.current_storage_level < machine.storage_capacity_max:
+            db.session.add(FoodItem(machine_id=machine_id, expiry_date=expiry_date, quantity=1))
+            machine.current_storage_level += 1
+        else:
+            db.session.rollback()
+            return
+    db.session.commit()
+
+
+def time_call(fn, rounds):
+    """Return the median wall time of fn() in milliseconds."""
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=20, help="Donations timed per quantity")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+        client = app.test_client()
+        expiry = datetime.date.today() + datetime.timedelta(days=5)
+
+        with app.app_context():
+            db.create_all()
+            machine = Machine(location_lat=0, location_lon=0, storage_capacity_max=10 ** 9)
+            db.session.add(machine)
+            db.session.commit()
+            machine_id = machine.id
+
+            print(f"{'quantity':>10} {'legacy ms':>12} {'lot ms':>10}")
+            for quantity in QUANTITIES:
+                legacy_ms = time_call(lambda: legacy_donation(machine_id, expiry, quantity), args.rounds)
+                lot_ms = time_call(
+                    lambda: client.post(
+                        f"/api/machines/{machine_id}/report_donation",
+                        json={"expiry_date": expiry.isoformat(), "quantity": quantity}
+                    ),
+                    args.rounds
+                )
+                print(f"{quantity:>10} {legacy_ms:>12.2f} {lot_ms:>10.2f}")
+
+            db.session.remove()
+
+
+if __name__ == "__main__":
+    main()
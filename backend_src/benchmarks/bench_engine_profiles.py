@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+bench_engine_profiles.py - Donate/collect throughput under concurrent writers per engine profile
+
+Runs worker threads that each alternate /api/food/donate and /api/food/collect calls
+against a scratch database, once per engine profile (see config.py), and reports
+throughput, latency percentiles and failed requests (e.g. "database is locked").
+
+The mysql profile is only run when --mysql-url points at a scratch database; its tables
+are created and dropped by the benchmark.
+
+Usage:
+    python benchmarks/bench_engine_profiles.py [--workers N] [--ops N] [--machines N] [--mysql-url URL]
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Add backend directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import database_config
+from main import create_app
+from models.models import db, Machine
+
+
+def percentile(samples, fraction):
+    """Return the given percentile (0..1) of a non-empty list of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_profile(environ, workers, ops, machines):
+    """Run the workload on one profile and return (ops_per_sec, p50_ms, p95_ms, failures)."""
+    app = create_app(dict(database_config(environ), TESTING=True))
+    expiry = (datetime.date.today() + datetime.timedelta(days=5)).isoformat()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        machine_ids = []
+        for _ in range(machines):
+            machine = Machine(location_lat=0, location_lon=0, storage_capacity_max=10 ** 9)
+            db.session.add(machine)
+            db.session.commit()
+            machine_ids.append(machine.id)
+        db.session.remove()
+
+    client = app.test_client()
+    tokens = {
+        machine_id: client.post("/api/machine/auth", json={"machine_id": machine_id}).get_json()["token"]
+        for machine_id in machine_ids
+    }
+
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(workers)
+
+    def worker(index):
+        machine_id = machine_ids[index % len(machine_ids)]
+        headers = {"Authorization": f"Bearer {tokens[machine_id]}"}
+        worker_client = app.test_client()
+        samples, failed = [], 0
+        start_barrier.wait()
+        for _ in range(ops):
+            for url, body in (("/api/food/donate", {"expiry_date": expiry, "quantity": 2}),
+                              ("/api/food/collect", {"quantity": 1})):
+                started = time.perf_counter()
+                try:
+                    ok = worker_client.post(url, json=body, headers=headers).status_code == 200
+                except Exception:
+                    ok = False
+                samples.append((time.perf_counter() - started) * 1000)
+                failed += not ok
+        with lock:
+            latencies.extend(samples)
+            failures[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        db.drop_all()
+        db.session.remove()
+        db.engine.dispose()
+
+    return len(latencies) / elapsed, statistics.median(latencies), percentile(latencies, 0.95), failures[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent writer threads")
+    parser.add_argument("--ops", type=int, default=100, help="Donate+collect pairs per worker")
+    parser.add_argument("--machines", type=int, default=4, help="Machines the workers are spread over")
+    parser.add_argument("--mysql-url", help="Scratch MySQL database for the mysql profile")
+    args = parser.parse_args()
+
+    print(f"{'profile':>14} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'failed':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        profiles = [
+            ("sqlite-plain", {"DATABASE_PROFILE": "sqlite-plain", "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'plain.db')}"}),
+            ("sqlite", {"DATABASE_PROFILE": "sqlite", "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'tuned.db')}"}),
+        ]
+        if args.mysql_url:
+            profiles.append(("mysql", {"DATABASE_PROFILE": "mysql", "DATABASE_URL": args.mysql_url}))
+
+        for name, environ in profiles:
+            throughput, p50, p95, failed = run_profile(environ, args.workers, args.ops, args.machines)
+            print(f"{name:>14} {throughput:>10.0f} {p50:>9.2f} {p95:>9.2f} {failed:>8}")
+
+
+if __name__ == "__main__":
+    main()
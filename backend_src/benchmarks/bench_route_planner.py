@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+bench_route_planner.py - Latency of /api/volunteer/route by number of sites
+
+Seeds a scratch SQLite database with machines holding expired food, scattered over a
+city-sized area, and times route requests whose time budget reaches every site (the
+worst case for the 2-opt pass). The first request per size fills the distance matrix.
+Exits non-zero if a cached request for up to BUDGET_SITES sites takes over BUDGET_MS.
+
+Usage:
+    python benchmarks/bench_route_planner.py [--rounds N]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# Add backend directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import create_app
+from models.models import db, Machine, MachineExpiryBucket
+
+SITE_COUNTS = [50, 100, 250, 500, 1000]
+
+# Latency target for a cached request; sizes up to BUDGET_SITES must meet it
+BUDGET_MS = 100
+BUDGET_SITES = 500
+
+
+def time_call(fn, rounds):
+    """Return the median wall time of fn() in milliseconds."""
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=10, help="Requests timed per site count")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    over_budget = []
+    query = {"lat": 34.05, "lon": -118.25, "time_budget": 1440, "speed_kmh": 200, "service_minutes": 0.5}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+        client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            print(f"{'sites':>8} {'stops':>8} {'first ms':>10} {'cached ms':>10}")
+            for count in SITE_COUNTS:
+                db.session.execute(MachineExpiryBucket.__table__.delete())
+                db.session.execute(Machine.__table__.delete())
+                machines = [
+                    Machine(location_lat=34.05 + rng.uniform(-0.3, 0.3), location_lon=-118.25 + rng.uniform(-0.3, 0.3))
+                    for _ in range(count)
+                ]
+                db.session.add_all(machines)
+                db.session.flush()
+                db.session.add_all([
+                    MachineExpiryBucket(machine_id=machine.id, expiry_date=yesterday, units=rng.randint(1, 20))
+                    for machine in machines
+                ])
+                db.session.commit()
+
+                start = time.perf_counter()
+                stops = len(client.get("/api/volunteer/route", query_string=query).get_json()["stops"])
+                first_ms = (time.perf_counter() - start) * 1000
+                cached_ms = time_call(lambda: client.get("/api/volunteer/route", query_string=query), args.rounds)
+                print(f"{count:>8} {stops:>8} {first_ms:>10.2f} {cached_ms:>10.2f}")
+                if count <= BUDGET_SITES and cached_ms > BUDGET_MS:
+                    over_budget.append(count)
+
+            db.session.remove()
+
+    if over_budget:
+        sys.exit(f"Over the {BUDGET_MS} ms budget with {', '.join(map(str, over_budget))} sites")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+fleet_load.py - Fleet load simulator for the machine API
+
+Runs N virtual machines, each driving machine_software.api_client.APIClient through a
+weighted mix of auth, status, donate, collect, sync and expired-removal calls, and writes
+a JSON report with throughput and p50/p95/p99 latency per endpoint and the growth of the
+database, for comparing releases.
+
+By default the backend runs in-process (Flask test client) on a scratch SQLite database,
+configured like the server itself (DATABASE_PROFILE etc., see config.py). With --base-url
+the simulator drives a running instance over HTTP instead; pass --db-path to have the
+size of its SQLite file reported.
+
+Usage:
+    python benchmarks/fleet_load.py [--machines N] [--ops N] [--concurrency N]
+                                    [--mix auth=5,status=30,...] [--base-url URL]
+                                    [--db-path FILE] [--output report.json]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+# Add backend directory (and the repository root, for machine_software) to path
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+sys.path.append(os.path.dirname(BACKEND_DIR))
+
+from machine_software.api_client import APIClient
+
+DEFAULT_MIX = "auth=2,status=30,donate=25,collect=25,sync=10,expired=8"
+OPERATIONS = ("auth", "status", "donate", "collect", "sync", "expired")
+PERCENTILES = (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99))
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def parse_mix(value):
+    """Parse "name=weight,..." into a dict of operation weights."""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; expected {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+class _Response:
+    """The part of requests.Response that APIClient uses, for in-process responses."""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.content = response.get_data()
+        self.text = self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class InProcessTransport:
+    """requests-style get/post/put/delete served by the Flask app without a socket."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, headers=None, json=None):
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        return _Response(self.client.open(path, method=method, headers=headers, json=json))
+
+    def get(self, url, headers=None):
+        return self.request("GET", url, headers)
+
+    def post(self, url, headers=None, json=None):
+        return self.request("POST", url, headers, json)
+
+    def put(self, url, headers=None, json=None):
+        return self.request("PUT", url, headers, json)
+
+    def delete(self, url, headers=None):
+        return self.request("DELETE", url, headers)
+
+
+class Recorder:
+    """Thread-safe latency samples per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, endpoint, elapsed_ms, status):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(elapsed_ms)
+            if status is None or status >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            entry = {
+                "requests": len(ordered),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": round(len(ordered) / elapsed, 2),
+            }
+            for name, fraction in PERCENTILES:
+                entry[name] = round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+            endpoints[endpoint] = entry
+        return endpoints
+
+
+class TimedTransport:
+    """Wraps a transport and records the latency of every call under its endpoint."""
+
+    def __init__(self, inner, base_url, recorder):
+        self.inner = inner
+        self.base_path = urlsplit(base_url).path.rstrip("/")
+        self.recorder = recorder
+
+    def _endpoint(self, method, url):
+        path = urlsplit(url).path
+        if path.startswith(self.base_path):
+            path = path[len(self.base_path):]
+        return f"{method} {_ID_SEGMENT.sub('/<id>', path)}"
+
+    def _call(self, method, url, **kwargs):
+        started = time.perf_counter()
+        status = None
+        try:
+            response = getattr(self.inner, method.lower())(url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.recorder.add(self._endpoint(method, url), (time.perf_counter() - started) * 1000, status)
+
+    def get(self, url, headers=None):
+        return self._call("GET", url, headers=headers)
+
+    def post(self, url, headers=None, json=None):
+        return self._call("POST", url, headers=headers, json=json)
+
+    def put(self, url, headers=None, json=None):
+        return self._call("PUT", url, headers=headers, json=json)
+
+    def delete(self, url, headers=None):
+        return self._call("DELETE", url, headers=headers)
+
+
+class VirtualMachine:
+    """One simulated machine: an APIClient plus the little state a real machine keeps."""
+
+    def __init__(self, machine_id, base_url, transport, rng):
+        self.rng = rng
+        self.client = APIClient(machine_id, base_url, http=transport)
+        self.storage_level = 0
+        self.lots = []
+
+    def run(self, operation):
+        getattr(self, operation)()
+
+    def auth(self):
+        self.client.authenticate()
+
+    def status(self):
+        self.client.update_machine_status({
+            "available_space": self.storage_level,
+            "available_food_items": self.storage_level,
+            "temperature": round(self.rng.uniform(2, 8), 1),
+            "door_status": "closed",
+            "network_status": "online",
+        })
+
+    def donate(self):
+        expiry = datetime.date.today() + datetime.timedelta(days=self.rng.randint(0, 7))
+        result = self.client.report_donation({"quantity": self.rng.randint(1, 4), "expiry_date": expiry.isoformat()})
+        if result:
+            self.lots.append(result["lot_id"])
+            self.storage_level = result["new_storage_level"]
+
+    def collect(self):
+        result = self.client.report_collection({"quantity": self.rng.randint(1, 3)})
+        if result:
+            self.storage_level = result["new_storage_level"]
+
+    def sync(self):
+        items = [{"expiry_date": (datetime.date.today() + datetime.timedelta(days=3)).isoformat(), "quantity": 1}]
+        if self.lots:
+            items.append({"id": self.lots.pop(0), "is_dispensed": True})
+        result = self.client.sync_food_items(items)
+        if result:
+            self.storage_level = result["current_storage_level"]
+
+    def expired(self):
+        removed = [self.lots.pop(0)] if self.lots else []
+        result = self.client.report_expired_removal({"food_item_ids": removed, "quantity": len(removed)})
+        if result:
+            self.storage_level = result["current_storage_level"]
+
+
+def database_size(path):
+    """Bytes used by a SQLite database file and its WAL, or None without a path."""
+    if not path:
+        return None
+    return sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+
+
+def row_counts(app):
+    """Rows per table of the in-process backend's database."""
+    from models.models import db
+    with app.app_context():
+        counts = {
+            table.name: db.session.execute(db.select(db.func.count()).select_from(table)).scalar()
+            for table in db.metadata.sorted_tables
+        }
+        db.session.remove()
+    return counts
+
+
+def run(args):
+    """Run the simulation and return the report dictionary."""
+    app = None
+    db_path = args.db_path
+    tmp = None
+    if args.base_url:
+        base_url = args.base_url.rstrip("/")
+        make_transport = requests.Session
+    else:
+        from config import database_config
+        from main import create_app
+        from models.models import db
+        tmp = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp.name, "fleet.db")
+        app = create_app(dict(database_config(), SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_path}"))
+        with app.app_context():
+            db.create_all()
+            db.session.remove()
+        base_url = "http://backend.local/api"
+        make_transport = lambda: InProcessTransport(app)
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    machine_ids = list(range(args.first_machine_id, args.first_machine_id + args.machines))
+
+    # Register the fleet (not timed)
+    setup = make_transport()
+    for machine_id in machine_ids:
+        response = setup.post(f"{base_url}/machine/register", json={
+            "machine_id": machine_id,
+            "location_lat": round(rng.uniform(33.5, 34.5), 5),
+            "location_lon": round(rng.uniform(-118.7, -117.7), 5),
+            "address_description": f"Virtual machine {machine_id}",
+        })
+        if response.status_code not in (200, 201):
+            raise SystemExit(f"Could not register machine {machine_id}: {response.status_code} {response.text}")
+
+    size_before = database_size(db_path)
+    rows_before = row_counts(app) if app else None
+    operations, weights = zip(*args.mix.items())
+
+    def worker(index):
+        worker_rng = random.Random(args.seed * 1000 + index)
+        transport = TimedTransport(make_transport(), base_url, recorder)
+        fleet = [
+            VirtualMachine(machine_id, base_url, transport, worker_rng)
+            for machine_id in machine_ids[index::args.concurrency]
+        ]
+        for _ in range(args.ops):
+            for machine in fleet:
+                machine.run(worker_rng.choices(operations, weights)[0])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(min(args.concurrency, len(machine_ids)))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    endpoints = recorder.report(elapsed)
+    total = sum(entry["requests"] for entry in endpoints.values())
+    size_after = database_size(db_path)
+    report = {
+        "generated_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "environment": {
+            "python": platform.python_version(),
+            "backend": args.base_url or "in-process",
+            "database_profile": app.config["DATABASE_PROFILE"] if app else None,
+        },
+        "config": {
+            "machines": args.machines,
+            "ops_per_machine": args.ops,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "duration_s": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(entry["errors"] for entry in endpoints.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "endpoints": endpoints,
+        "database": {
+            "bytes_before": size_before,
+            "bytes_after": size_after,
+            "growth_bytes": None if size_before is None else size_after - size_before,
+            "rows_before": rows_before,
+            "rows_after": row_counts(app) if app else None,
+        },
+    }
+    if app:
+        with app.app_context():
+            db.engine.dispose()
+    if tmp:
+        tmp.cleanup()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--machines", type=int, default=50, help="Virtual machines in the fleet")
+    parser.add_argument("--ops", type=int, default=20, help="Operations per machine")
+    parser.add_argument("--concurrency", type=int, default=8, help="Worker threads the fleet is spread over")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--base-url", help="Drive a running backend, e.g. http://localhost:5000/api")
+    parser.add_argument("--db-path", help="SQLite file of the running backend, for the size report")
+    parser.add_argument("--first-machine-id", type=int, default=1, help="Id of the first virtual machine")
+    parser.add_argument("--output", "-o", help="Write the JSON report here (default stdout)")
+    args = parser.parse_args()
+
+    # APIClient logs every call at INFO
+    logging.basicConfig(level=logging.CRITICAL)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory, jsonify
+from flask import Flask, current_app, send_from_directory, jsonify
 # Updated model imports
 from models.models import db, Machine, FoodItem, User, Volunteer, Admin
 
@@ -13,29 +13,22 @@ from models.models import db, Machine, FoodItem, User, Volunteer, Admin
 from routes.machine_routes import machine_bp
 from routes.volunteer_routes import volunteer_bp
 from routes.public_routes import public_bp
+from routes.export_routes import export_bp
+from routes.analytics_routes import analytics_bp
 # Import the new machine compatibility blueprint
 from routes.machine_compatibility import machine_compat_bp
+from config import database_config, install_sqlite_pragmas
+from services.analytics import rebuild_daily_stats_command
+from services.archive import archive_food_items_command
+from services.counters import verify_counters_command
+from services.expiry_sweeper import install_expiry_sweeper, sweep_expired_command
+from services.export import export_food_items_command
+from services.request_metrics import install_request_metrics
+from services.state_backfill import backfill_food_item_state_command, install_database_preparation
+from services.telemetry import prune_telemetry_command
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a_very_strong_default_secret_key_for_dev')
-
-# Database Configuration - Using SQLite for testing
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///exes_food.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db.init_app(app)
-
-# Register blueprints
-app.register_blueprint(machine_bp, url_prefix='/api/machines')
-app.register_blueprint(volunteer_bp, url_prefix='/api/volunteer')
-app.register_blueprint(public_bp, url_prefix='/api/public')
-# Register the new machine compatibility blueprint
-app.register_blueprint(machine_compat_bp)
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
 def serve(path):
-    static_folder_path = app.static_folder
+    static_folder_path = current_app.static_folder
     if static_folder_path is None:
         return "Static folder not configured", 404
 
@@ -49,7 +42,61 @@ def serve(path):
             # Basic API root message if no index.html
             return jsonify({"message": "Welcome to the Exes Food Management System API. Frontend not yet implemented."}), 200
 
-if __name__ == '__main__':
+def create_app(config=None):
+    """Create the Flask application.
+
+    Args:
+        config: Optional mapping of config values applied before the database is bound
+                (used by the test suite and benchmarks to point at a scratch database)
+    """
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+    app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a_very_strong_default_secret_key_for_dev')
+
+    # Database Configuration - profile chosen by DATABASE_PROFILE / DATABASE_URL (see config.py)
+    app.config.update(database_config())
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
     with app.app_context():
-        db.create_all() # Create database tables if they don't exist
+        install_sqlite_pragmas(db.engine, app.config.get('SQLITE_PRAGMAS'))
+        # Per-endpoint latency / SQL / size metrics, served at /metrics
+        install_request_metrics(app, db.engine)
+    # Creates and upgrades the schema (and backfills FoodItem.state) before the first request
+    install_database_preparation(app)
+    # Moves expired lots to expired-pending-removal from the first request on, and at each midnight
+    install_expiry_sweeper(app)
+
+    # Register blueprints
+    app.register_blueprint(machine_bp, url_prefix='/api/machines')
+    app.register_blueprint(volunteer_bp, url_prefix='/api/volunteer')
+    app.register_blueprint(public_bp, url_prefix='/api/public')
+    app.register_blueprint(export_bp, url_prefix='/api/export')
+    app.register_blueprint(analytics_bp, url_prefix='/api/analytics')
+    # Register the new machine compatibility blueprint
+    app.register_blueprint(machine_compat_bp)
+
+    # flask --app main verify-counters [--repair]
+    app.cli.add_command(verify_counters_command)
+    # flask --app main prune-telemetry
+    app.cli.add_command(prune_telemetry_command)
+    # flask --app main export-food-items [--format csv] [--gzip] [-o file]
+    app.cli.add_command(export_food_items_command)
+    # flask --app main rebuild-daily-stats [--machine ID]
+    app.cli.add_command(rebuild_daily_stats_command)
+    # flask --app main sweep-expired (for cron, when the background sweeper is disabled)
+    app.cli.add_command(sweep_expired_command)
+    # flask --app main backfill-food-item-state [--chunk-size N] [--pause SECONDS]
+    app.cli.add_command(backfill_food_item_state_command)
+    # flask --app main archive-food-items [--older-than-days N] [--batch-size N] (daily, from cron)
+    app.cli.add_command(archive_food_items_command)
+
+    app.add_url_rule('/', 'serve', serve, defaults={'path': ''})
+    app.add_url_rule('/<path:path>', 'serve', serve)
+    return app
+
+app = create_app()
+
+if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
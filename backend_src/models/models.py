@@ -1,6 +1,7 @@
 # Database Models for Exes Food Management System
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.schema import CreateColumn
 import datetime
 
 db = SQLAlchemy()
@@ -16,29 +17,192 @@ class Machine(db.Model):
     current_storage_level = db.Column(db.Integer, nullable=False, default=0) # Current units of food
     last_heartbeat = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     operational_hours = db.Column(db.String(100), nullable=True) # e.g., "24/7" or "9am-5pm Mon-Fri"
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default="0") # Bumped by every change to this machine's food items
 
     food_items = db.relationship("FoodItem", backref="machine", lazy=True, cascade="all, delete-orphan")
+    counter = db.relationship("MachineCounter", uselist=False, lazy=True, cascade="all, delete-orphan")
+    expiry_buckets = db.relationship("MachineExpiryBucket", lazy=True, cascade="all, delete-orphan")
+    daily_stats = db.relationship("MachineDailyStats", lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"<Machine {self.id} at ({self.location_lat}, {self.location_lon})>"
 
+class FoodItemState:
+    """Values of FoodItem.state, the lifecycle of a lot."""
+    AVAILABLE = 0 # In the machine
+    EXPIRED = 1 # In the machine, moved to expired-pending-removal by the expiry sweeper
+    DISPENSED = 2 # Taken out by a receiver
+    EXPIRED_REMOVED = 3 # Taken out after expiring, by a volunteer or the machine itself
+
+    IN_MACHINE = (AVAILABLE, EXPIRED)
+    NAMES = {AVAILABLE: "available", EXPIRED: "expired", DISPENSED: "dispensed", EXPIRED_REMOVED: "expired_removed"}
+
+def state_is(column, *states):
+    """Test a state column against FoodItemState values.
+
+    The values are rendered inline rather than bound, which is what lets SQLite match the
+    test against the WHERE of a partial index.
+    """
+    values = [db.literal_column(str(int(state))) for state in states]
+    return column == values[0] if len(values) == 1 else column.in_(values)
+
 class FoodItem(db.Model):
     __tablename__ = "food_items"
     id = db.Column(db.Integer, primary_key=True)
-    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), nullable=False)
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), nullable=False, index=True)
     # food_type = db.Column(db.String(100), nullable=False) # e.g., canned goods, bread, fruit - decided against for now to keep simple
     quantity = db.Column(db.Integer, nullable=False, default=1) # Assuming 1 item = 1 packet/unit
     expiry_date = db.Column(db.Date, nullable=False)
     donated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    is_dispensed = db.Column(db.Boolean, default=False)
+    # A FoodItemState value. NULL only on rows written before the column existed, until
+    # services.state_backfill has derived it from the old boolean flags (before the first
+    # request, or ahead of time with `flask --app main backfill-food-item-state`).
+    state = db.Column(db.SmallInteger, nullable=True, default=FoodItemState.AVAILABLE)
     dispensed_at = db.Column(db.DateTime, nullable=True)
-    is_expired_removed = db.Column(db.Boolean, default=False)
     expired_removed_at = db.Column(db.DateTime, nullable=True)
     expired_removed_by_volunteer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
+    expired_at = db.Column(db.DateTime, nullable=True) # When the expiry sweeper moved it to EXPIRED
+    sync_version = db.Column(db.Integer, nullable=False, default=0, server_default="0") # Machine.sync_version of the last change to this item
+
+    # FEFO dispense and availability reads only look at available lots, so index just those
+    # rows in expiry order. Including quantity lets unit counts be answered from the index alone.
+    # (Databases without partial indexes, e.g. MySQL, get a plain composite index.)
+    __table_args__ = (
+        db.Index(
+            "ix_food_items_state_available", "machine_id", "expiry_date", "quantity",
+            sqlite_where=state_is(state, FoodItemState.AVAILABLE),
+            postgresql_where=state_is(state, FoodItemState.AVAILABLE)
+        ),
+        # Volunteers list a machine's lots awaiting removal (set by the expiry sweeper)
+        db.Index(
+            "ix_food_items_state_expired", "machine_id", "id",
+            sqlite_where=state_is(state, FoodItemState.EXPIRED),
+            postgresql_where=state_is(state, FoodItemState.EXPIRED)
+        ),
+        # Delta sync reads a machine's items changed since a given version
+        db.Index("ix_food_items_machine_sync_version", "machine_id", "sync_version"),
+        # Rows still to be backfilled by services.state_backfill (empty once it has run)
+        db.Index(
+            "ix_food_items_state_unset", "id",
+            sqlite_where=state.is_(None),
+            postgresql_where=state.is_(None)
+        ),
+        # Ids are never reused once a row is deleted or archived (SQLite would otherwise
+        # hand out max(id) + 1 again); archived rows keep their id
+        {"sqlite_autoincrement": True},
+    )
 
     def __repr__(self):
         return f"<FoodItem {self.id} in Machine {self.machine_id}, Expires: {self.expiry_date}>"
 
+class FoodItemArchive(db.Model):
+    """A dispensed or removed FoodItem moved out of food_items by services.archive.
+
+    Rows keep their food_items id and columns. machine_id and the volunteer id are not
+    foreign keys: history outlives the machines and users it mentions.
+    """
+    __tablename__ = "food_items_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False) # FoodItem.id
+    machine_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expiry_date = db.Column(db.Date, nullable=False)
+    donated_at = db.Column(db.DateTime, nullable=True)
+    state = db.Column(db.SmallInteger, nullable=False) # FoodItemState.DISPENSED or EXPIRED_REMOVED
+    dispensed_at = db.Column(db.DateTime, nullable=True)
+    expired_removed_at = db.Column(db.DateTime, nullable=True)
+    expired_removed_by_volunteer_id = db.Column(db.Integer, nullable=True)
+    expired_at = db.Column(db.DateTime, nullable=True)
+    sync_version = db.Column(db.Integer, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    # History reads and exports of one machine, in id order
+    __table_args__ = (db.Index("ix_food_items_archive_machine_id", "machine_id", "id"),)
+
+    def __repr__(self):
+        return f"<FoodItemArchive {self.id} of Machine {self.machine_id}>"
+
+class MachineCounter(db.Model):
+    """Running totals for one machine, updated in the same transaction as its food items."""
+    __tablename__ = "machine_counters"
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), primary_key=True)
+    dispensed_on = db.Column(db.Date, nullable=True) # Local date that dispensed_today counts (rolls over with the expiry buckets, not MachineDailyStats)
+    dispensed_today = db.Column(db.Integer, nullable=False, default=0) # Units dispensed on dispensed_on
+    expired_pending = db.Column(db.Integer, nullable=False, default=0, server_default="0") # Units swept into expired-pending-removal and still in the machine
+
+    def __repr__(self):
+        return f"<MachineCounter for Machine {self.machine_id}>"
+
+class MachineExpiryBucket(db.Model):
+    """Units still in a machine that expire on one day.
+
+    Available units are the buckets expiring today or later, expired units the rest.
+    """
+    __tablename__ = "machine_expiry_buckets"
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), primary_key=True)
+    expiry_date = db.Column(db.Date, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<MachineExpiryBucket Machine {self.machine_id} {self.expiry_date}: {self.units}>"
+
+class MachineDailyStats(db.Model):
+    """Activity of one machine on one UTC day, maintained by the inventory write paths.
+
+    Days follow the stored UTC timestamps, so near midnight they differ from the local date
+    that MachineCounter.dispensed_today and the expiry buckets roll over on.
+    """
+    __tablename__ = "machine_daily_stats"
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True) # UTC day the events happened on
+    donated_units = db.Column(db.Integer, nullable=False, default=0)
+    dispensed_units = db.Column(db.Integer, nullable=False, default=0)
+    expired_removed_units = db.Column(db.Integer, nullable=False, default=0)
+    dwell_seconds = db.Column(db.Float, nullable=False, default=0.0) # Seconds in the machine, summed over units that left this day
+    dwell_units = db.Column(db.Integer, nullable=False, default=0) # Units counted in dwell_seconds
+
+    # Fleet-wide reports read a range of days across every machine
+    __table_args__ = (db.Index("ix_machine_daily_stats_day", "day"),)
+
+    def __repr__(self):
+        return f"<MachineDailyStats Machine {self.machine_id} on {self.day}>"
+
+class TelemetryPoint(db.Model):
+    """One raw telemetry reading. Rows are only appended, and pruned once past retention."""
+    __tablename__ = "telemetry_points"
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), nullable=False)
+    metric = db.Column(db.String(50), nullable=False) # e.g., temperature, humidity
+    recorded_at = db.Column(db.DateTime, nullable=False) # UTC
+    value = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        # Series reads: one metric of one machine over a time range
+        db.Index("ix_telemetry_points_series", "machine_id", "metric", "recorded_at"),
+        # Retention deletes by age across all machines
+        db.Index("ix_telemetry_points_recorded_at", "recorded_at"),
+    )
+
+    def __repr__(self):
+        return f"<TelemetryPoint Machine {self.machine_id} {self.metric}={self.value} at {self.recorded_at}>"
+
+class TelemetryRollup(db.Model):
+    """Aggregate of one metric of one machine over a fixed-size time bucket."""
+    __tablename__ = "telemetry_rollups"
+    machine_id = db.Column(db.Integer, db.ForeignKey("machines.id"), primary_key=True)
+    metric = db.Column(db.String(50), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True) # Bucket size in seconds: 60, 3600 or 86400
+    bucket_start = db.Column(db.DateTime, primary_key=True) # UTC
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+
+    # Retention deletes one resolution by age across all machines
+    __table_args__ = (db.Index("ix_telemetry_rollups_age", "resolution", "bucket_start"),)
+
+    def __repr__(self):
+        return f"<TelemetryRollup Machine {self.machine_id} {self.metric}/{self.resolution}s at {self.bucket_start}>"
+
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
@@ -79,9 +243,29 @@ class Admin(User):
         "polymorphic_identity": "admin",
     }
 
+def upgrade_schema(engine):
+    """Add columns and indexes declared since an existing table was created.
+
+    create_all only creates missing tables. Added columns must be nullable or carry a
+    server_default so existing rows stay valid.
+    """
+    inspector = db.inspect(engine)
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
 # Donations are anonymous, so no specific Donor table linked to users.
 # Donation events can be implicitly tracked via FoodItem creation if needed for analytics,
 # but without linking to a specific donor user.
 
 # Receiver interactions are also anonymous at the machine level.
-# Dispensing events are tracked in FoodItem.is_dispensed and FoodItem.dispensed_at.
+# Dispensing events are tracked in FoodItem.state and FoodItem.dispensed_at.
@@ -0,0 +1,28 @@
+# Analytics API Routes (reports over the daily rollups)
+
+from flask import Blueprint, request, jsonify
+from services.analytics import AnalyticsError, query_daily_stats
+import datetime
+
+analytics_bp = Blueprint("analytics_bp", __name__, url_prefix="/api/analytics")
+
+# Days reported when no range is given
+DEFAULT_RANGE_DAYS = 30
+
+@analytics_bp.route("/daily", methods=["GET"])
+def get_daily_stats():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive, UTC days)&machine_id=<id>(repeatable)&group_by=machine|day
+    try:
+        end = request.args.get("end")
+        end = datetime.date.fromisoformat(end) if end else datetime.datetime.utcnow().date()
+        start = request.args.get("start")
+        start = datetime.date.fromisoformat(start) if start else end - datetime.timedelta(days=DEFAULT_RANGE_DAYS - 1)
+        machine_ids = [int(machine_id) for machine_id in request.args.getlist("machine_id")]
+    except ValueError:
+        return jsonify({"error": "Invalid start, end or machine_id"}), 400
+
+    try:
+        rows = query_daily_stats(start, end, machine_ids or None, request.args.get("group_by", "machine"))
+    except AnalyticsError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(rows), 200
@@ -0,0 +1,38 @@
+# Export API Routes (bulk data for analytics jobs)
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from services.export import FORMATS, MIMETYPES, export_history
+import datetime
+
+export_bp = Blueprint("export_bp", __name__, url_prefix="/api/export")
+
+def parse_time(value):
+    # ISO 8601, naive values are UTC
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@export_bp.route("/food_items", methods=["GET"])
+def export_food_items():
+    # Streams the whole history: ?format=ndjson|csv&start=&end=&machine_id=<id>(repeatable)&gzip=1
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in FORMATS:
+        return jsonify({"error": f"format must be one of {list(FORMATS)}"}), 400
+    try:
+        start = parse_time(request.args.get("start"))
+        end = parse_time(request.args.get("end"))
+        machine_ids = [int(machine_id) for machine_id in request.args.getlist("machine_id")]
+    except ValueError:
+        return jsonify({"error": "Invalid start, end or machine_id"}), 400
+    compress = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+
+    stream = export_history(fmt, start, end, machine_ids or None, compress)
+    # A compressed export is a .gz file, not a transfer encoding: clients must not unpack it
+    mimetype = "application/gzip" if compress else MIMETYPES[fmt]
+    response = Response(stream_with_context(stream), mimetype=mimetype)
+    filename = f"food_items.{fmt}" + (".gz" if compress else "")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
@@ -5,9 +5,17 @@ This module provides compatibility endpoints for the machine software to connect
 It adapts the machine client's expected endpoints to the actual backend implementation.
 """
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, abort, make_response, request, jsonify
 from models.models import db, Machine, FoodItem
+from services.heartbeats import get_heartbeat_buffer
+from services.inventory import InventoryError, dispense_units, ingest_donation, remove_items
+from services.response_cache import cached_response
+from services.spatial_index import get_machine_index
+from services.sync import apply_sync, changes_since
+from services.telemetry import TelemetryError, ingest_points, maybe_apply_retention, parse_timestamp
+from services.token_cache import get_token_cache
 import datetime
+import logging
 import secrets
 import jwt
 from functools import wraps
@@ -15,13 +23,62 @@ from functools import wraps
 # Create blueprint with the prefix expected by machine client
 machine_compat_bp = Blueprint("machine_compat_bp", __name__, url_prefix="/api")
 
+logger = logging.getLogger(__name__)
+
 # Secret key for JWT token generation
 JWT_SECRET = secrets.token_hex(32)  # In production, this should be in environment variables
 
 # Dictionary to store machine tokens
 machine_tokens = {}
 
+# Responses for rejected donations, keyed by InventoryError.reason
+DONATION_ERRORS = {
+    'not_found': ('Machine not found', 404),
+    'inactive': ('Machine not active', 403),
+    'full': ('Machine storage is full', 403),
+    'overflow': ('Machine became full during donation process', 507),
+}
+
+# Status report fields that are also stored as telemetry readings
+STATUS_TELEMETRY_FIELDS = ('temperature', 'available_space', 'available_food_items')
+
+# Result size bounds for the nearest-machine locator
+DEFAULT_NEAREST_LIMIT = 20
+MAX_NEAREST_LIMIT = 500
+
+class AuthenticatedMachine:
+    """The machine a request is authenticated as, loaded only when a handler needs more than its id.
+
+    Handlers that only read machine.id run without a machines query. Reading or setting
+    any other attribute loads the Machine row (once) and goes through to it.
+    """
+
+    __slots__ = ("id", "_row")
+
+    def __init__(self, machine_id):
+        object.__setattr__(self, "id", machine_id)
+        object.__setattr__(self, "_row", None)
+
+    def _load(self):
+        row = self._row
+        if row is None:
+            row = db.session.get(Machine, self.id)
+            if row is None:
+                # Deleted since its existence was cached
+                get_token_cache().invalidate_machine(self.id)
+                abort(make_response(jsonify({'error': 'Invalid machine'}), 401))
+            object.__setattr__(self, "_row", row)
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
 # Token verification decorator
+# Verified tokens and existing machines are cached, so a repeat call needs neither a JWT
+# decode nor a machines query; the authenticated machine is passed to the handler
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -34,21 +91,29 @@ def token_required(f):
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
         
-        try:
-            data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-            machine_id = data['machine_id']
-            
-            # Verify machine exists
-            machine = Machine.query.get(machine_id)
-            if not machine:
-                return jsonify({'error': 'Invalid machine'}), 401
-                
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'error': 'Invalid token'}), 401
+        token_cache = get_token_cache()
+        machine_id = token_cache.get(token)
+        if machine_id is None:
+            try:
+                data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+                machine_id = data['machine_id']
+            except jwt.ExpiredSignatureError:
+                return jsonify({'error': 'Token has expired'}), 401
+            except jwt.InvalidTokenError:
+                return jsonify({'error': 'Invalid token'}), 401
+            token_cache.put(token, machine_id, data.get('exp'))
+        
+        # Verify machine exists
+        if token_cache.has_machine(machine_id):
+            return f(AuthenticatedMachine(machine_id), *args, **kwargs)
+        machine = db.session.get(Machine, machine_id)
+        if not machine:
+            token_cache.discard(token)
+            return jsonify({'error': 'Invalid machine'}), 401
+        if machine.id == machine_id:
+            token_cache.put_machine(machine_id)
             
-        return f(machine_id, *args, **kwargs)
+        return f(machine, *args, **kwargs)
     
     return decorated
 
@@ -80,6 +145,10 @@ def machine_auth():
     
     # Store token
     machine_tokens[machine_id] = token
+    # The first call made with the token need not look the machine up again (the check
+    # keeps ids sent as strings out of the cache, which is invalidated by integer id)
+    if machine.id == machine_id:
+        get_token_cache().put_machine(machine_id)
     
     return jsonify({'token': token}), 200
 
@@ -109,6 +178,8 @@ def register_machine():
             machine.operational_hours = data['operational_hours']
         
         db.session.commit()
+        # Tokens issued before re-registration must be verified again
+        get_token_cache().invalidate_machine(machine_id)
         return jsonify({'message': 'Machine updated successfully'}), 200
     else:
         # Create new machine
@@ -130,17 +201,13 @@ def register_machine():
 # Machine status update endpoint
 @machine_compat_bp.route("/machine/status", methods=["POST"])
 @token_required
-def update_status(machine_id):
+def update_status(machine):
     """Update machine status information."""
     data = request.get_json()
     
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     # Update machine status
     if 'available_space' in data:
         machine.current_storage_level = data['available_space']
@@ -150,230 +217,204 @@ def update_status(machine_id):
     else:
         machine.status = 'active'
     
-    machine.last_heartbeat = datetime.datetime.utcnow()
+    # Numeric readings in the status report are kept as telemetry; bad ones do not fail the
+    # status update but are logged and reported back
+    response = {'message': 'Machine status updated successfully'}
+    readings = {key: data[key] for key in STATUS_TELEMETRY_FIELDS if data.get(key) is not None}
+    if readings:
+        readings['timestamp'] = data.get('timestamp')
+        try:
+            # ingest_points would drop a point with a bad timestamp without saying why
+            parse_timestamp(readings['timestamp'])
+            ingest_points(machine.id, [readings])
+        except TelemetryError as e:
+            logger.warning("Machine %s sent invalid telemetry in a status report: %s", machine.id, e)
+            response['telemetry_error'] = str(e)
+    
+    # Only real changes reach the machine row; the heartbeat itself is buffered
+    db.session.commit()
+    get_heartbeat_buffer().record(machine.id)
+    return jsonify(response), 200
+
+# Telemetry ingestion endpoint
+@machine_compat_bp.route("/machine/telemetry", methods=["POST"])
+@token_required
+def report_telemetry(machine):
+    """Store a batch of telemetry points."""
+    data = request.get_json()
     
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    
+    try:
+        result = ingest_points(machine.id, data.get('points'))
+    except TelemetryError as e:
+        return jsonify({'error': str(e)}), 400
     db.session.commit()
-    return jsonify({'message': 'Machine status updated successfully'}), 200
+    maybe_apply_retention()
+    
+    return jsonify({
+        'message': 'Telemetry stored successfully',
+        'accepted_readings': result['accepted'],
+        'rejected_points': result['rejected']
+    }), 200
 
 # Food donation endpoint
 @machine_compat_bp.route("/food/donate", methods=["POST"])
 @token_required
-def donate_food(machine_id):
+def donate_food(machine):
     """Report a new food donation."""
     data = request.get_json()
     
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
-    if machine.status != 'active':
-        return jsonify({'error': 'Machine not active'}), 403
-    
-    if machine.current_storage_level >= machine.storage_capacity_max:
-        return jsonify({'error': 'Machine storage is full'}), 403
-    
     # Process donation
     try:
         expiry_date = datetime.datetime.strptime(data.get('expiry_date', ''), "%Y-%m-%d").date()
         quantity = int(data.get('quantity', 1))
     except (ValueError, TypeError):
         return jsonify({'error': 'Invalid expiry date or quantity'}), 400
+    if quantity < 1:
+        return jsonify({'error': 'quantity must be a positive integer'}), 400
     
     if expiry_date < datetime.date.today():
         return jsonify({'error': 'Cannot donate expired food'}), 400
     
-    # Add food items
-    for _ in range(quantity):
-        if machine.current_storage_level < machine.storage_capacity_max:
-            new_food_item = FoodItem(
-                machine_id=machine_id,
-                expiry_date=expiry_date,
-                quantity=1  # Assuming 1 item per entry for easier tracking
-            )
-            db.session.add(new_food_item)
-            machine.current_storage_level += 1
-        else:
-            db.session.rollback()
-            return jsonify({'error': 'Machine became full during donation process'}), 507
+    # Store the donation as one lot; capacity is claimed in a single conditional update
+    try:
+        lot_id, new_storage_level = ingest_donation(machine.id, expiry_date, quantity)
+    except InventoryError as e:
+        db.session.rollback()
+        message, status_code = DONATION_ERRORS[e.reason]
+        return jsonify({'error': message}), status_code
     
     db.session.commit()
     return jsonify({
         'message': 'Donation reported successfully',
-        'new_storage_level': machine.current_storage_level
+        'lot_id': lot_id,
+        'new_storage_level': new_storage_level
     }), 200
 
 # Food collection endpoint
 @machine_compat_bp.route("/food/collect", methods=["POST"])
 @token_required
-def collect_food(machine_id):
+def collect_food(machine):
     """Report a food collection."""
     data = request.get_json()
     
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     if machine.status != 'active':
         return jsonify({'error': 'Machine not active'}), 403
     
-    # Find food items to dispense
-    quantity = int(data.get('quantity', 1))
-    dispensed_items = []
-    
-    for _ in range(quantity):
-        # Find the soonest-to-expire, non-dispensed, non-expired food item
-        food_to_dispense = FoodItem.query.filter(
-            FoodItem.machine_id == machine_id,
-            FoodItem.is_dispensed == False,
-            FoodItem.is_expired_removed == False,
-            FoodItem.expiry_date >= datetime.date.today()
-        ).order_by(FoodItem.expiry_date.asc()).first()
-        
-        if not food_to_dispense:
-            break
-        
-        food_to_dispense.is_dispensed = True
-        food_to_dispense.dispensed_at = datetime.datetime.utcnow()
-        machine.current_storage_level -= food_to_dispense.quantity
-        dispensed_items.append(food_to_dispense.id)
+    try:
+        quantity = int(data.get('quantity', 1))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid quantity'}), 400
+    if quantity < 1:
+        return jsonify({'error': 'Invalid quantity'}), 400
+    
+    # Dispense the soonest-to-expire lots in one pick
+    try:
+        dispensed_items, units_dispensed, new_storage_level = dispense_units(machine.id, quantity)
+    except InventoryError:
+        db.session.rollback()
+        return jsonify({'error': 'Machine is busy, please retry'}), 409
     
     if not dispensed_items:
         return jsonify({'error': 'No suitable food available for dispensing'}), 404
     
-    if machine.current_storage_level < 0:
-        machine.current_storage_level = 0  # Safety check
-    
     db.session.commit()
     return jsonify({
         'message': 'Food collected successfully',
         'items_dispensed': dispensed_items,
-        'new_storage_level': machine.current_storage_level
+        'quantity_dispensed': units_dispensed,
+        'new_storage_level': new_storage_level
     }), 200
 
 # Food sync endpoint
 @machine_compat_bp.route("/food/sync", methods=["POST"])
 @token_required
-def sync_food(machine_id):
+def sync_food(machine):
     """Sync food items between machine and backend."""
     data = request.get_json()
     
     if not data or 'items' not in data:
         return jsonify({'error': 'No items provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     items = data['items']
-    synced_items = []
+    if not isinstance(items, list):
+        return jsonify({'error': 'Items must be a list'}), 400
     
-    # Process each item
-    for item in items:
-        item_id = item.get('id')
-        
-        # Check if item exists
-        food_item = FoodItem.query.get(item_id) if item_id else None
-        
-        if food_item:
-            # Update existing item
-            if 'is_dispensed' in item:
-                food_item.is_dispensed = item['is_dispensed']
-            if 'is_expired_removed' in item:
-                food_item.is_expired_removed = item['is_expired_removed']
-            synced_items.append(food_item.id)
-        else:
-            # Create new item
-            try:
-                expiry_date = datetime.datetime.strptime(item.get('expiry_date', ''), "%Y-%m-%d").date()
-            except ValueError:
-                continue
-                
-            new_food_item = FoodItem(
-                machine_id=machine_id,
-                expiry_date=expiry_date,
-                quantity=item.get('quantity', 1),
-                is_dispensed=item.get('is_dispensed', False),
-                is_expired_removed=item.get('is_expired_removed', False)
-            )
-            db.session.add(new_food_item)
-            synced_items.append('new')
-    
-    # Update machine storage level
-    active_items = FoodItem.query.filter(
-        FoodItem.machine_id == machine_id,
-        FoodItem.is_dispensed == False,
-        FoodItem.is_expired_removed == False
-    ).count()
-    
-    machine.current_storage_level = active_items
-    db.session.commit()
+    since = data.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid sync cursor'}), 400
     
-    return jsonify({
+    # Apply all submitted items in bulk and adjust the storage level by the net change
+    result = apply_sync(machine.id, items)
+    
+    response = {
         'message': 'Food items synced successfully',
-        'synced_items': len(synced_items),
-        'current_storage_level': machine.current_storage_level
-    }), 200
+        'synced_items': result['synced'],
+        'rejected_items': result['rejected'],
+        'current_storage_level': result['storage_level'],
+        'cursor': result['version']
+    }
+    
+    # Machines that send their last cursor also receive everything changed since then
+    if since is not None:
+        changes, cursor, has_more = changes_since(machine.id, since)
+        response.update({'changes': changes, 'cursor': cursor, 'has_more': has_more})
+    
+    db.session.commit()
+    return jsonify(response), 200
 
 # Expired food removal endpoint
 @machine_compat_bp.route("/maintenance/expired", methods=["POST"])
 @token_required
-def remove_expired(machine_id):
+def remove_expired(machine):
     """Report removal of expired food items."""
     data = request.get_json()
     
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     food_item_ids = data.get('food_item_ids', [])
-    removed_count = 0
-    
-    # Mark items as expired and removed
-    for item_id in food_item_ids:
-        food_item = FoodItem.query.get(item_id)
-        if food_item and food_item.machine_id == machine_id:
-            food_item.is_expired_removed = True
-            removed_count += 1
-    
-    # Update machine storage level
-    active_items = FoodItem.query.filter(
-        FoodItem.machine_id == machine_id,
-        FoodItem.is_dispensed == False,
-        FoodItem.is_expired_removed == False
-    ).count()
-    
-    machine.current_storage_level = active_items
+    # type() rather than isinstance(): JSON true/false arrive as bool, a subclass of int
+    if not isinstance(food_item_ids, list) or not all(type(item_id) is int for item_id in food_item_ids):
+        return jsonify({'error': 'food_item_ids must be a list of integers'}), 400
+    
+    # Mark every listed item still in this machine as removed in one statement
+    removed_ids, units, new_level = remove_items(machine.id, food_item_ids)
     db.session.commit()
     
+    if new_level is None:
+        new_level = machine.current_storage_level
+    
     return jsonify({
         'message': 'Expired items removed successfully',
-        'removed_count': removed_count,
-        'current_storage_level': machine.current_storage_level
+        'removed_count': len(removed_ids),
+        'removed_item_ids': removed_ids,
+        'removed_quantity': units,
+        'unchanged_item_ids': sorted(set(food_item_ids) - set(removed_ids)),
+        'current_storage_level': new_level
     }), 200
 
 # Alert reporting endpoint
 @machine_compat_bp.route("/maintenance/alert", methods=["POST"])
 @token_required
-def report_alert(machine_id):
+def report_alert(machine):
     """Report a machine alert or issue."""
     data = request.get_json()
     
     if not data or 'alert_type' not in data:
         return jsonify({'error': 'Alert type is required'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     # In a real implementation, we would store this alert in a dedicated alerts table
     # For now, we'll just update the machine status if it's a critical alert
     
@@ -390,69 +431,38 @@ def report_alert(machine_id):
 
 # Nearest machines endpoint
 @machine_compat_bp.route("/location/nearest", methods=["GET"])
+@cached_response
 def get_nearest_machines():
-    """Get nearest machines to a location."""
+    """Get nearest machines to a location.
+
+    Query parameters: lat, lon, optional filter ('donor' or 'receiver'), limit (default 20)
+    and radius in kilometres. Distances in the response are great-circle kilometres.
+    """
     try:
         lat = float(request.args.get('lat', 0))
         lon = float(request.args.get('lon', 0))
+        limit = int(request.args.get('limit', DEFAULT_NEAREST_LIMIT))
+        radius = request.args.get('radius')
+        radius = float(radius) if radius is not None else None
     except ValueError:
+        return jsonify({'error': 'Invalid coordinates, limit or radius'}), 400
+    
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
         return jsonify({'error': 'Invalid coordinates'}), 400
+    if not 1 <= limit <= MAX_NEAREST_LIMIT or (radius is not None and radius <= 0):
+        return jsonify({'error': 'Invalid limit or radius'}), 400
     
     filter_type = request.args.get('filter')
     
-    # Get all active machines
-    machines = Machine.query.filter(Machine.status == 'active').all()
-    
-    # Calculate distances and filter
-    machine_data = []
-    for machine in machines:
-        # In a real implementation, we would use a proper distance calculation
-        # For now, we'll use a simple approximation
-        distance = ((machine.location_lat - lat) ** 2 + (machine.location_lon - lon) ** 2) ** 0.5
-        
-        # Count available food items
-        available_food = FoodItem.query.filter(
-            FoodItem.machine_id == machine.id,
-            FoodItem.is_dispensed == False,
-            FoodItem.is_expired_removed == False,
-            FoodItem.expiry_date >= datetime.date.today()
-        ).count()
-        
-        # Calculate available space
-        available_space = machine.storage_capacity_max - machine.current_storage_level
-        
-        # Apply filter
-        if filter_type == 'donor' and available_space <= 0:
-            continue
-        if filter_type == 'receiver' and available_food <= 0:
-            continue
-        
-        machine_data.append({
-            'id': machine.id,
-            'location_lat': machine.location_lat,
-            'location_lon': machine.location_lon,
-            'address_description': machine.address_description,
-            'distance': distance,
-            'available_space': available_space,
-            'available_food': available_food,
-            'operational_hours': machine.operational_hours
-        })
-    
-    # Sort by distance
-    machine_data.sort(key=lambda x: x['distance'])
-    
+    machine_data = get_machine_index().nearest(lat, lon, limit=limit, radius_km=radius, filter_type=filter_type)
     return jsonify(machine_data), 200
 
 # Machine configuration endpoints
-# Fixed: Removed the machine_id parameter from the route since it's already provided by the token_required decorator
+# Fixed: Removed the machine_id parameter from the route since the machine is already provided by the token_required decorator
 @machine_compat_bp.route("/machine/config", methods=["GET"])
 @token_required
-def get_config(machine_id):
+def get_config(machine):
     """Get machine configuration."""
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     # In a real implementation, we would have a dedicated configuration table
     # For now, we'll return some basic configuration
     
@@ -469,17 +479,13 @@ def get_config(machine_id):
 
 @machine_compat_bp.route("/machine/config", methods=["PUT"])
 @token_required
-def update_config(machine_id):
+def update_config(machine):
     """Update machine configuration."""
     data = request.get_json()
     
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({'error': 'Machine not found'}), 404
-    
     # In a real implementation, we would update a dedicated configuration table
     # For now, we'll just update the operational hours
     
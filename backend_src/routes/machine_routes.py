@@ -1,11 +1,28 @@
 # Machine API Routes
 
 from flask import Blueprint, request, jsonify
-from models.models import db, Machine, FoodItem
+from models.models import db, Machine, FoodItem, FoodItemState, state_is
+from services.archive import history_union
+from services.counters import machine_counts
+from services.heartbeats import get_heartbeat_buffer
+from services.pagination import PaginationError, keyset_page, page_args, page_response
+from services.telemetry import RAW, RESOLUTIONS, TelemetryError, parse_timestamp, query_series
+from services.inventory import InventoryError, dispense_units, ingest_donation
 import datetime
 
 machine_bp = Blueprint("machine_bp", __name__, url_prefix="/api/machines")
 
+# Responses for rejected donations, keyed by InventoryError.reason
+DONATION_ERRORS = {
+    "not_found": ("Machine not found", 404),
+    "inactive": ("Machine not active or in maintenance", 403),
+    "full": ("Machine storage is full", 403),
+    "overflow": ("Machine became full during donation process", 507), # Insufficient Storage
+}
+
+# Seconds without a heartbeat after which a machine is reported as not alive
+DEFAULT_STALE_AFTER = 300
+
 @machine_bp.route("/", methods=["POST"])
 def create_machine():
     data = request.get_json()
@@ -25,21 +42,40 @@ def create_machine():
     db.session.commit()
     return jsonify({"message": "Machine created successfully", "machine_id": new_machine.id}), 201
 
+@machine_bp.route("/liveness", methods=["GET"])
+def get_liveness():
+    # Last heartbeat of every machine, including heartbeats not yet written to the database
+    try:
+        stale_after = int(request.args.get("stale_after", DEFAULT_STALE_AFTER))
+    except ValueError:
+        return jsonify({"error": "stale_after must be a number of seconds"}), 400
+
+    machines = db.session.query(Machine.id, Machine.status, Machine.last_heartbeat).order_by(Machine.id).all()
+    last_seen = get_heartbeat_buffer().last_seen({machine.id: machine.last_heartbeat for machine in machines})
+    now = datetime.datetime.utcnow()
+
+    result = []
+    for machine in machines:
+        heartbeat = last_seen[machine.id]
+        age = (now - heartbeat).total_seconds() if heartbeat else None
+        result.append({
+            "id": machine.id,
+            "status": machine.status,
+            "last_heartbeat": heartbeat.isoformat() if heartbeat else None,
+            "seconds_since_heartbeat": round(age, 1) if age is not None else None,
+            "alive": age is not None and age <= stale_after
+        })
+    return jsonify(result), 200
+
 @machine_bp.route("/<int:machine_id>", methods=["GET"])
 def get_machine(machine_id):
     machine = Machine.query.get(machine_id)
     if not machine:
         return jsonify({"error": "Machine not found"}), 404
     
-    food_items_data = [
-        {
-            "id": item.id, 
-            "expiry_date": item.expiry_date.isoformat(), 
-            "donated_at": item.donated_at.isoformat(),
-            "is_dispensed": item.is_dispensed
-        } 
-        for item in machine.food_items if not item.is_dispensed and not item.is_expired_removed and item.expiry_date >= datetime.date.today()
-    ]
+    # Counts come from the machine's inventory counters rather than its food items
+    counts = machine_counts(machine.id)
+    last_heartbeat = get_heartbeat_buffer().last_seen({machine.id: machine.last_heartbeat})[machine.id]
 
     return jsonify({
         "id": machine.id,
@@ -49,9 +85,97 @@ def get_machine(machine_id):
         "status": machine.status,
         "storage_capacity_max": machine.storage_capacity_max,
         "current_storage_level": machine.current_storage_level,
-        "available_food_count": len(food_items_data),
+        "available_food_count": counts["available"],
+        "expired_food_count": counts["expired"],
+        "dispensed_today": counts["dispensed_today"],
         "operational_hours": machine.operational_hours,
-        "last_heartbeat": machine.last_heartbeat.isoformat() if machine.last_heartbeat else None
+        "last_heartbeat": last_heartbeat.isoformat() if last_heartbeat else None
+    }), 200
+
+@machine_bp.route("/<int:machine_id>/food_items", methods=["GET"])
+def get_machine_food_items(machine_id):
+    # Paged item listing, filtered in SQL: ?state=available|expired|all&after=<id>&limit=
+    try:
+        after, limit = page_args()
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+    state = request.args.get("state", "available")
+    if state not in ("available", "expired", "all"):
+        return jsonify({"error": "state must be available, expired or all"}), 400
+
+    if not db.session.get(Machine, machine_id):
+        return jsonify({"error": "Machine not found"}), 404
+
+    today = datetime.date.today()
+    if state == "all":
+        # The full history, archived lots included
+        history = history_union(lambda items: db.select(
+            items.c.id, items.c.quantity, items.c.expiry_date, items.c.donated_at, items.c.state
+        ).where(items.c.machine_id == machine_id)).subquery()
+        items, next_after = keyset_page(db.session.query(history), history.c.id, after, limit)
+    else:
+        query = db.session.query(
+            FoodItem.id,
+            FoodItem.quantity,
+            FoodItem.expiry_date,
+            FoodItem.donated_at,
+            FoodItem.state
+        ).filter(FoodItem.machine_id == machine_id)
+        if state == "available":
+            # Only AVAILABLE lots can be in date (the sweeper moves lots once their date passes),
+            # and state = 0 alone matches the ix_food_items_state_available predicate
+            query = query.filter(state_is(FoodItem.state, FoodItemState.AVAILABLE), FoodItem.expiry_date >= today)
+        else:
+            # Past their date, whether or not the expiry sweeper has reached them yet
+            query = query.filter(state_is(FoodItem.state, *FoodItemState.IN_MACHINE), FoodItem.expiry_date < today)
+        items, next_after = keyset_page(query, FoodItem.id, after, limit)
+
+    return page_response([
+        {
+            "id": item.id,
+            "quantity": item.quantity,
+            "expiry_date": item.expiry_date.isoformat(),
+            "donated_at": item.donated_at.isoformat() if item.donated_at else None,
+            "is_dispensed": item.state == FoodItemState.DISPENSED,
+            "is_expired_removed": item.state == FoodItemState.EXPIRED_REMOVED
+        } for item in items
+    ], next_after)
+
+@machine_bp.route("/<int:machine_id>/telemetry", methods=["GET"])
+def get_machine_telemetry(machine_id):
+    # One metric over a time range, served from rollups unless raw points are asked for
+    metric = request.args.get("metric")
+    if not metric:
+        return jsonify({"error": "metric is required"}), 400
+    try:
+        end = parse_timestamp(request.args.get("end"), datetime.datetime.utcnow())
+        start = parse_timestamp(request.args.get("start"), end - datetime.timedelta(days=1))
+    except TelemetryError as e:
+        return jsonify({"error": str(e)}), 400
+    if start >= end:
+        return jsonify({"error": "start must be before end"}), 400
+
+    resolution = request.args.get("resolution", "auto")
+    if resolution == "auto":
+        resolution = None
+    elif resolution == "raw":
+        resolution = RAW
+    elif resolution.isdigit() and int(resolution) in RESOLUTIONS:
+        resolution = int(resolution)
+    else:
+        return jsonify({"error": f"resolution must be auto, raw or one of {list(RESOLUTIONS)}"}), 400
+
+    if not db.session.get(Machine, machine_id):
+        return jsonify({"error": "Machine not found"}), 404
+
+    resolution, points = query_series(machine_id, metric, start, end, resolution)
+    return jsonify({
+        "machine_id": machine_id,
+        "metric": metric,
+        "resolution": "raw" if resolution == RAW else resolution,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "points": points
     }), 200
 
 @machine_bp.route("/<int:machine_id>/status", methods=["PUT"])
@@ -64,8 +188,8 @@ def update_machine_status(machine_id):
         machine.status = data["status"]
     if "current_storage_level" in data:
         machine.current_storage_level = data["current_storage_level"]
-    machine.last_heartbeat = datetime.datetime.utcnow()
     db.session.commit()
+    get_heartbeat_buffer().record(machine_id)
     return jsonify({"message": "Machine status updated"}), 200
 
 @machine_bp.route("/<int:machine_id>/heartbeat", methods=["POST"])
@@ -73,25 +197,18 @@ def machine_heartbeat(machine_id):
     machine = Machine.query.get(machine_id)
     if not machine:
         return jsonify({"error": "Machine not found"}), 404
-    machine.last_heartbeat = datetime.datetime.utcnow()
+    # The heartbeat is buffered and written in a batch with other machines' heartbeats
+    get_heartbeat_buffer().record(machine_id)
     # Potentially update storage level from machine report
     data = request.get_json()
     if data and "current_storage_level" in data:
         machine.current_storage_level = data["current_storage_level"]
-    db.session.commit()
+        db.session.commit()
     return jsonify({"message": "Heartbeat received"}), 200
 
 # Endpoint for machine to report a donation (internal, called by machine hardware)
 @machine_bp.route("/<int:machine_id>/report_donation", methods=["POST"])
 def report_donation(machine_id):
-    machine = Machine.query.get(machine_id)
-    if not machine:
-        return jsonify({"error": "Machine not found"}), 404
-    if machine.status != "active":
-        return jsonify({"error": "Machine not active or in maintenance"}), 403
-    if machine.current_storage_level >= machine.storage_capacity_max:
-        return jsonify({"error": "Machine storage is full"}), 403
-
     data = request.get_json()
     if not data or "expiry_date" not in data or "quantity" not in data:
         return jsonify({"error": "Missing expiry_date or quantity"}), 400
@@ -101,25 +218,22 @@ def report_donation(machine_id):
         quantity = int(data["quantity"])
     except ValueError:
         return jsonify({"error": "Invalid date format (YYYY-MM-DD) or quantity"}), 400
+    if quantity < 1:
+        return jsonify({"error": "quantity must be a positive integer"}), 400
 
     if expiry_date < datetime.date.today():
         return jsonify({"error": "Cannot donate expired food"}), 400
 
-    for _ in range(quantity):
-        if machine.current_storage_level < machine.storage_capacity_max:
-            new_food_item = FoodItem(
-                machine_id=machine_id,
-                expiry_date=expiry_date,
-                quantity=1 # Assuming 1 item per entry for easier tracking
-            )
-            db.session.add(new_food_item)
-            machine.current_storage_level += 1
-        else:
-            db.session.rollback() # Rollback if partial donation leads to overflow
-            return jsonify({"error": "Machine became full during donation process"}), 507 # Insufficient Storage
+    # The whole donation is stored as one lot; capacity is claimed in a single conditional update
+    try:
+        lot_id, new_storage_level = ingest_donation(machine_id, expiry_date, quantity)
+    except InventoryError as e:
+        db.session.rollback()
+        message, status_code = DONATION_ERRORS[e.reason]
+        return jsonify({"error": message}), status_code
     
     db.session.commit()
-    return jsonify({"message": "Donation reported successfully", "new_storage_level": machine.current_storage_level}), 200
+    return jsonify({"message": "Donation reported successfully", "lot_id": lot_id, "new_storage_level": new_storage_level}), 200
 
 # Endpoint for machine to report food dispensing (internal, called by machine hardware)
 @machine_bp.route("/<int:machine_id>/dispense_food", methods=["POST"])
@@ -130,22 +244,15 @@ def dispense_food(machine_id):
     if machine.status != "active":
         return jsonify({"error": "Machine not active or in maintenance"}), 403
 
-    # Find the soonest-to-expire, non-dispensed, non-expired food item
-    food_to_dispense = FoodItem.query.filter(
-        FoodItem.machine_id == machine_id,
-        FoodItem.is_dispensed == False,
-        FoodItem.is_expired_removed == False,
-        FoodItem.expiry_date >= datetime.date.today()
-    ).order_by(FoodItem.expiry_date.asc()).first()
+    # Dispense one unit from the soonest-to-expire lot
+    try:
+        dispensed_items, _, new_storage_level = dispense_units(machine_id, 1)
+    except InventoryError:
+        db.session.rollback()
+        return jsonify({"error": "Machine is busy, please retry"}), 409
 
-    if not food_to_dispense:
+    if not dispensed_items:
         return jsonify({"error": "No suitable food available for dispensing"}), 404
 
-    food_to_dispense.is_dispensed = True
-    food_to_dispense.dispensed_at = datetime.datetime.utcnow()
-    machine.current_storage_level -= food_to_dispense.quantity # Should be 1 if we stick to 1 item per entry
-    if machine.current_storage_level < 0: machine.current_storage_level = 0 # Safety check
-    
     db.session.commit()
-    return jsonify({"message": "Food dispensed successfully", "item_id": food_to_dispense.id, "new_storage_level": machine.current_storage_level}), 200
-
+    return jsonify({"message": "Food dispensed successfully", "item_id": dispensed_items[0], "new_storage_level": new_storage_level}), 200
@@ -1,12 +1,16 @@
 # Public API Routes (for website locator, etc.)
 
-from flask import Blueprint, request, jsonify
-from models.models import db, Machine, FoodItem
-import datetime
+from flask import Blueprint, Response, current_app, request, jsonify
+from models.models import db, Machine
+from services.availability_stream import StreamError, get_availability_stream, parse_stream_filter
+from services.counters import units_by_machine
+from services.response_cache import cached_response
 
 public_bp = Blueprint("public_bp", __name__, url_prefix="/api/public")
 
+# Both locator responses are cached until a machine changes (see services.response_cache)
 @public_bp.route("/machines_for_donors", methods=["GET"])
+@cached_response
 def get_machines_for_donors():
     # Find machines that are active and have available storage space
     machines = Machine.query.filter(
@@ -30,49 +34,69 @@ def get_machines_for_donors():
     return jsonify(result), 200
 
 @public_bp.route("/machines_for_receivers", methods=["GET"])
+@cached_response
 def get_machines_for_receivers():
     # Find machines that are active and have available, non-expired food
-    today = datetime.date.today()
-    
-    # Subquery to count available food items per machine
-    available_food_subquery = db.session.query(
-        FoodItem.machine_id,
-        db.func.count(FoodItem.id).label("available_items_count")
-    ).filter(
-        FoodItem.is_dispensed == False,
-        FoodItem.is_expired_removed == False,
-        FoodItem.expiry_date >= today
-    ).group_by(FoodItem.machine_id).subquery()
+    # Subquery of available units per machine, read from the inventory counters
+    available_food_subquery = units_by_machine().subquery()
 
-    machines = db.session.query(Machine).join(
+    # Machine columns and their counts come back as plain rows from one aggregated query
+    machines = db.session.query(
+        Machine.id,
+        Machine.location_lat,
+        Machine.location_lon,
+        Machine.address_description,
+        Machine.operational_hours,
+        available_food_subquery.c.units.label("available_items_count")
+    ).join(
         available_food_subquery, Machine.id == available_food_subquery.c.machine_id
-    ).filter(Machine.status == "active").all()
+    ).filter(
+        Machine.status == "active",
+        available_food_subquery.c.units > 0
+    ).all()
 
     if not machines:
         return jsonify({"message": "No machines currently have food available for dispensing."}), 404
 
-    result = []
-    for machine in machines:
-        # Re-fetch the count for this specific machine to be sure (or use the subquery result directly if possible with alias)
-        food_count = FoodItem.query.filter(
-            FoodItem.machine_id == machine.id,
-            FoodItem.is_dispensed == False,
-            FoodItem.is_expired_removed == False,
-            FoodItem.expiry_date >= today
-        ).count()
-
-        if food_count > 0:
-            result.append({
-                "id": machine.id,
-                "location_lat": machine.location_lat,
-                "location_lon": machine.location_lon,
-                "address_description": machine.address_description,
-                "available_food_items": food_count,
-                "operational_hours": machine.operational_hours
-            })
+    result = [
+        {
+            "id": machine.id,
+            "location_lat": machine.location_lat,
+            "location_lon": machine.location_lon,
+            "address_description": machine.address_description,
+            "available_food_items": machine.available_items_count,
+            "operational_hours": machine.operational_hours
+        } for machine in machines
+    ]
+    return jsonify(result), 200
 
-    if not result:
-         return jsonify({"message": "No machines currently have food available for dispensing."}), 404
+# Server-sent events with availability deltas for map clients (see services.availability_stream)
+@public_bp.route("/stream", methods=["GET"])
+def stream_availability():
+    try:
+        stream_filter = parse_stream_filter(request.args)
+    except StreamError as e:
+        return jsonify({"error": str(e)}), 400
 
-    return jsonify(result), 200
+    # EventSource sends Last-Event-ID when it reconnects; the query parameter is for polyfills
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    if last_event_id:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+        if last_event_id < 0:
+            return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+    else:
+        last_event_id = None
 
+    events = get_availability_stream().iter_sse(
+        last_event_id,
+        stream_filter,
+        keepalive=current_app.config.get("STREAM_KEEPALIVE", 15),
+        max_duration=current_app.config.get("STREAM_MAX_DURATION")
+    )
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
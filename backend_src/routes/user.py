@@ -1,12 +1,18 @@
 from flask import Blueprint, jsonify, request
 from src.models.user import User, db
+from services.pagination import PaginationError, keyset_page, page_args, page_response
 
 user_bp = Blueprint('user', __name__)
 
 @user_bp.route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    return jsonify([user.to_dict() for user in users])
+    # One page per request: ?after=<last id seen>&limit=<page size>
+    try:
+        after, limit = page_args()
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    users, next_after = keyset_page(User.query, User.id, after, limit)
+    return page_response([user.to_dict() for user in users], next_after)
 
 @user_bp.route('/users', methods=['POST'])
 def create_user():
@@ -1,7 +1,11 @@
 # Volunteer API Routes
 
 from flask import Blueprint, request, jsonify
-from models.models import db, Machine, FoodItem, User # Assuming Volunteer is a User with role 'volunteer'
+from models.models import db, Machine, FoodItem, FoodItemState, User, state_is # Assuming Volunteer is a User with role 'volunteer'
+from services.counters import units_by_machine
+from services.pagination import PaginationError, keyset_page, page_args, page_response
+from services.inventory import remove_items_for_volunteer
+from services.route_planner import DEFAULT_SERVICE_MINUTES, DEFAULT_SPEED_KMH, RouteError, plan_route
 import datetime
 from werkzeug.security import generate_password_hash, check_password_hash # For potential future login
 
@@ -18,11 +22,12 @@ volunteer_bp = Blueprint("volunteer_bp", __name__, url_prefix="/api/volunteer")
 def get_machines_with_expired_food():
     # In a real app, this would be tied to an authenticated volunteer and potentially their assigned machines
     # For now, showing all machines with any expired food for simplicity
-    today = datetime.date.today()
-    machines_with_issues = db.session.query(Machine.id, Machine.address_description, db.func.count(FoodItem.id).label("expired_item_count")) \
-        .join(FoodItem, Machine.id == FoodItem.machine_id) \
-        .filter(FoodItem.expiry_date < today, FoodItem.is_dispensed == False, FoodItem.is_expired_removed == False) \
-        .group_by(Machine.id, Machine.address_description) \
+    # Units past their expiry date, from the expiry buckets: the same count as GET /api/machines/<id>
+    # reports, whether or not the expiry sweeper has reached them yet
+    expired_units = units_by_machine(expired=True).subquery()
+    machines_with_issues = db.session.query(Machine.id, Machine.address_description, expired_units.c.units.label("expired_item_count")) \
+        .join(expired_units, Machine.id == expired_units.c.machine_id) \
+        .order_by(Machine.id) \
         .all()
 
     if not machines_with_issues:
@@ -37,35 +42,61 @@ def get_machines_with_expired_food():
     ]
     return jsonify(result), 200
 
+@volunteer_bp.route("/route", methods=["GET"])
+def get_collection_route():
+    # Visit order for a collection round: ?lat=&lon=&time_budget=<minutes>&speed_kmh=&service_minutes=
+    # Sites with the most expired units are picked first (see services.route_planner)
+    try:
+        lat = float(request.args["lat"])
+        lon = float(request.args["lon"])
+        time_budget = float(request.args["time_budget"])
+        speed_kmh = float(request.args.get("speed_kmh", DEFAULT_SPEED_KMH))
+        service_minutes = float(request.args.get("service_minutes", DEFAULT_SERVICE_MINUTES))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat, lon and time_budget are required numbers"}), 400
+
+    try:
+        route = plan_route(lat, lon, time_budget, speed_kmh, service_minutes)
+    except RouteError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(route), 200
+
 @volunteer_bp.route("/machine/<int:machine_id>/expired_items", methods=["GET"])
 def get_expired_items_in_machine(machine_id):
     # volunteer_user_id = request.headers.get("X-Volunteer-ID") # Example of getting volunteer ID, NOT SECURE
     # if not volunteer_user_id or not is_volunteer(int(volunteer_user_id)):
     #     return jsonify({"error": "Unauthorized or invalid volunteer ID"}), 401
         
+    # Unpaged unless after or limit is given: clients written before paging expect every item
+    try:
+        after, limit = page_args(default_limit=None)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+
     machine = Machine.query.get(machine_id)
     if not machine:
         return jsonify({"error": "Machine not found"}), 404
 
-    today = datetime.date.today()
-    expired_items = FoodItem.query.filter(
+    # Lots in the machine past their expiry date: those the expiry sweeper has moved to
+    # expired-pending-removal and those it has not reached yet
+    expired_items, next_after = keyset_page(FoodItem.query.filter(
         FoodItem.machine_id == machine_id,
-        FoodItem.expiry_date < today,
-        FoodItem.is_dispensed == False,
-        FoodItem.is_expired_removed == False
-    ).all()
+        state_is(FoodItem.state, *FoodItemState.IN_MACHINE),
+        FoodItem.expiry_date < datetime.date.today()
+    ), FoodItem.id, after, limit)
 
-    if not expired_items:
+    if not expired_items and not after:
         return jsonify({"message": "No expired items to remove in this machine."}), 200
 
     result = [
         {
             "food_item_id": item.id,
+            "quantity": item.quantity,
             "expiry_date": item.expiry_date.isoformat(),
             "donated_at": item.donated_at.isoformat()
         } for item in expired_items
     ]
-    return jsonify(result), 200
+    return page_response(result, next_after)
 
 @volunteer_bp.route("/food_item/<int:food_item_id>/mark_removed", methods=["POST"])
 def mark_food_item_removed(food_item_id):
@@ -81,10 +112,10 @@ def mark_food_item_removed(food_item_id):
     if not food_item:
         return jsonify({"error": "Food item not found"}), 404
     
-    if food_item.is_dispensed:
+    if food_item.state == FoodItemState.DISPENSED:
         return jsonify({"error": "Food item has already been dispensed"}), 400
     
-    if food_item.is_expired_removed:
+    if food_item.state == FoodItemState.EXPIRED_REMOVED:
         return jsonify({"error": "Food item has already been marked as removed"}), 400
     
     # Optional: Check if food is actually expired, or allow removal of non-expired too by volunteers
@@ -97,7 +128,7 @@ def mark_food_item_removed(food_item_id):
         # This should ideally not happen if data integrity is maintained
         return jsonify({"error": "Associated machine not found"}), 500
 
-    food_item.is_expired_removed = True
+    food_item.state = FoodItemState.EXPIRED_REMOVED
     food_item.expired_removed_at = datetime.datetime.utcnow()
     food_item.expired_removed_by_volunteer_id = volunteer.id
     
@@ -108,3 +139,38 @@ def mark_food_item_removed(food_item_id):
         
     db.session.commit()
     return jsonify({"message": f"Food item {food_item_id} marked as removed by volunteer {volunteer.username}", "new_storage_level": machine.current_storage_level}), 200
+
+# Most lots one bulk removal may report
+MAX_BULK_REMOVAL = 500
+
+@volunteer_bp.route("/food_items/mark_removed", methods=["POST"])
+def mark_food_items_removed():
+    # Bulk variant of mark_removed: {"volunteer_id": ..., "food_item_ids": [...]}, one transaction
+    data = request.get_json(silent=True) or {}
+    volunteer_user_id = data.get("volunteer_id")
+    if not volunteer_user_id:
+        return jsonify({"error": "Volunteer ID is required"}), 400
+
+    item_ids = data.get("food_item_ids")
+    # type() rather than isinstance(): JSON true/false arrive as bool, a subclass of int
+    if not isinstance(item_ids, list) or not item_ids or not all(type(item_id) is int for item_id in item_ids):
+        return jsonify({"error": "food_item_ids must be a non-empty list of ids"}), 400
+    if len(item_ids) > MAX_BULK_REMOVAL:
+        return jsonify({"error": f"At most {MAX_BULK_REMOVAL} food items per request"}), 400
+
+    volunteer = User.query.filter_by(id=volunteer_user_id, role="volunteer").first()
+    if not volunteer:
+        return jsonify({"error": "Unauthorized or invalid volunteer ID"}), 401
+
+    volunteer_id = volunteer.id
+    outcomes, storage_levels = remove_items_for_volunteer(item_ids, volunteer_id)
+    db.session.commit()
+
+    return jsonify({
+        "volunteer_id": volunteer_id,
+        "removed_count": sum(1 for status in outcomes.values() if status == "removed"),
+        "results": [{"food_item_id": item_id, "status": status} for item_id, status in outcomes.items()],
+        "machines": [
+            {"machine_id": machine_id, "new_storage_level": level} for machine_id, level in storage_levels.items()
+        ]
+    }), 200
@@ -0,0 +1,219 @@
+"""
+Daily Analytics Rollups
+
+Per-machine, per-UTC-day totals of donated, dispensed and expired-removed units and of
+the time units spent in the machine (MachineDailyStats), so reports read one row per
+machine and day instead of grouping food_items.
+
+The rollups are maintained incrementally: the Core write paths in services.inventory and
+services.sync collect their events in a DailyStats and apply it in the same transaction,
+and FoodItems changed through the ORM are picked up at flush time. Donations count on the
+day of donated_at; dispenses and removals count on the day the lot left the machine, which
+is also the day its time in the machine is attributed to.
+
+Days here are UTC days, since donated_at and dispensed_at are stored in UTC and history
+must not shift with the server's zone. The live counters in services.counters
+(dispensed_today, available/expired) roll over at local midnight instead, like every
+expiry comparison, so for the hours between the two midnights a machine's dispensed_today
+and its MachineDailyStats row for "today" cover different windows.
+
+`flask --app main rebuild-daily-stats` recomputes the rollups from food_items and
+food_items_archive, e.g. once after upgrading a database that predates them.
+"""
+
+import datetime
+from itertools import chain
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.models import db, FoodItem, FoodItemState, MachineDailyStats
+from services.archive import history_union
+from services.counters import _previous_state
+from services.upsert import upsert
+
+stats_table = MachineDailyStats.__table__
+
+STAT_COLUMNS = ("donated_units", "dispensed_units", "expired_removed_units", "dwell_seconds", "dwell_units")
+GROUPINGS = ("machine", "day")
+
+# Longest range the query API returns, in days
+MAX_RANGE_DAYS = 366
+
+# Rows per upsert statement (keeps bound parameters under SQLite's limit)
+_APPLY_CHUNK = 500
+
+
+class AnalyticsError(Exception):
+    """Raised when an analytics query is invalid."""
+
+
+class DailyStats:
+    """Rollup increments collected by one write, applied with a single upsert."""
+
+    def __init__(self):
+        self._rows = {}
+
+    def _row(self, machine_id, at):
+        return self._rows.setdefault((machine_id, at.date()), dict.fromkeys(STAT_COLUMNS, 0))
+
+    def donated(self, machine_id, at, units):
+        """Count units donated to a machine at a UTC time."""
+        self._row(machine_id, at)["donated_units"] += units
+        return self
+
+    def departed(self, machine_id, at, units, donated_at, removed=False):
+        """Count units that left a machine at a UTC time, dispensed or (if removed) thrown away."""
+        row = self._row(machine_id, at)
+        row["expired_removed_units" if removed else "dispensed_units"] += units
+        if donated_at is not None:
+            row["dwell_seconds"] += units * max((at - donated_at).total_seconds(), 0.0)
+            row["dwell_units"] += units
+        return self
+
+    def __bool__(self):
+        return bool(self._rows)
+
+    def apply(self, session=None):
+        """Add the collected increments to the rollup table."""
+        session = session or db.session
+        rows = [
+            dict(values, machine_id=machine_id, day=day)
+            for (machine_id, day), values in sorted(self._rows.items())
+        ]
+        for start in range(0, len(rows), _APPLY_CHUNK):
+            upsert(
+                session, stats_table, rows[start:start + _APPLY_CHUNK],
+                lambda incoming: [(stats_table.c[name], stats_table.c[name] + incoming[name]) for name in STAT_COLUMNS]
+            )
+        self._rows = {}
+
+
+def _mean(dwell_seconds, dwell_units):
+    return round(dwell_seconds / dwell_units, 1) if dwell_units else None
+
+
+def query_daily_stats(start, end, machine_ids=None, group_by="machine"):
+    """Read the rollups for an inclusive range of UTC days.
+
+    Args:
+        start: First day
+        end: Last day
+        machine_ids: Only these machines
+        group_by: "machine" for one row per machine and day, "day" for fleet totals per day
+
+    Returns:
+        List of dictionaries ordered by day (and machine)
+
+    Raises:
+        AnalyticsError: If the range or grouping is invalid
+    """
+    if group_by not in GROUPINGS:
+        raise AnalyticsError(f"group_by must be one of {', '.join(GROUPINGS)}")
+    if end < start:
+        raise AnalyticsError("end must not be before start")
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise AnalyticsError(f"A range covers at most {MAX_RANGE_DAYS} days")
+
+    c = stats_table.c
+    window = [c.day >= start, c.day <= end]
+    if machine_ids:
+        window.append(c.machine_id.in_(machine_ids))
+
+    if group_by == "machine":
+        rows = db.session.execute(
+            db.select(c.machine_id, c.day, *(c[name] for name in STAT_COLUMNS))
+            .where(*window).order_by(c.day, c.machine_id)
+        ).all()
+    else:
+        rows = db.session.execute(
+            db.select(c.day, *(db.func.sum(c[name]).label(name) for name in STAT_COLUMNS))
+            .where(*window).group_by(c.day).order_by(c.day)
+        ).all()
+
+    result = []
+    for row in rows:
+        entry = {"machine_id": row.machine_id} if group_by == "machine" else {}
+        entry.update({
+            "day": row.day.isoformat(),
+            "donated_units": row.donated_units,
+            "dispensed_units": row.dispensed_units,
+            "expired_removed_units": row.expired_removed_units,
+            "mean_time_in_machine_seconds": _mean(row.dwell_seconds, row.dwell_units),
+        })
+        result.append(entry)
+    return result
+
+
+def rebuild_daily_stats(machine_ids=None, chunk_size=1000):
+    """Recompute the rollups from food_items and the archive (the caller commits).
+
+    Returns:
+        Number of rollup rows written
+    """
+    delete = stats_table.delete()
+    if machine_ids:
+        delete = delete.where(stats_table.c.machine_id.in_(machine_ids))
+    db.session.execute(delete)
+
+    def select_from(items):
+        query = db.select(
+            items.c.machine_id, items.c.quantity, items.c.donated_at,
+            items.c.state, items.c.dispensed_at, items.c.expired_removed_at
+        )
+        if machine_ids:
+            query = query.where(items.c.machine_id.in_(machine_ids))
+        return query
+
+    query = history_union(select_from)
+
+    stats = DailyStats()
+    result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+    for row in result:
+        if row.donated_at is not None:
+            stats.donated(row.machine_id, row.donated_at, row.quantity)
+        if row.state == FoodItemState.DISPENSED and row.dispensed_at is not None:
+            stats.departed(row.machine_id, row.dispensed_at, row.quantity, row.donated_at)
+        elif row.state == FoodItemState.EXPIRED_REMOVED and row.expired_removed_at is not None:
+            stats.departed(row.machine_id, row.expired_removed_at, row.quantity, row.donated_at, removed=True)
+    written = len(stats._rows)
+    stats.apply()
+    return written
+
+
+@click.command("rebuild-daily-stats")
+@click.option("--machine", "machine_ids", type=int, multiple=True, help="Only rebuild this machine (repeatable).")
+@with_appcontext
+def rebuild_daily_stats_command(machine_ids):
+    """Recompute the daily analytics rollups from food_items and food_items_archive."""
+    written = rebuild_daily_stats(list(machine_ids) or None)
+    db.session.commit()
+    click.echo(f"Wrote {written} daily rollup row(s).")
+
+
+@event.listens_for(Session, "before_flush")
+def _roll_up_orm_changes(session, flush_context, instances):
+    """Count FoodItem donations, dispenses and removals made through the ORM."""
+    stats = DailyStats()
+    now = datetime.datetime.utcnow()
+    for item in chain(session.new, session.dirty):
+        if not isinstance(item, FoodItem) or item.machine_id is None:
+            continue
+        if item in session.new:
+            previous_state = FoodItemState.AVAILABLE
+            stats.donated(item.machine_id, item.donated_at or now, item.quantity or 1)
+        elif session.is_modified(item):
+            previous = _previous_state(session, item)
+            previous_state = previous["state"]
+        else:
+            continue
+        if previous_state in (FoodItemState.DISPENSED, FoodItemState.EXPIRED_REMOVED):
+            continue
+        if item.state == FoodItemState.DISPENSED:
+            stats.departed(item.machine_id, item.dispensed_at or now, item.quantity or 1, item.donated_at)
+        elif item.state == FoodItemState.EXPIRED_REMOVED:
+            stats.departed(item.machine_id, item.expired_removed_at or now, item.quantity or 1, item.donated_at, removed=True)
+    if stats:
+        stats.apply(session)
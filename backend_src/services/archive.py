@@ -0,0 +1,156 @@
+"""
+Food Item Archiving
+
+Keeps food_items about the size of the current inventory by moving finished lots
+(dispensed or removed) into food_items_archive once they have been finished for longer
+than ARCHIVE_AFTER_DAYS (default 30).
+
+Lots are moved in batches of batch_size, walking food_items in id order, each batch one
+short transaction that copies the rows with INSERT ... SELECT and deletes them from
+food_items. Counters and daily rollups are unaffected: they only count lots in a
+machine, or were updated when the lot left it. Run it daily from cron with
+`flask --app main archive-food-items`.
+
+food_items ids must never be handed out again once archived. New SQLite databases
+create food_items with AUTOINCREMENT; on one created before that, which reuses
+max(id) + 1, the row with the highest id is always left in food_items.
+
+Readers of the full history (the export and the rollup rebuild, the "all" machine
+listing) select from both tables through history_union; sync rejects ids that have been
+archived instead of creating them anew.
+"""
+
+import datetime
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models.models import db, FoodItem, FoodItemArchive, FoodItemState, state_is
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 30
+DEFAULT_BATCH_SIZE = 500
+
+food_items_table = FoodItem.__table__
+archive_table = FoodItemArchive.__table__
+
+# Columns copied from food_items; archived_at is set on the way
+ARCHIVED_COLUMNS = tuple(column.name for column in archive_table.columns if column.name != "archived_at")
+
+
+def history_union(build):
+    """Combine the same select over food_items and food_items_archive.
+
+    Args:
+        build: Callable taking a table and returning a select with identical columns
+
+    Returns:
+        UNION ALL of both selects (ids never appear in both tables)
+    """
+    return db.union_all(build(food_items_table), build(archive_table))
+
+
+def archived_ids(item_ids):
+    """Return the subset of item_ids that have been archived."""
+    if not item_ids:
+        return set()
+    return set(db.session.execute(
+        db.select(archive_table.c.id).where(archive_table.c.id.in_(item_ids))
+    ).scalars())
+
+
+def _reuses_ids():
+    """Whether food_items may hand out an id again once the highest one is deleted."""
+    if db.engine.dialect.name != "sqlite":
+        return False
+    sql = db.session.execute(
+        db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": food_items_table.name}
+    ).scalar()
+    return "AUTOINCREMENT" not in (sql or "").upper()
+
+
+def _finished_before(columns, cutoff):
+    finished_at = db.func.coalesce(columns.dispensed_at, columns.expired_removed_at, columns.donated_at)
+    return state_is(columns.state, FoodItemState.DISPENSED, FoodItemState.EXPIRED_REMOVED) & (finished_at < cutoff)
+
+
+def archive_batch(cutoff, after=0, batch_size=DEFAULT_BATCH_SIZE, now=None, keep_last=False):
+    """Move up to batch_size lots finished before cutoff, with an id above after.
+
+    With keep_last the row with the highest id in food_items is never moved. The caller
+    commits.
+
+    Returns:
+        Tuple of (lots_moved, last_id); last_id is None once nothing is left
+    """
+    now = now or datetime.datetime.utcnow()
+    columns = food_items_table.c
+    candidates = [columns.id > after, _finished_before(columns, cutoff)]
+    if keep_last:
+        candidates.append(columns.id < db.select(db.func.max(columns.id)).scalar_subquery())
+    ids = db.session.execute(
+        db.select(columns.id)
+        .where(*candidates)
+        .order_by(columns.id)
+        .limit(batch_size)
+        .with_for_update()
+    ).scalars().all()
+    if not ids:
+        return 0, None
+
+    db.session.execute(archive_table.insert().from_select(
+        ARCHIVED_COLUMNS + ("archived_at",),
+        db.select(*(columns[name] for name in ARCHIVED_COLUMNS), db.literal(now, db.DateTime))
+        .where(columns.id.in_(ids))
+    ))
+    db.session.execute(food_items_table.delete().where(columns.id.in_(ids)))
+    return len(ids), ids[-1]
+
+
+def archive_finished_items(older_than=None, batch_size=None, pause=0.0):
+    """Archive every lot finished longer ago than older_than, committing after each batch.
+
+    Args:
+        older_than: Age of the lots to archive (defaults to ARCHIVE_AFTER_DAYS days)
+        batch_size: Lots moved per transaction (defaults to ARCHIVE_BATCH_SIZE)
+        pause: Seconds to sleep between batches
+
+    Returns:
+        Dictionary with the number of lots and batches archived
+    """
+    config = current_app.config
+    if older_than is None:
+        older_than = datetime.timedelta(days=config.get("ARCHIVE_AFTER_DAYS", DEFAULT_ARCHIVE_AFTER_DAYS))
+    batch_size = batch_size or config.get("ARCHIVE_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    now = datetime.datetime.utcnow()
+    cutoff = now - older_than
+    keep_last = _reuses_ids()
+
+    lots = batches = 0
+    after = 0
+    while True:
+        moved, after = archive_batch(cutoff, after, batch_size, now, keep_last)
+        if after is None:
+            break
+        db.session.commit()
+        lots += moved
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    return {"lots": lots, "batches": batches}
+
+
+@click.command("archive-food-items")
+@click.option("--older-than-days", type=click.IntRange(0), default=None,
+              help="Archive lots finished longer ago than this (default ARCHIVE_AFTER_DAYS).")
+@click.option("--batch-size", type=click.IntRange(1), default=None, help="Lots moved per transaction.")
+@click.option("--pause", type=click.FloatRange(0), default=0.0, show_default=True,
+              help="Seconds to sleep between batches.")
+@with_appcontext
+def archive_food_items_command(older_than_days, batch_size, pause):
+    """Move dispensed and removed lots into food_items_archive."""
+    older_than = datetime.timedelta(days=older_than_days) if older_than_days is not None else None
+    result = archive_finished_items(older_than, batch_size, pause)
+    click.echo(f"Archived {result['lots']} lot(s) in {result['batches']} batch(es).")
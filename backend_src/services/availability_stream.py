@@ -0,0 +1,282 @@
+"""
+Availability Stream
+
+Pushes machine availability changes to map clients as server-sent events (the
+/api/public/stream endpoint), so they stay current without re-polling the locator
+endpoints.
+
+When a transaction that changed machines commits (see services.machine_events), their
+available items, available space and status are read once and compared with the last
+published values. Each machine whose values changed becomes one compact event, appended
+to an in-memory ring buffer with an increasing id. Connected clients filter the buffer in
+memory by topic and bounding box, so the number of clients does not add database work.
+
+Event topics:
+
+    availability  available_items or available_space changed
+    status        status changed
+    removed       the machine was deleted
+
+A reconnecting client sends the id of the last event it saw (Last-Event-ID) and receives
+everything after it. If those events have already left the buffer (or the id comes from
+before a restart) it receives a reset event instead and should reload the locator
+endpoints. The buffer is per process: commits made by other worker processes are not seen.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy.exc import SQLAlchemyError
+
+from models.models import db, Machine
+from services.counters import buckets_table, units_by_machine
+from services.machine_events import subscribe, subscribe_deleted
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = "availability_stream"
+TOPICS = ("availability", "status", "removed")
+
+# Reconnection delay suggested to EventSource clients, in milliseconds
+RETRY_MS = 3000
+
+
+class StreamError(Exception):
+    """Raised when stream filter parameters are invalid."""
+
+
+class _Event:
+    __slots__ = ("id", "topics", "lat", "lon", "encoded")
+
+    def __init__(self, event_id, topics, lat, lon, payload):
+        self.id = event_id
+        self.topics = topics
+        self.lat = lat
+        self.lon = lon
+        self.encoded = (
+            f"id: {event_id}\nevent: {topics[0]}\n"
+            f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+        )
+
+
+class StreamFilter:
+    """Topic and bounding-box filter of one client."""
+
+    def __init__(self, topics=None, bbox=None):
+        """Initialize a filter.
+
+        Args:
+            topics: Topics to deliver (None for all)
+            bbox: (min_lon, min_lat, max_lon, max_lat) to deliver, or None for everywhere
+        """
+        self.topics = frozenset(topics) if topics else None
+        self.bbox = bbox
+
+    def matches(self, event):
+        if self.topics is not None and self.topics.isdisjoint(event.topics):
+            return False
+        if self.bbox is None or event.lat is None:
+            return True
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return min_lon <= event.lon <= max_lon and min_lat <= event.lat <= max_lat
+
+
+def parse_stream_filter(args):
+    """Build a StreamFilter from topic (repeatable or comma separated) and bbox parameters.
+
+    Raises:
+        StreamError: If a topic is unknown or the bounding box is malformed
+    """
+    topics = [topic for value in args.getlist("topic") for topic in value.split(",") if topic]
+    unknown = set(topics) - set(TOPICS)
+    if unknown:
+        raise StreamError(f"Unknown topic {sorted(unknown)[0]!r}; expected one of {', '.join(TOPICS)}")
+
+    bbox = None
+    if args.get("bbox"):
+        try:
+            bbox = tuple(float(value) for value in args["bbox"].split(","))
+        except ValueError:
+            bbox = ()
+        if (
+            len(bbox) != 4 or not bbox[0] <= bbox[2] or not bbox[1] <= bbox[3]
+            or not -180 <= bbox[0] <= bbox[2] <= 180 or not -90 <= bbox[1] <= bbox[3] <= 90
+        ):
+            raise StreamError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    return StreamFilter(topics, bbox)
+
+
+class AvailabilityStream:
+    """Ring buffer of availability events with blocking reads for streaming clients."""
+
+    def __init__(self, history=1000):
+        """Initialize an empty stream.
+
+        Args:
+            history: Number of recent events kept for resuming clients
+        """
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        # machine id -> (lat, lon, available_items, available_space, status) last published
+        self._state = {}
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def _append(self, topics, lat, lon, payload):
+        self._last_id += 1
+        self._events.append(_Event(self._last_id, topics, lat, lon, payload))
+
+    def publish(self, rows):
+        """Publish the current values of changed machines.
+
+        Args:
+            rows: Iterable of (machine_id, lat, lon, available_items, available_space, status)
+
+        Returns:
+            Number of events appended (machines whose values did not change are skipped)
+        """
+        appended = 0
+        with self._condition:
+            for machine_id, lat, lon, available_items, available_space, status in rows:
+                previous = self._state.get(machine_id)
+                topics = []
+                if previous is None or previous[4] != status:
+                    topics.append("status")
+                if previous is None or previous[2:4] != (available_items, available_space):
+                    topics.append("availability")
+                if not topics:
+                    continue
+                self._state[machine_id] = (lat, lon, available_items, available_space, status)
+                self._append(tuple(topics), lat, lon, {
+                    "machine_id": machine_id,
+                    "available_items": available_items,
+                    "available_space": available_space,
+                    "status": status
+                })
+                appended += 1
+            if appended:
+                self._condition.notify_all()
+        return appended
+
+    def publish_removed(self, machine_ids):
+        """Publish removal events for deleted machines."""
+        with self._condition:
+            for machine_id in sorted(machine_ids):
+                lat, lon = self._state.pop(machine_id, (None, None))[:2]
+                self._append(("removed",), lat, lon, {"machine_id": machine_id, "status": "removed"})
+            self._condition.notify_all()
+
+    def events_after(self, last_id):
+        """Return (events, reset) for a client that has seen events up to last_id.
+
+        reset is True when events after last_id are no longer buffered (or last_id is
+        from another process lifetime) and the client has to reload its snapshot.
+        """
+        with self._condition:
+            if last_id > self._last_id:
+                return [], True
+            if last_id == self._last_id:
+                return [], False
+            if not self._events or self._events[0].id > last_id + 1:
+                return [], True
+            return [event for event in self._events if event.id > last_id], False
+
+    def wait(self, last_id, timeout):
+        """Block until an event newer than last_id exists; returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._last_id != last_id, timeout)
+
+    def iter_sse(self, last_id, stream_filter, keepalive=15.0, max_duration=None):
+        """Yield text/event-stream chunks for one client.
+
+        Args:
+            last_id: Last event id the client saw, or None to start with new events
+            stream_filter: StreamFilter of the client
+            keepalive: Seconds of silence after which a comment line is sent
+            max_duration: Seconds after which the stream ends (the client reconnects with
+                          Last-Event-ID), or None to stream until the client disconnects
+        """
+        started = time.monotonic()
+        if last_id is None:
+            last_id = self._last_id
+        yield f"retry: {RETRY_MS}\nid: {last_id}\n\n"
+        while True:
+            events, reset = self.events_after(last_id)
+            if reset:
+                last_id = self._last_id
+                yield f"id: {last_id}\nevent: reset\ndata: {{}}\n\n"
+                continue
+            if events:
+                last_id = events[-1].id
+                chunk = "".join(event.encoded for event in events if stream_filter.matches(event))
+                if chunk:
+                    yield chunk
+                continue
+            remaining = None
+            if max_duration is not None:
+                remaining = max_duration - (time.monotonic() - started)
+                if remaining <= 0:
+                    return
+            timeout = keepalive if remaining is None else min(keepalive, remaining)
+            if not self.wait(last_id, timeout) and (remaining is None or remaining > keepalive):
+                yield ": keepalive\n\n"
+
+
+def get_availability_stream():
+    """Return the availability stream for the current application, creating it on first use."""
+    stream = current_app.extensions.get(EXTENSION_KEY)
+    if stream is None:
+        stream = current_app.extensions.setdefault(
+            EXTENSION_KEY, AvailabilityStream(history=current_app.config.get("STREAM_HISTORY", 1000))
+        )
+    return stream
+
+
+def machine_availability(machine_ids):
+    """Select (machine_id, lat, lon, available_items, available_space, status) for machines."""
+    available = units_by_machine().where(buckets_table.c.machine_id.in_(machine_ids)).subquery()
+    return (
+        db.select(
+            Machine.id,
+            Machine.location_lat,
+            Machine.location_lon,
+            db.func.coalesce(available.c.units, 0),
+            Machine.storage_capacity_max - Machine.current_storage_level,
+            Machine.status
+        )
+        .outerjoin(available, available.c.machine_id == Machine.id)
+        .where(Machine.id.in_(machine_ids))
+        .order_by(Machine.id)
+    )
+
+
+@subscribe
+def _publish_changes(machine_ids):
+    if not has_app_context():
+        return
+    stream = current_app.extensions.get(EXTENSION_KEY)
+    if stream is None:
+        return
+    # The committing session cannot run more SQL here; read through a fresh connection
+    try:
+        with db.engine.connect() as connection:
+            rows = connection.execute(machine_availability(sorted(machine_ids))).all()
+    except SQLAlchemyError:
+        logger.exception("Could not read availability of machines %s", sorted(machine_ids))
+        return
+    stream.publish(rows)
+
+
+@subscribe_deleted
+def _publish_removals(machine_ids):
+    if has_app_context():
+        stream = current_app.extensions.get(EXTENSION_KEY)
+        if stream is not None:
+            stream.publish_removed(machine_ids)
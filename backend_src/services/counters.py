@@ -0,0 +1,382 @@
+"""
+Machine Inventory Counters
+
+Per-machine totals kept in step with food items, so read endpoints do not have to
+aggregate the food_items table.
+
+Units still in a machine are counted per expiry date (MachineExpiryBucket). Available and
+expired units are the buckets on either side of today, so they stay correct across midnight
+without any write. Units dispensed during the current day, and units the expiry sweeper
+has moved into the expired-pending-removal state, are kept on MachineCounter.
+
+Every write path applies its changes to the counters in the same transaction as the items
+themselves: the Core paths in services.inventory and services.sync call apply_counter_deltas,
+and FoodItems changed through the ORM are picked up at flush time. verify_counters
+recomputes everything from food_items to detect (and optionally repair) drift; run it with
+`flask --app main verify-counters [--repair]`, including once after upgrading a database
+that predates the counters.
+
+"Today" is the server's local date throughout, as for the expiry sweeper, so a lot
+expiring today and the units dispensed today roll over at the same midnight.
+"""
+
+import datetime
+from collections import Counter
+from itertools import chain
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models.models import db, Machine, FoodItem, FoodItemState, MachineCounter, MachineExpiryBucket, state_is
+from services.upsert import upsert
+
+counters_table = MachineCounter.__table__
+buckets_table = MachineExpiryBucket.__table__
+
+def apply_counter_deltas(machine_id, expiry_deltas, dispensed=0, session=None, expired_pending=0):
+    """Apply a change in a machine's inventory to its counters.
+
+    Args:
+        machine_id: Machine whose items changed
+        expiry_deltas: Mapping of expiry date -> change in units still in the machine
+        dispensed: Units dispensed by the change
+        session: Session to write with (defaults to db.session)
+        expired_pending: Change in units in the expired-pending-removal state
+    """
+    session = session or db.session
+    expiry_deltas = {day: delta for day, delta in expiry_deltas.items() if delta}
+
+    if expiry_deltas:
+        upsert(
+            session, buckets_table,
+            [
+                {"machine_id": machine_id, "expiry_date": day, "units": delta}
+                for day, delta in sorted(expiry_deltas.items())
+            ],
+            lambda incoming: [(buckets_table.c.units, buckets_table.c.units + incoming["units"])]
+        )
+        emptied = [day for day, delta in expiry_deltas.items() if delta < 0]
+        if emptied:
+            session.execute(buckets_table.delete().where(
+                buckets_table.c.machine_id == machine_id,
+                buckets_table.c.expiry_date.in_(emptied),
+                buckets_table.c.units <= 0,
+            ))
+
+    if dispensed or expired_pending:
+        row = {"machine_id": machine_id, "expired_pending": expired_pending}
+        set_values = []
+        if expired_pending:
+            set_values.append((counters_table.c.expired_pending, counters_table.c.expired_pending + expired_pending))
+        if dispensed:
+            today = datetime.date.today()
+            row.update(dispensed_on=today, dispensed_today=dispensed)
+            # dispensed_today is assigned first: MySQL evaluates assignments in order
+            set_values += [
+                (counters_table.c.dispensed_today, db.case(
+                    (counters_table.c.dispensed_on == today, counters_table.c.dispensed_today + dispensed),
+                    else_=dispensed
+                )),
+                (counters_table.c.dispensed_on, today),
+            ]
+        upsert(session, counters_table, [row], lambda incoming: set_values)
+
+
+def apply_fleet_counter_deltas(expiry_deltas, expired_pending=None, session=None):
+    """Apply changes in the inventory of several machines to their counters.
+
+    The counterpart of apply_counter_deltas for writes spanning machines: every table is
+    written with one statement, whatever the number of machines.
+
+    Args:
+        expiry_deltas: Mapping of (machine_id, expiry date) -> change in units still in the machine
+        expired_pending: Mapping of machine_id -> change in units in the expired-pending-removal state
+        session: Session to write with (defaults to db.session)
+    """
+    session = session or db.session
+    expiry_deltas = {key: delta for key, delta in expiry_deltas.items() if delta}
+    expired_pending = {machine_id: delta for machine_id, delta in (expired_pending or {}).items() if delta}
+
+    if expiry_deltas:
+        upsert(
+            session, buckets_table,
+            [
+                {"machine_id": machine_id, "expiry_date": day, "units": delta}
+                for (machine_id, day), delta in sorted(expiry_deltas.items())
+            ],
+            lambda incoming: [(buckets_table.c.units, buckets_table.c.units + incoming["units"])]
+        )
+        emptied = [key for key, delta in expiry_deltas.items() if delta < 0]
+        if emptied:
+            session.execute(buckets_table.delete().where(
+                db.tuple_(buckets_table.c.machine_id, buckets_table.c.expiry_date).in_(emptied),
+                buckets_table.c.units <= 0,
+            ))
+
+    if expired_pending:
+        upsert(
+            session, counters_table,
+            [{"machine_id": machine_id, "expired_pending": delta} for machine_id, delta in sorted(expired_pending.items())],
+            lambda incoming: [(counters_table.c.expired_pending, counters_table.c.expired_pending + incoming["expired_pending"])]
+        )
+
+
+def machine_counts(machine_id, today=None):
+    """Read a machine's counters.
+
+    Args:
+        machine_id: Machine to read
+        today: Day separating available from expired units (defaults to today)
+
+    Returns:
+        Dictionary with available, expired, expired_pending, dispensed_today and the expiry
+        buckets (expired counts every unit past its date, expired_pending only those the
+        expiry sweeper has already moved)
+    """
+    today = today or datetime.date.today()
+    buckets = db.session.execute(
+        db.select(buckets_table.c.expiry_date, buckets_table.c.units)
+        .where(buckets_table.c.machine_id == machine_id)
+        .order_by(buckets_table.c.expiry_date)
+    ).all()
+    counter = db.session.execute(
+        db.select(counters_table.c.dispensed_on, counters_table.c.dispensed_today, counters_table.c.expired_pending)
+        .where(counters_table.c.machine_id == machine_id)
+    ).first()
+
+    dispensed_today = 0
+    if counter and counter.dispensed_on == today:
+        dispensed_today = counter.dispensed_today
+    return {
+        "available": sum(bucket.units for bucket in buckets if bucket.expiry_date >= today),
+        "expired": sum(bucket.units for bucket in buckets if bucket.expiry_date < today),
+        "expired_pending": counter.expired_pending if counter else 0,
+        "dispensed_today": dispensed_today,
+        "buckets": [
+            {"expiry_date": bucket.expiry_date.isoformat(), "units": bucket.units} for bucket in buckets
+        ]
+    }
+
+
+def units_by_machine(expired=False, today=None):
+    """Select (machine_id, units) for every machine with available (or expired) units.
+
+    The statement is grouped by machine and reads only the bucket table; callers usually
+    join it as a subquery.
+    """
+    today = today or datetime.date.today()
+    if expired:
+        window = buckets_table.c.expiry_date < today
+    else:
+        window = buckets_table.c.expiry_date >= today
+    return (
+        db.select(buckets_table.c.machine_id, db.func.sum(buckets_table.c.units).label("units"))
+        .where(window, buckets_table.c.units > 0)
+        .group_by(buckets_table.c.machine_id)
+    )
+
+
+def verify_counters(repair=False, machine_ids=None):
+    """Compare the counters with food_items and report (optionally fix) any drift.
+
+    Machine.current_storage_level is checked too, since it must equal the units held.
+
+    Args:
+        repair: Rewrite drifted counters from food_items (the caller commits)
+        machine_ids: Restrict the check to these machines
+
+    Returns:
+        List of drift dictionaries with machine_id, counter, expected and actual
+    """
+    items = FoodItem.__table__
+    today = datetime.date.today()
+    # dispensed_at is naive UTC; the day starts at local midnight
+    day_start = (
+        datetime.datetime.combine(today, datetime.time.min).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    )
+
+    def scoped(stmt, column):
+        return stmt.where(column.in_(machine_ids)) if machine_ids is not None else stmt
+
+    expected_buckets = {}
+    for row in db.session.execute(scoped(
+        db.select(items.c.machine_id, items.c.expiry_date, db.func.sum(items.c.quantity).label("units"))
+        .where(state_is(items.c.state, *FoodItemState.IN_MACHINE))
+        .group_by(items.c.machine_id, items.c.expiry_date),
+        items.c.machine_id
+    )):
+        expected_buckets.setdefault(row.machine_id, {})[row.expiry_date] = row.units
+
+    expected_dispensed = dict(db.session.execute(scoped(
+        db.select(items.c.machine_id, db.func.sum(items.c.quantity))
+        .where(state_is(items.c.state, FoodItemState.DISPENSED), items.c.dispensed_at >= day_start)
+        .group_by(items.c.machine_id),
+        items.c.machine_id
+    )).all())
+
+    expected_pending = dict(db.session.execute(scoped(
+        db.select(items.c.machine_id, db.func.sum(items.c.quantity))
+        .where(state_is(items.c.state, FoodItemState.EXPIRED))
+        .group_by(items.c.machine_id),
+        items.c.machine_id
+    )).all())
+
+    actual_buckets = {}
+    for row in db.session.execute(scoped(db.select(buckets_table), buckets_table.c.machine_id)):
+        actual_buckets.setdefault(row.machine_id, {})[row.expiry_date] = row.units
+
+    actual_dispensed = {}
+    actual_pending = {}
+    for row in db.session.execute(scoped(db.select(counters_table), counters_table.c.machine_id)):
+        actual_dispensed[row.machine_id] = row.dispensed_today if row.dispensed_on == today else 0
+        actual_pending[row.machine_id] = row.expired_pending
+
+    storage_levels = dict(db.session.execute(scoped(
+        db.select(Machine.id, Machine.current_storage_level), Machine.id
+    )).all())
+
+    drift = []
+    for machine_id, level in sorted(storage_levels.items()):
+        buckets = expected_buckets.get(machine_id, {})
+        stored = actual_buckets.get(machine_id, {})
+        for day in sorted(set(buckets) | set(stored)):
+            if buckets.get(day, 0) != stored.get(day, 0):
+                drift.append({
+                    "machine_id": machine_id,
+                    "counter": f"units expiring {day.isoformat()}",
+                    "expected": buckets.get(day, 0),
+                    "actual": stored.get(day, 0)
+                })
+        if expected_dispensed.get(machine_id, 0) != actual_dispensed.get(machine_id, 0):
+            drift.append({
+                "machine_id": machine_id,
+                "counter": "dispensed_today",
+                "expected": expected_dispensed.get(machine_id, 0),
+                "actual": actual_dispensed.get(machine_id, 0)
+            })
+        if expected_pending.get(machine_id, 0) != actual_pending.get(machine_id, 0):
+            drift.append({
+                "machine_id": machine_id,
+                "counter": "expired_pending",
+                "expected": expected_pending.get(machine_id, 0),
+                "actual": actual_pending.get(machine_id, 0)
+            })
+        held = sum(buckets.values())
+        if level != held:
+            drift.append({
+                "machine_id": machine_id,
+                "counter": "current_storage_level",
+                "expected": held,
+                "actual": level
+            })
+
+    if repair:
+        for machine_id in sorted({entry["machine_id"] for entry in drift}):
+            buckets = expected_buckets.get(machine_id, {})
+            db.session.execute(buckets_table.delete().where(buckets_table.c.machine_id == machine_id))
+            if buckets:
+                db.session.execute(buckets_table.insert(), [
+                    {"machine_id": machine_id, "expiry_date": day, "units": units}
+                    for day, units in buckets.items()
+                ])
+            db.session.execute(counters_table.delete().where(counters_table.c.machine_id == machine_id))
+            db.session.execute(counters_table.insert().values(
+                machine_id=machine_id,
+                dispensed_on=today,
+                dispensed_today=expected_dispensed.get(machine_id, 0),
+                expired_pending=expected_pending.get(machine_id, 0)
+            ))
+            db.session.execute(
+                Machine.__table__.update()
+                .where(Machine.__table__.c.id == machine_id)
+                .values(current_storage_level=sum(buckets.values()))
+            )
+    return drift
+
+
+@click.command("verify-counters")
+@click.option("--repair", is_flag=True, help="Rewrite drifted counters from food_items.")
+@click.option("--machine", "machine_ids", type=int, multiple=True, help="Only check this machine (repeatable).")
+@with_appcontext
+def verify_counters_command(repair, machine_ids):
+    """Check the per-machine inventory counters against food_items."""
+    drift = verify_counters(repair=repair, machine_ids=list(machine_ids) or None)
+    for entry in drift:
+        click.echo(f"machine {entry['machine_id']}: {entry['counter']} is {entry['actual']}, expected {entry['expected']}")
+    if repair:
+        db.session.commit()
+        click.echo(f"Repaired {len({entry['machine_id'] for entry in drift})} machine(s).")
+    elif drift:
+        raise SystemExit(1)
+    else:
+        click.echo("Counters match food_items.")
+
+
+_COUNTED_ATTRIBUTES = ("quantity", "expiry_date", "state")
+
+
+def _previous_state(session, item):
+    """Counted attributes of a FoodItem as they were before the pending change."""
+    instance_state = inspect(item)
+    previous = {}
+    for key in _COUNTED_ATTRIBUTES:
+        history = instance_state.attrs[key].history
+        if history.deleted:
+            previous[key] = history.deleted[0]
+        elif history.added:
+            # Assigned while unloaded (e.g. after a commit): the old value is only in the row
+            row = session.execute(
+                db.select(*(FoodItem.__table__.c[name] for name in _COUNTED_ATTRIBUTES))
+                .where(FoodItem.__table__.c.id == item.id)
+            ).first()
+            return row._asdict()
+        else:
+            previous[key] = getattr(item, key)
+    return previous
+
+
+def _holds_units(state):
+    return state in FoodItemState.IN_MACHINE
+
+
+@event.listens_for(Session, "before_flush")
+def _count_orm_changes(session, flush_context, instances):
+    """Apply FoodItem inserts, updates and deletes made through the ORM to the counters."""
+    deleted_machines = {obj.id for obj in session.deleted if isinstance(obj, Machine)}
+    expiry_deltas = {}
+    dispensed = Counter()
+    expired_pending = Counter()
+
+    for item in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(item, FoodItem) or item.machine_id is None:
+            continue
+        if item.machine_id in deleted_machines:
+            continue
+        deltas = expiry_deltas.setdefault(item.machine_id, Counter())
+
+        if item in session.new:
+            was_dispensed = False
+        elif item in session.deleted or session.is_modified(item):
+            previous = _previous_state(session, item)
+            was_dispensed = previous["state"] == FoodItemState.DISPENSED
+            if _holds_units(previous["state"]):
+                deltas[previous["expiry_date"]] -= previous["quantity"] or 1
+                if previous["state"] == FoodItemState.EXPIRED:
+                    expired_pending[item.machine_id] -= previous["quantity"] or 1
+        else:
+            continue
+
+        if item not in session.deleted:
+            quantity = item.quantity or 1
+            state = FoodItemState.AVAILABLE if item.state is None and item in session.new else item.state
+            if _holds_units(state):
+                deltas[item.expiry_date] += quantity
+                if state == FoodItemState.EXPIRED:
+                    expired_pending[item.machine_id] += quantity
+            if state == FoodItemState.DISPENSED and not was_dispensed:
+                dispensed[item.machine_id] += quantity
+
+    for machine_id, deltas in expiry_deltas.items():
+        apply_counter_deltas(machine_id, deltas, dispensed[machine_id], session, expired_pending[machine_id])
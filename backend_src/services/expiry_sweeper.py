@@ -0,0 +1,207 @@
+"""
+Expiry Sweeper
+
+Moves lots that are past their expiry date into the explicit expired-pending-removal
+state (FoodItem.state EXPIRED), stamping expired_at, and keeps MachineCounter.expired_pending
+in step. The volunteer endpoints list lots by date and do not wait for it; the swept state
+records when a lot was found expired and what the machine still has awaiting removal.
+
+Lots are swept in batches of batch_size, each in its own short transaction, so a large
+backlog never holds locks for long. ExpirySweeper runs a sweep in a background thread
+when it starts and again at every day boundary (the local date, like every other expiry
+comparison). install_expiry_sweeper starts it with the first request an application
+serves, so every server (flask run, gunicorn, main.py) gets one while CLI commands and the
+reloader's watcher process do not; each worker process runs its own, which is harmless
+since a lot is only ever swept once. Deployments that would rather use cron set
+EXPIRY_SWEEPER to False and run `flask --app main sweep-expired` just after midnight.
+"""
+
+import datetime
+import logging
+import threading
+from collections import Counter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import SQLAlchemyError
+
+from models.models import db, FoodItem, FoodItemState, MachineCounter, state_is
+from services.machine_events import record_change
+from services.upsert import upsert
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = "expiry_sweeper"
+DEFAULT_BATCH_SIZE = 500
+
+food_items_table = FoodItem.__table__
+counters_table = MachineCounter.__table__
+
+
+def sweep_batch(today, batch_size, now=None):
+    """Move up to batch_size lots expiring before today into expired-pending-removal.
+
+    The caller commits.
+
+    Returns:
+        Tuple of (lots_seen, units_by_machine); lots_seen is 0 once nothing is left to sweep
+    """
+    now = now or datetime.datetime.utcnow()
+    columns = food_items_table.c
+    available = state_is(columns.state, FoodItemState.AVAILABLE)
+    ids = db.session.execute(
+        db.select(columns.id)
+        .where(available, columns.expiry_date < today)
+        .order_by(columns.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0, Counter()
+
+    # Lots dispensed or removed since they were selected are left alone
+    target = columns.id.in_(ids) & available
+    stmt = food_items_table.update().values(state=FoodItemState.EXPIRED, expired_at=now)
+    if db.session.get_bind().dialect.update_returning:
+        swept = db.session.execute(stmt.where(target).returning(columns.machine_id, columns.quantity)).all()
+    else:
+        swept = db.session.execute(
+            db.select(columns.id, columns.machine_id, columns.quantity).where(target).with_for_update()
+        ).all()
+        if swept:
+            db.session.execute(stmt.where(columns.id.in_([row.id for row in swept])))
+
+    units = Counter()
+    for row in swept:
+        units[row.machine_id] += row.quantity
+    if units:
+        upsert(
+            db.session, counters_table,
+            [{"machine_id": machine_id, "expired_pending": count} for machine_id, count in sorted(units.items())],
+            lambda incoming: [(counters_table.c.expired_pending, counters_table.c.expired_pending + incoming["expired_pending"])]
+        )
+        for machine_id in units:
+            record_change(db.session, machine_id)
+    return len(ids), units
+
+
+def sweep_expired(today=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Sweep every lot that expired before today, committing after each batch.
+
+    Args:
+        today: First day that is not expired (defaults to today)
+        batch_size: Lots moved per transaction
+
+    Returns:
+        Dictionary with the number of lots, units, machines and batches swept
+    """
+    today = today or datetime.date.today()
+    totals = Counter()
+    machines = set()
+    while True:
+        seen, units = sweep_batch(today, batch_size)
+        if not seen:
+            break
+        db.session.commit()
+        totals["batches"] += 1
+        totals["lots"] += seen
+        totals["units"] += sum(units.values())
+        machines.update(units)
+    return {"lots": totals["lots"], "units": totals["units"], "machines": len(machines), "batches": totals["batches"]}
+
+
+def _seconds_until_tomorrow():
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+    return (midnight - now).total_seconds()
+
+
+class ExpirySweeper:
+    """Background thread that sweeps expired lots at start-up and at every day boundary."""
+
+    def __init__(self, app, batch_size=DEFAULT_BATCH_SIZE, retry_after=60.0):
+        """Initialize a stopped sweeper.
+
+        Args:
+            app: Application whose database is swept
+            batch_size: Lots moved per transaction
+            retry_after: Seconds to wait before retrying a sweep that failed
+        """
+        self.app = app
+        self.batch_size = batch_size
+        self.retry_after = retry_after
+        self.last_result = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        """Sweep now; returns the sweep_expired result."""
+        with self.app.app_context():
+            try:
+                self.last_result = sweep_expired(batch_size=self.batch_size)
+            except SQLAlchemyError:
+                db.session.rollback()
+                raise
+        return self.last_result
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                wait = _seconds_until_tomorrow() + 1
+            except SQLAlchemyError:
+                logger.exception("Expiry sweep failed; retrying in %s seconds", self.retry_after)
+                wait = self.retry_after
+            self._stop.wait(wait)
+
+
+def start_expiry_sweeper(app):
+    """Start the application's expiry sweeper thread (once) and return it."""
+    sweeper = app.extensions.get(EXTENSION_KEY)
+    if sweeper is None:
+        sweeper = app.extensions.setdefault(EXTENSION_KEY, ExpirySweeper(
+            app, batch_size=app.config.get("EXPIRY_SWEEP_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+        ))
+        sweeper.start()
+    return sweeper
+
+
+def install_expiry_sweeper(app):
+    """Start the expiry sweeper with the application's first request, unless EXPIRY_SWEEPER is False."""
+    if not app.config.get("EXPIRY_SWEEPER", True):
+        logger.warning(
+            "Expiry sweeper disabled (EXPIRY_SWEEPER=False): lots past their date stay AVAILABLE "
+            "unless `flask --app main sweep-expired` runs daily"
+        )
+        return
+
+    def start():
+        if EXTENSION_KEY not in app.extensions:
+            start_expiry_sweeper(app)
+
+    app.before_request(start)
+
+
+@click.command("sweep-expired")
+@click.option("--batch-size", type=click.IntRange(1), default=None, help="Lots moved per transaction.")
+@with_appcontext
+def sweep_expired_command(batch_size):
+    """Move lots past their expiry date into the expired-pending-removal state."""
+    result = sweep_expired(
+        batch_size=batch_size or current_app.config.get("EXPIRY_SWEEP_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    )
+    click.echo(
+        f"Swept {result['lots']} lot(s), {result['units']} unit(s) in {result['machines']} machine(s) "
+        f"over {result['batches']} batch(es)."
+    )
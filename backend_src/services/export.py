@@ -0,0 +1,174 @@
+"""
+Food Item History Export
+
+Streams the FoodItem history (donations, dispenses and expired removals), archived lots
+included, as NDJSON or CSV for analytics jobs, for the /api/export/food_items endpoint and the
+`flask --app main export-food-items` command.
+
+Archived lots are exported first, then live ones, each in id order. Rows are read through
+a server-side cursor in chunks of chunk_size and encoded chunk by chunk, optionally
+through a streaming gzip compressor, so memory use does not depend on the size of the
+table.
+"""
+
+import csv
+import datetime
+import io
+import json
+import zlib
+
+import click
+from flask.cli import with_appcontext
+
+from models.models import db, FoodItemState
+from services.archive import archive_table, food_items_table
+
+FORMATS = ("ndjson", "csv")
+DEFAULT_CHUNK_SIZE = 1000
+
+# Exported columns, in CSV column order
+EXPORT_COLUMNS = (
+    "id",
+    "machine_id",
+    "quantity",
+    "expiry_date",
+    "donated_at",
+    "is_dispensed",
+    "dispensed_at",
+    "is_expired_removed",
+    "expired_removed_at",
+    "expired_removed_by_volunteer_id",
+)
+
+MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _export_column(items, name):
+    # The flags of the export format are derived from FoodItem.state
+    if name == "is_dispensed":
+        return (items.c.state == FoodItemState.DISPENSED).label(name)
+    if name == "is_expired_removed":
+        return (items.c.state == FoodItemState.EXPIRED_REMOVED).label(name)
+    return items.c[name]
+
+
+def history_queries(start=None, end=None, machine_ids=None):
+    """Select the exported columns, filtered to items with any event in [start, end).
+
+    An item is included if it was donated, dispensed or removed inside the range. Returns
+    one select for food_items_archive and one for food_items, each in id order along the
+    table's primary key, so neither needs a sort before its first row.
+    """
+    def select_from(items):
+        query = db.select(*(_export_column(items, name) for name in EXPORT_COLUMNS))
+        if machine_ids:
+            query = query.where(items.c.machine_id.in_(machine_ids))
+        if start is not None or end is not None:
+            events = []
+            for column in (items.c.donated_at, items.c.dispensed_at, items.c.expired_removed_at):
+                bounds = []
+                if start is not None:
+                    bounds.append(column >= start)
+                if end is not None:
+                    bounds.append(column < end)
+                events.append(db.and_(*bounds))
+            query = query.where(db.or_(*events))
+        return query.order_by(items.c.id)
+
+    return select_from(archive_table), select_from(food_items_table)
+
+
+def iter_history_chunks(start=None, end=None, machine_ids=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield lists of at most chunk_size history rows, read through a server-side cursor.
+
+    Archived lots come first, then the live ones, each table in id order. (Ids never
+    appear in both tables; ordering the union of the two made the database read and sort
+    every row before returning the first.)
+    """
+    for query in history_queries(start, end, machine_ids):
+        result = db.session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+        try:
+            for partition in result.partitions():
+                yield partition
+        finally:
+            result.close()
+
+
+def _value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def encode_chunks(chunks, fmt):
+    """Encode row chunks as NDJSON or CSV text, one string per chunk (CSV starts with a header)."""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+        for chunk in chunks:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([[_value(value) for value in row] for row in chunk])
+            yield buffer.getvalue()
+    else:
+        for chunk in chunks:
+            yield "".join(
+                json.dumps({name: _value(value) for name, value in zip(EXPORT_COLUMNS, row)}) + "\n"
+                for row in chunk
+            )
+
+
+def gzip_stream(pieces):
+    """Compress a stream of text pieces into a gzip byte stream without buffering it."""
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip container
+    for piece in pieces:
+        data = compressor.compress(piece.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_history(fmt="ndjson", start=None, end=None, machine_ids=None, compress=False,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream the history export as bytes.
+
+    Args:
+        fmt: "ndjson" or "csv"
+        start: Only items with an event at or after this time
+        end: Only items with an event before this time
+        machine_ids: Only items of these machines
+        compress: Gzip the stream
+        chunk_size: Rows fetched from the cursor at a time
+
+    Returns:
+        Iterator of byte strings
+    """
+    pieces = encode_chunks(iter_history_chunks(start, end, machine_ids, chunk_size), fmt)
+    if compress:
+        return gzip_stream(pieces)
+    return (piece.encode("utf-8") for piece in pieces)
+
+
+@click.command("export-food-items")
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="ndjson", show_default=True)
+@click.option("--start", type=click.DateTime(), help="Only items with an event at or after this time (UTC).")
+@click.option("--end", type=click.DateTime(), help="Only items with an event before this time (UTC).")
+@click.option("--machine", "machine_ids", type=int, multiple=True, help="Only this machine (repeatable).")
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False, writable=True), help="File to write (default stdout).")
+@click.option("--chunk-size", type=click.IntRange(1), default=DEFAULT_CHUNK_SIZE, show_default=True)
+@with_appcontext
+def export_food_items_command(fmt, start, end, machine_ids, compress, output, chunk_size):
+    """Export the food item history as NDJSON or CSV."""
+    stream = export_history(fmt, start, end, list(machine_ids) or None, compress, chunk_size)
+    target = open(output, "wb") if output else click.get_binary_stream("stdout")
+    try:
+        for data in stream:
+            target.write(data)
+    finally:
+        if output:
+            target.close()
+        else:
+            target.flush()
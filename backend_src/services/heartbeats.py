@@ -0,0 +1,197 @@
+"""
+Heartbeat Buffer
+
+Coalesces machine heartbeats in memory instead of writing Machine.last_heartbeat on every
+request.
+
+Only the latest heartbeat per machine is kept. Pending heartbeats are written as one
+batched UPDATE, in a transaction of their own, by the first heartbeat that arrives once
+flush_interval seconds have passed since the previous flush, and by a background thread
+every flush_interval seconds, so the last heartbeats of machines that stop reporting are
+written too; flush() can also be called directly. A heartbeat never moves last_heartbeat
+backwards.
+
+Readers that need current liveness use last_seen(), which merges the buffer with the
+stored values, so monitoring does not lag by up to one flush interval.
+
+There is one buffer per application and per process. The buffer is flushed once more
+when the process exits normally; heartbeats still in it when a process is killed are
+lost, which only makes a machine look up to one interval older.
+"""
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from models.models import db, Machine
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = "machine_heartbeat_buffer"
+
+machines_table = Machine.__table__
+
+
+class HeartbeatBuffer:
+    """Latest unflushed heartbeat per machine, written out in batches."""
+
+    def __init__(self, engine, flush_interval=5.0):
+        """Initialize an empty buffer.
+
+        Args:
+            engine: Engine the batched UPDATEs are written through
+            flush_interval: Minimum seconds between flushes triggered by record()
+        """
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}   # machine id -> latest heartbeat time
+        self._last_flush = time.monotonic()
+        self.recorded = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Flush every flush_interval seconds in a background thread, and once more at exit."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="heartbeat-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """Stop the background thread and flush what is still buffered."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+            atexit.unregister(self.stop)
+        self._flush_logged()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush_logged()
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+        except SQLAlchemyError:
+            # The batch stays buffered and is retried by the next flush
+            logger.exception("Heartbeat flush failed")
+
+    def record(self, machine_id, at=None):
+        """Buffer a heartbeat, flushing the buffer if the flush interval has passed.
+
+        Args:
+            machine_id: Machine that reported in
+            at: Time of the heartbeat (defaults to now, UTC)
+        """
+        at = at or datetime.datetime.utcnow()
+        with self._lock:
+            previous = self._pending.get(machine_id)
+            if previous is None or at > previous:
+                self._pending[machine_id] = at
+            self.recorded += 1
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self._flush_logged()
+
+    def pending(self):
+        """Return a copy of the buffered heartbeats."""
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self):
+        """Write every buffered heartbeat with one batched UPDATE.
+
+        Returns:
+            Number of machines whose heartbeat was written
+        """
+        # A second caller arriving mid-flush leaves the work to the first
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._last_flush = time.monotonic()
+            if not batch:
+                return 0
+
+            stmt = (
+                machines_table.update()
+                .where(
+                    machines_table.c.id == bindparam("b_id"),
+                    db.or_(
+                        machines_table.c.last_heartbeat == None,
+                        machines_table.c.last_heartbeat < bindparam("b_at"),
+                    ),
+                )
+                .values(last_heartbeat=bindparam("b_at"))
+            )
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(stmt, [
+                        {"b_id": machine_id, "b_at": at} for machine_id, at in sorted(batch.items())
+                    ])
+            except Exception:
+                # Put the batch back (newer heartbeats win) so the next flush retries it
+                with self._lock:
+                    for machine_id, at in batch.items():
+                        if machine_id not in self._pending or self._pending[machine_id] < at:
+                            self._pending[machine_id] = at
+                raise
+            self.flushes += 1
+            self.rows_written += len(batch)
+            return len(batch)
+        finally:
+            self._flush_lock.release()
+
+    def last_seen(self, stored):
+        """Merge buffered heartbeats over stored values.
+
+        Args:
+            stored: Mapping of machine id -> last_heartbeat read from the database
+
+        Returns:
+            Mapping of machine id -> most recent known heartbeat (None if never seen)
+        """
+        pending = self.pending()
+        merged = {}
+        for machine_id, at in stored.items():
+            buffered = pending.get(machine_id)
+            if buffered is not None and (at is None or buffered > at):
+                at = buffered
+            merged[machine_id] = at
+        return merged
+
+    def stats(self):
+        """Return buffer counters: heartbeats recorded, flushes, rows written and pending."""
+        with self._lock:
+            return {
+                "recorded": self.recorded,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "pending": len(self._pending)
+            }
+
+
+def get_heartbeat_buffer():
+    """Return the heartbeat buffer for the current application, creating it on first use."""
+    buffer = current_app.extensions.get(EXTENSION_KEY)
+    if buffer is None:
+        buffer = current_app.extensions.setdefault(EXTENSION_KEY, HeartbeatBuffer(
+            db.engine,
+            flush_interval=current_app.config.get("HEARTBEAT_FLUSH_INTERVAL", 5.0)
+        ))
+        if current_app.config.get("HEARTBEAT_FLUSH_THREAD", True):
+            buffer.start()
+    return buffer
@@ -0,0 +1,478 @@
+"""
+Inventory Services
+
+Set-based write paths for machine inventory, shared by the machine blueprint and the
+machine compatibility blueprint.
+
+A donation is stored as a single lot: one FoodItem row whose quantity is the number of
+units donated. Capacity is claimed with one conditional UPDATE on the machine row, so
+the check and the increment cannot race with another donation.
+
+Dispensing is first-expired-first-out over lots. The lots needed are read with one
+ordered, limited query and claimed with guarded UPDATEs; if another request claimed any
+of them first the transaction is rolled back and the pick is retried.
+
+Every write also applies its change to the machine's inventory counters (see
+services.counters) and the daily analytics rollups (see services.analytics) in the same
+transaction.
+
+Every change to a machine's items bumps Machine.sync_version and stamps the changed rows
+with the new value, which is what delta sync reads. The bump is a write to the machine row,
+so writers to the same machine commit in version order.
+"""
+
+import datetime
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from models.models import db, Machine, FoodItem, FoodItemState, state_is
+from services.analytics import DailyStats
+from services.counters import apply_counter_deltas, apply_fleet_counter_deltas
+from services.machine_events import record_change
+
+machines_table = Machine.__table__
+food_items_table = FoodItem.__table__
+
+
+class InventoryError(Exception):
+    """Raised when an inventory operation is rejected.
+
+    The reason is one of "not_found", "inactive", "full", "overflow" or "conflict"; the
+    blueprints map it onto their own error messages and status codes.
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _rejection_reason(machine_id):
+    """Work out why a conditional machine update matched no row (cold path only)."""
+    machine = db.session.get(Machine, machine_id)
+    if not machine:
+        return "not_found"
+    if machine.status != "active":
+        return "inactive"
+    if machine.current_storage_level >= machine.storage_capacity_max:
+        return "full"
+    return "overflow"
+
+
+def _update_machine(session, machine_id, stmt, *columns):
+    """Run an UPDATE on one machine row and return the given columns afterwards, or None."""
+    if session.get_bind().dialect.update_returning:
+        return session.execute(stmt.returning(*columns)).first()
+    if session.execute(stmt).rowcount == 0:
+        return None
+    return session.execute(db.select(*columns).where(machines_table.c.id == machine_id)).first()
+
+
+def next_sync_version(machine_id, session=None):
+    """Bump a machine's sync version and return the new value (None if there is no machine)."""
+    session = session or db.session
+    stmt = (
+        machines_table.update()
+        .where(machines_table.c.id == machine_id)
+        .values(sync_version=machines_table.c.sync_version + 1)
+    )
+    row = _update_machine(session, machine_id, stmt, machines_table.c.sync_version)
+    return row.sync_version if row else None
+
+
+def reserve_capacity(machine_id, quantity):
+    """Claim storage space for a number of units on an active machine.
+
+    Args:
+        machine_id: Machine receiving the units
+        quantity: Number of units to claim
+
+    Returns:
+        Tuple of (new_storage_level, sync_version) for the machine
+
+    Raises:
+        InventoryError: If the machine is missing, inactive or lacks the space
+    """
+    stmt = (
+        machines_table.update()
+        .where(
+            machines_table.c.id == machine_id,
+            machines_table.c.status == "active",
+            machines_table.c.current_storage_level + quantity <= machines_table.c.storage_capacity_max,
+        )
+        .values(
+            current_storage_level=machines_table.c.current_storage_level + quantity,
+            sync_version=machines_table.c.sync_version + 1,
+        )
+    )
+    row = _update_machine(
+        db.session, machine_id, stmt,
+        machines_table.c.current_storage_level, machines_table.c.sync_version
+    )
+    if row is None:
+        raise InventoryError(_rejection_reason(machine_id))
+    return row.current_storage_level, row.sync_version
+
+
+def ingest_donation(machine_id, expiry_date, quantity):
+    """Store a donation as one lot and update the machine's storage level.
+
+    The capacity claim and the lot insert run in the caller's transaction; nothing is
+    written if the machine cannot take the whole donation.
+
+    Args:
+        machine_id: Machine the food was donated to
+        expiry_date: Expiry date shared by every unit in the donation
+        quantity: Number of units donated (must be positive)
+
+    Returns:
+        Tuple of (lot_id, new_storage_level)
+
+    Raises:
+        InventoryError: If the machine cannot accept the donation
+    """
+    new_level, version = reserve_capacity(machine_id, quantity)
+    record_change(db.session, machine_id)
+    now = datetime.datetime.utcnow()
+    result = db.session.execute(
+        food_items_table.insert().values(
+            machine_id=machine_id,
+            quantity=quantity,
+            expiry_date=expiry_date,
+            donated_at=now,
+            state=FoodItemState.AVAILABLE,
+            sync_version=version,
+        )
+    )
+    apply_counter_deltas(machine_id, {expiry_date: quantity})
+    DailyStats().donated(machine_id, now, quantity).apply()
+    return result.inserted_primary_key[0], new_level
+
+
+def adjust_storage_level(machine_id, delta):
+    """Add delta (possibly negative) to a machine's storage level, never going below zero.
+
+    Returns:
+        The machine's new storage level
+    """
+    level = machines_table.c.current_storage_level
+    stmt = (
+        machines_table.update()
+        .where(machines_table.c.id == machine_id)
+        .values(current_storage_level=db.case((level + delta < 0, 0), else_=level + delta))
+    )
+    row = _update_machine(db.session, machine_id, stmt, level)
+    return row.current_storage_level if row else None
+
+
+def _claim_lots(machine_id, quantity, now, version):
+    """Run one FEFO pick.
+
+    Returns:
+        Tuple of (dispensed_ids, units, units_by_expiry_date, daily_stats), or None if a lot
+        was taken concurrently
+    """
+    lots = db.session.execute(
+        db.select(
+            food_items_table.c.id,
+            food_items_table.c.quantity,
+            food_items_table.c.expiry_date,
+            food_items_table.c.donated_at,
+        )
+        .where(
+            food_items_table.c.machine_id == machine_id,
+            state_is(food_items_table.c.state, FoodItemState.AVAILABLE),
+            food_items_table.c.expiry_date >= now.date(),
+        )
+        .order_by(food_items_table.c.expiry_date.asc(), food_items_table.c.id.asc())
+        .limit(quantity)  # each lot holds at least one unit
+        .with_for_update()
+    ).all()
+
+    whole_lots = []
+    split = None
+    remaining = quantity
+    by_expiry = {}
+    stats = DailyStats()
+    for lot in lots:
+        if remaining <= 0:
+            break
+        units = min(lot.quantity, remaining)
+        by_expiry[lot.expiry_date] = by_expiry.get(lot.expiry_date, 0) + units
+        stats.departed(machine_id, now, units, lot.donated_at)
+        if lot.quantity <= remaining:
+            whole_lots.append(lot.id)
+        else:
+            split = (lot, remaining)
+        remaining -= units
+
+    still_available = state_is(food_items_table.c.state, FoodItemState.AVAILABLE)
+    dispensed_ids = list(whole_lots)
+    if whole_lots:
+        claimed = db.session.execute(
+            food_items_table.update()
+            .where(food_items_table.c.id.in_(whole_lots), still_available)
+            .values(state=FoodItemState.DISPENSED, dispensed_at=now, sync_version=version)
+        ).rowcount
+        if claimed != len(whole_lots):
+            return None
+
+    if split:
+        lot, units = split
+        # Shrink the lot in place and record the dispensed part as its own row
+        claimed = db.session.execute(
+            food_items_table.update()
+            .where(
+                food_items_table.c.id == lot.id,
+                food_items_table.c.quantity == lot.quantity,
+                still_available,
+            )
+            .values(quantity=lot.quantity - units, sync_version=version)
+        ).rowcount
+        if claimed != 1:
+            return None
+        result = db.session.execute(
+            food_items_table.insert().values(
+                machine_id=machine_id,
+                quantity=units,
+                expiry_date=lot.expiry_date,
+                donated_at=lot.donated_at,
+                state=FoodItemState.DISPENSED,
+                dispensed_at=now,
+                sync_version=version,
+            )
+        )
+        dispensed_ids.append(result.inserted_primary_key[0])
+
+    return dispensed_ids, quantity - remaining, by_expiry, stats
+
+
+def dispense_units(machine_id, quantity, max_attempts=3):
+    """Dispense up to a number of units from a machine, soonest-to-expire first.
+
+    Whole lots are marked dispensed with one UPDATE. When only part of a lot is needed the
+    lot is shrunk and the dispensed units are written as a separate, already-dispensed row
+    so donation history is preserved.
+
+    Args:
+        machine_id: Machine to dispense from
+        quantity: Maximum number of units to dispense
+        max_attempts: How many times to retry the pick after losing a race
+
+    Returns:
+        Tuple of (dispensed_item_ids, units_dispensed, new_storage_level); the id list is
+        empty when nothing suitable was available
+
+    Raises:
+        InventoryError: With reason "conflict" if every attempt lost a race
+    """
+    for _ in range(max_attempts):
+        now = datetime.datetime.utcnow()
+        try:
+            version = next_sync_version(machine_id)
+            claimed = _claim_lots(machine_id, quantity, now, version)
+        except OperationalError:
+            # SQLite reports a lost write race as "database is locked"
+            claimed = None
+        if claimed is None:
+            db.session.rollback()
+            continue
+
+        dispensed_ids, units, by_expiry, stats = claimed
+        if not dispensed_ids:
+            return [], 0, None
+        apply_counter_deltas(
+            machine_id, {day: -count for day, count in by_expiry.items()}, dispensed=units
+        )
+        stats.apply()
+        record_change(db.session, machine_id)
+        return dispensed_ids, units, adjust_storage_level(machine_id, -units)
+
+    raise InventoryError("conflict")
+
+
+def remove_items(machine_id, item_ids):
+    """Mark a machine's lots as expired-and-removed in one statement.
+
+    Only lots that belong to the machine and are still in it change state; the storage
+    level drops by exactly the units removed.
+
+    Args:
+        machine_id: Machine the lots were removed from
+        item_ids: Ids of the lots reported as removed
+
+    Returns:
+        Tuple of (removed_ids, units_removed, new_storage_level)
+    """
+    item_ids = set(item_ids)
+    if not item_ids:
+        return [], 0, None
+
+    now = datetime.datetime.utcnow()
+    version = next_sync_version(machine_id)
+    columns = food_items_table.c
+    target = (
+        columns.id.in_(item_ids)
+        & (columns.machine_id == machine_id)
+        & state_is(columns.state, *FoodItemState.IN_MACHINE)
+    )
+    stmt = food_items_table.update().values(
+        state=FoodItemState.EXPIRED_REMOVED, expired_removed_at=now, sync_version=version
+    )
+
+    if db.session.get_bind().dialect.update_returning:
+        removed = db.session.execute(
+            stmt.where(target).returning(
+                columns.id, columns.quantity, columns.expiry_date, columns.expired_at, columns.donated_at
+            )
+        ).all()
+    else:
+        removed = db.session.execute(
+            db.select(columns.id, columns.quantity, columns.expiry_date, columns.expired_at, columns.donated_at)
+            .where(target).with_for_update()
+        ).all()
+        if removed:
+            db.session.execute(stmt.where(columns.id.in_([row.id for row in removed])))
+
+    if not removed:
+        return [], 0, None
+    units = 0
+    pending = 0
+    by_expiry = {}
+    stats = DailyStats()
+    for row in removed:
+        units += row.quantity
+        by_expiry[row.expiry_date] = by_expiry.get(row.expiry_date, 0) - row.quantity
+        # RETURNING yields the new state; expired_at marks lots the sweeper had moved
+        if row.expired_at is not None:
+            pending += row.quantity
+        stats.departed(machine_id, now, row.quantity, row.donated_at, removed=True)
+    apply_counter_deltas(machine_id, by_expiry, expired_pending=-pending)
+    stats.apply()
+    record_change(db.session, machine_id)
+    return sorted(row.id for row in removed), units, adjust_storage_level(machine_id, -units)
+
+
+def _update_machines(machine_ids, stmt, *columns):
+    """Run an UPDATE on several machine rows and return {machine_id: row} afterwards."""
+    if db.session.get_bind().dialect.update_returning:
+        rows = db.session.execute(stmt.returning(machines_table.c.id, *columns)).all()
+    else:
+        db.session.execute(stmt)
+        rows = db.session.execute(
+            db.select(machines_table.c.id, *columns).where(machines_table.c.id.in_(machine_ids))
+        ).all()
+    return {row.id: row for row in rows}
+
+
+def remove_items_for_volunteer(item_ids, volunteer_id):
+    """Mark lots in any number of machines as removed by a volunteer.
+
+    The lots are read with one query and marked with one guarded UPDATE; the affected
+    machines get their sync versions bumped with one UPDATE and their storage levels
+    lowered with another, so the number of statements does not depend on the number of
+    lots or machines. Lots that are missing, dispensed or already removed are left alone.
+
+    Args:
+        item_ids: Ids of the lots removed
+        volunteer_id: Volunteer who removed them (already validated by the caller)
+
+    Returns:
+        Tuple of (outcomes, storage_levels): outcomes maps every requested id to "removed",
+        "not_found", "already_dispensed", "already_removed" or "conflict" (changed by a
+        concurrent request); storage_levels maps every affected machine to its new level
+    """
+    item_ids = list(dict.fromkeys(item_ids))
+    outcomes = dict.fromkeys(item_ids, "not_found")
+    if not item_ids:
+        return outcomes, {}
+
+    columns = food_items_table.c
+    returning = db.session.get_bind().dialect.update_returning
+    lots = db.select(
+        columns.id, columns.machine_id, columns.quantity, columns.expiry_date, columns.state, columns.donated_at
+    ).where(columns.id.in_(item_ids))
+    if not returning:
+        lots = lots.with_for_update()
+
+    eligible = {}
+    for row in db.session.execute(lots):
+        if row.state == FoodItemState.DISPENSED:
+            outcomes[row.id] = "already_dispensed"
+        elif row.state == FoodItemState.EXPIRED_REMOVED:
+            outcomes[row.id] = "already_removed"
+        else:
+            eligible[row.id] = row
+    if not eligible:
+        return outcomes, {}
+
+    now = datetime.datetime.utcnow()
+    machine_ids = sorted({row.machine_id for row in eligible.values()})
+    bump = (
+        machines_table.update()
+        .where(machines_table.c.id.in_(machine_ids))
+        .values(sync_version=machines_table.c.sync_version + 1)
+    )
+    versions = _update_machines(machine_ids, bump, machines_table.c.sync_version)
+
+    stmt = food_items_table.update().values(
+        state=FoodItemState.EXPIRED_REMOVED,
+        expired_removed_at=now,
+        expired_removed_by_volunteer_id=volunteer_id,
+        sync_version=db.case({machine_id: row.sync_version for machine_id, row in versions.items()}, value=columns.machine_id)
+    )
+    if returning:
+        # Lots dispensed or removed since they were read are left alone
+        removed = db.session.execute(stmt.where(
+            columns.id.in_(eligible), state_is(columns.state, *FoodItemState.IN_MACHINE)
+        ).returning(columns.id)).scalars().all()
+    else:
+        db.session.execute(stmt.where(columns.id.in_(eligible)))
+        removed = list(eligible)
+
+    units = {}
+    expiry_deltas = {}
+    pending = {}
+    stats = DailyStats()
+    for item_id in eligible:
+        outcomes[item_id] = "conflict"
+    for item_id in removed:
+        row = eligible[item_id]
+        outcomes[item_id] = "removed"
+        units[row.machine_id] = units.get(row.machine_id, 0) + row.quantity
+        key = (row.machine_id, row.expiry_date)
+        expiry_deltas[key] = expiry_deltas.get(key, 0) - row.quantity
+        if row.state == FoodItemState.EXPIRED:
+            pending[row.machine_id] = pending.get(row.machine_id, 0) - row.quantity
+        stats.departed(row.machine_id, now, row.quantity, row.donated_at, removed=True)
+    if not units:
+        return outcomes, {}
+
+    apply_fleet_counter_deltas(expiry_deltas, pending)
+    stats.apply()
+
+    # One grouped update lowers every machine by its own units, never below zero
+    level = machines_table.c.current_storage_level
+    lowered = level - db.case(units, value=machines_table.c.id)
+    lower = (
+        machines_table.update()
+        .where(machines_table.c.id.in_(list(units)))
+        .values(current_storage_level=db.case((lowered < 0, 0), else_=lowered))
+    )
+    levels = _update_machines(list(units), lower, level)
+    for machine_id in units:
+        record_change(db.session, machine_id)
+    return outcomes, {machine_id: row.current_storage_level for machine_id, row in sorted(levels.items())}
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_orm_changes(session, flush_context, instances):
+    """Give FoodItems changed through the ORM a fresh sync version of their machine."""
+    changed = {}
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, FoodItem) and obj.machine_id is not None and session.is_modified(obj):
+            changed.setdefault(obj.machine_id, []).append(obj)
+    for machine_id, items in changed.items():
+        version = next_sync_version(machine_id, session)
+        for item in items:
+            item.sync_version = version or 0
@@ -0,0 +1,73 @@
+"""
+Machine Change Notifications
+
+Tracks which machines a transaction touched (and which it deleted) and tells subscribers
+once it commits.
+
+ORM writes to Machine and FoodItem rows are picked up automatically at flush time. Write
+paths that issue Core statements (see services.inventory) call record_change themselves.
+Nothing is delivered for transactions that roll back.
+"""
+
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models.models import Machine, FoodItem
+
+_PENDING_KEY = "changed_machine_ids"
+_DELETED_KEY = "deleted_machine_ids"
+
+# Callables taking the set of machine ids changed by a committed transaction
+_listeners = []
+# Callables taking the set of machine ids deleted by a committed transaction
+_deletion_listeners = []
+
+
+def subscribe(listener):
+    """Register a callable to receive the set of machine ids changed by each commit."""
+    _listeners.append(listener)
+    return listener
+
+
+def subscribe_deleted(listener):
+    """Register a callable to receive the set of machine ids deleted by each commit."""
+    _deletion_listeners.append(listener)
+    return listener
+
+
+def record_change(session, machine_id):
+    """Mark a machine as changed by the session's current transaction."""
+    session.info.setdefault(_PENDING_KEY, set()).add(machine_id)
+
+
+@event.listens_for(Session, "after_flush")
+def _record_orm_changes(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        # Assigning an attribute its current value leaves the object dirty but unchanged
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Machine):
+            record_change(session, obj.id)
+        elif isinstance(obj, FoodItem):
+            record_change(session, obj.machine_id)
+    for obj in session.deleted:
+        if isinstance(obj, Machine):
+            session.info.setdefault(_DELETED_KEY, set()).add(obj.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_listeners(session):
+    deleted = session.info.pop(_DELETED_KEY, None)
+    changed = session.info.pop(_PENDING_KEY, None)
+    if deleted:
+        for listener in _deletion_listeners:
+            listener(deleted)
+    if changed:
+        for listener in _listeners:
+            listener(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_DELETED_KEY, None)
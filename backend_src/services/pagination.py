@@ -0,0 +1,80 @@
+"""
+Keyset Pagination
+
+Cursor-based paging for list endpoints. A page is the next `limit` rows with an id
+greater than the `after` cursor, so every page costs one indexed range read no matter
+how deep into the listing it is (unlike OFFSET, which re-reads every skipped row).
+
+List bodies are left as plain JSON arrays; the cursor for the next page is returned in
+the X-Next-After response header and is absent on the last page.
+"""
+
+from flask import jsonify, request
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+NEXT_CURSOR_HEADER = "X-Next-After"
+
+
+class PaginationError(Exception):
+    """Raised when after or limit is not a valid page request."""
+
+
+def page_args(default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """Read the after and limit query parameters of the current request.
+
+    Args:
+        default_limit: Page size when no limit is given; None leaves a request without
+            after or limit unpaged, for listings that were complete before paging existed
+        max_limit: Largest page size a client may ask for
+
+    Returns:
+        Tuple of (after, limit); after is 0 when no cursor was given, limit is None for
+        an unpaged request
+
+    Raises:
+        PaginationError: If either value is not a valid integer, after is negative or limit
+            is out of range
+    """
+    if default_limit is None and "after" not in request.args and "limit" not in request.args:
+        return 0, None
+    try:
+        after = int(request.args.get("after", 0))
+        limit = int(request.args.get("limit", default_limit or DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise PaginationError("after and limit must be integers")
+    if after < 0:
+        raise PaginationError("after must not be negative")
+    if not 1 <= limit <= max_limit:
+        raise PaginationError(f"limit must be between 1 and {max_limit}")
+    return after, limit
+
+
+def keyset_page(query, id_column, after, limit):
+    """Fetch one page of a query ordered by an id column.
+
+    Args:
+        query: Select or ORM query with every filter already applied
+        id_column: Unique, indexed column the listing is ordered by
+        after: Return rows with an id greater than this
+        limit: Page size, or None for every remaining row
+
+    Returns:
+        Tuple of (rows, next_after); next_after is None on the last page
+    """
+    if limit is None:
+        return query.filter(id_column > after).order_by(id_column).all(), None
+    rows = query.filter(id_column > after).order_by(id_column).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, getattr(rows[-1], id_column.key)
+    return rows, None
+
+
+def page_response(payload, next_after, status=200):
+    """Render a page as a JSON array, adding the next-page cursor header if there is one."""
+    response = jsonify(payload)
+    response.status_code = status
+    if next_after is not None:
+        response.headers[NEXT_CURSOR_HEADER] = str(next_after)
+    return response
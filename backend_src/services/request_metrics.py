@@ -0,0 +1,265 @@
+"""
+Request Metrics
+
+Per-endpoint latency, SQL statement count, SQL time and response size for every request,
+exposed in the Prometheus text format at /metrics.
+
+SQL is attributed to the request whose thread issues it, through SQLAlchemy engine events
+on the application's engine. Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged
+with their SQL, repeated statements grouped together, so an endpoint that has turned into
+N+1 queries shows up as one statement run N times. Select lists, multi-row VALUES and IN
+lists are collapsed before grouping, and each statement is cut to about 200 characters,
+so a batch write of any size stays one short line.
+
+Metric families (labels endpoint and method; status only on the request counter):
+
+    http_requests_total                  counter
+    http_request_duration_seconds        histogram
+    http_request_sql_statements          histogram
+    http_request_sql_duration_seconds    histogram
+    http_response_size_bytes             histogram (responses with a known length)
+
+The verified-token cache (services.token_cache) is exported alongside them, unlabelled:
+
+    machine_token_cache_lookups_total    counter (label result: hit or miss)
+    machine_token_cache_evictions_total  counter
+    machine_token_cache_invalidations_total counter
+    machine_token_cache_size             gauge
+    machine_token_cache_hit_ratio        gauge (hits over all lookups since start-up)
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from services.token_cache import get_token_cache
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = "request_metrics"
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# Statements kept per request for the slow-request log, and the length each is logged at
+MAX_CAPTURED_STATEMENTS = 200
+MAX_LOGGED_STATEMENT_LENGTH = 200
+
+# Second and later rows of a multi-row VALUES clause, columns after the first of a plain
+# select list, and the items of an IN list
+_VALUES_ROWS = re.compile(r"VALUES (\([^()]*\))(?:, \([^()]*\))+")
+_SELECT_LIST = re.compile(r"SELECT ([^(),]+), [^()]*? FROM ")
+_IN_LIST = re.compile(r"IN \([^()\s,]+(?:, [^()\s,]+)*\)")
+
+
+class Histogram:
+    """Cumulative-bucket histogram of one label set."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(pairs):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+
+class RequestMetrics:
+    """Thread-safe store of the per-endpoint metric families."""
+
+    FAMILIES = (
+        ("http_request_duration_seconds", "Request latency in seconds.", DURATION_BUCKETS),
+        ("http_request_sql_statements", "SQL statements issued per request.", STATEMENT_BUCKETS),
+        ("http_request_sql_duration_seconds", "Time spent in SQL per request, in seconds.", DURATION_BUCKETS),
+        ("http_response_size_bytes", "Response body size in bytes.", SIZE_BUCKETS),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._histograms = {name: {} for name, _, _ in self.FAMILIES}
+        self._buckets = {name: buckets for name, _, buckets in self.FAMILIES}
+
+    def _observe(self, family, key, value):
+        histogram = self._histograms[family].get(key)
+        if histogram is None:
+            histogram = self._histograms[family][key] = Histogram(self._buckets[family])
+        histogram.observe(value)
+
+    def record(self, endpoint, method, status, duration, statements, sql_time, size):
+        """Record one finished request."""
+        key = (endpoint, method)
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            self._observe("http_request_duration_seconds", key, duration)
+            self._observe("http_request_sql_statements", key, statements)
+            self._observe("http_request_sql_duration_seconds", key, sql_time)
+            if size is not None:
+                self._observe("http_response_size_bytes", key, size)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = [
+            "# HELP http_requests_total Requests handled, by endpoint, method and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                labels = _labels((("endpoint", endpoint), ("method", method), ("status", status)))
+                lines.append(f"http_requests_total{{{labels}}} {count}")
+            for name, help_text, _ in self.FAMILIES:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (endpoint, method), histogram in sorted(self._histograms[name].items()):
+                    base = (("endpoint", endpoint), ("method", method))
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{{{_labels(base + (('le', bound),))}}} {count}")
+                    lines.append(f"{name}_bucket{{{_labels(base + (('le', '+Inf'),))}}} {histogram.count}")
+                    lines.append(f"{name}_sum{{{_labels(base)}}} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{{{_labels(base)}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def get_request_metrics():
+    """Return the metrics store of the current application, creating it on first use."""
+    metrics = current_app.extensions.get(EXTENSION_KEY)
+    if metrics is None:
+        metrics = current_app.extensions.setdefault(EXTENSION_KEY, RequestMetrics())
+    return metrics
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "sql_statements" in g:
+        conn.info.setdefault("request_metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("request_metrics_started")
+    if not started or not has_request_context() or "sql_statements" not in g:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    g.sql_count += 1
+    g.sql_time += elapsed
+    if len(g.sql_statements) < MAX_CAPTURED_STATEMENTS:
+        g.sql_statements.append((statement, elapsed))
+
+
+def _discard_timer(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        started = context.connection.info.get("request_metrics_started")
+        if started:
+            started.pop()
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_statements = []
+
+
+def _statement_shape(statement):
+    """Statement text as grouped and logged for a slow request.
+
+    Select lists, multi-row VALUES and IN lists are collapsed, so batches of different
+    sizes group together, and the text is cut to MAX_LOGGED_STATEMENT_LENGTH.
+    """
+    text = " ".join(statement.split())
+    text = _VALUES_ROWS.sub(r"VALUES \1, ...", text)
+    text = _SELECT_LIST.sub(r"SELECT \1, ... FROM ", text)
+    text = _IN_LIST.sub("IN (...)", text)
+    if len(text) > MAX_LOGGED_STATEMENT_LENGTH:
+        # Keep the end too: after a long select list it names the tables and filters
+        tail = MAX_LOGGED_STATEMENT_LENGTH // 4
+        text = text[:MAX_LOGGED_STATEMENT_LENGTH - tail - 5] + " ... " + text[-tail:]
+    return text
+
+
+def _log_slow_request(duration):
+    by_shape = {}
+    for statement, elapsed in g.sql_statements:
+        shape = _statement_shape(statement)
+        runs, total = by_shape.get(shape, (0, 0.0))
+        by_shape[shape] = (runs + 1, total + elapsed)
+    # Most expensive first; a statement repeated many times is the usual N+1 signature
+    ranked = sorted(by_shape.items(), key=lambda entry: entry[1][1], reverse=True)
+    details = "\n".join(
+        f"  {runs}x {total * 1000:.1f} ms  {shape}" for shape, (runs, total) in ranked[:10]
+    )
+    logger.warning(
+        "Slow request %s %s (%s): %.1f ms, %d SQL statements in %.1f ms\n%s",
+        request.method, request.path, request.endpoint, duration * 1000, g.sql_count, g.sql_time * 1000, details
+    )
+
+
+def _finish_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    get_request_metrics().record(
+        endpoint, request.method, response.status_code, duration,
+        g.sql_count, g.sql_time, response.content_length
+    )
+    threshold = current_app.config.get("SLOW_REQUEST_THRESHOLD", 0.5)
+    if threshold is not None and duration >= threshold:
+        _log_slow_request(duration)
+    g.pop("sql_statements", None)
+    return response
+
+
+def render_token_cache_metrics():
+    """Render the token cache counters in the Prometheus text exposition format."""
+    stats = get_token_cache().stats()
+    lines = [
+        "# HELP machine_token_cache_lookups_total Token cache lookups, by result.",
+        "# TYPE machine_token_cache_lookups_total counter",
+        f'machine_token_cache_lookups_total{{{_labels((("result", "hit"),))}}} {stats["hits"]}',
+        f'machine_token_cache_lookups_total{{{_labels((("result", "miss"),))}}} {stats["misses"]}',
+    ]
+    for name, key, metric_type, help_text in (
+        ("machine_token_cache_evictions_total", "evictions", "counter", "Tokens evicted for age or size."),
+        ("machine_token_cache_invalidations_total", "invalidations", "counter", "Tokens dropped with their machine."),
+        ("machine_token_cache_size", "size", "gauge", "Verified tokens currently cached."),
+        ("machine_token_cache_hit_ratio", "hit_rate", "gauge", "Share of token lookups answered from the cache."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {stats[key]}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return Response(get_request_metrics().render() + render_token_cache_metrics(), mimetype=PROMETHEUS_MIMETYPE)
+
+
+def install_request_metrics(app, engine):
+    """Instrument an application's requests and its engine, and serve /metrics."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _discard_timer)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,205 @@
+"""
+Response Cache
+
+Caches the rendered responses of read-only locator endpoints, keyed by endpoint and
+normalized query parameters, and answers conditional requests with 304 Not Modified.
+
+Entries are invalidated as soon as a transaction that changed any machine (or its food
+items) commits (see services.machine_events), when the day changes, and after ttl
+seconds as a bound on changes committed by other processes.
+
+With a non-zero stale_ttl an invalidated entry stays usable for that long while one
+request recomputes it: concurrent requests get the stale copy instead of all querying
+the database at once.
+"""
+
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, has_app_context, request
+
+from services.machine_events import subscribe
+
+EXTENSION_KEY = "response_cache"
+
+# Only these statuses are cached; errors from bad parameters are recomputed every time
+CACHEABLE_STATUSES = (200, 404)
+
+
+class _Entry:
+    __slots__ = ("body", "status", "mimetype", "etag", "generation", "created_at", "created_on", "refreshing")
+
+    def __init__(self, body, status, mimetype, generation):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.generation = generation
+        self.created_at = time.monotonic()
+        self.created_on = datetime.date.today()
+        self.refreshing = False
+
+
+class ResponseCache:
+    """Bounded LRU map of (endpoint, parameters) -> rendered response."""
+
+    def __init__(self, ttl=30, stale_ttl=0, max_entries=1024):
+        """Initialize an empty cache.
+
+        Args:
+            ttl: Seconds an entry is served without being recomputed
+            stale_ttl: Seconds past invalidation an entry may still be served while one
+                       request recomputes it (0 disables stale serving)
+            max_entries: Maximum number of cached responses
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._invalidated_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        """Mark every cached response as out of date."""
+        with self._lock:
+            self._generation += 1
+            self._invalidated_at = time.monotonic()
+            self.invalidations += 1
+
+    def _is_fresh(self, entry, now):
+        return (
+            entry.generation == self._generation
+            and now - entry.created_at < self.ttl
+            and entry.created_on == datetime.date.today()
+        )
+
+    def _stale_deadline(self, entry):
+        """Monotonic time until which an out-of-date entry may still be served."""
+        if entry.generation != self._generation:
+            return self._invalidated_at + self.stale_ttl
+        return entry.created_at + self.ttl + self.stale_ttl
+
+    def lookup(self, key):
+        """Return (entry, must_refresh) for a key.
+
+        The entry is None on a miss. must_refresh is True when the caller has to recompute
+        the response (and store it); a stale entry is returned with must_refresh False while
+        another request is already recomputing it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, True
+            self._entries.move_to_end(key)
+            if self._is_fresh(entry, now):
+                self.hits += 1
+                return entry, False
+            if (
+                self.stale_ttl and entry.refreshing and entry.created_on == datetime.date.today()
+                and now < self._stale_deadline(entry)
+            ):
+                self.stale_hits += 1
+                return entry, False
+            entry.refreshing = True
+            self.misses += 1
+            return None, True
+
+    def store(self, key, response, generation):
+        """Cache a rendered response computed at the given generation; returns the entry."""
+        entry = _Entry(response.get_data(), response.status_code, response.mimetype, generation)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            elif key in self._entries:
+                # Invalidated while computing: keep serving the old copy until the next refresh
+                self._entries[key].refreshing = False
+        return entry
+
+    def release(self, key):
+        """Give up a refresh claimed by lookup (e.g. the view did not return a cacheable response)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refreshing = False
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def stats(self):
+        """Return cache counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+
+def get_response_cache():
+    """Return the response cache for the current application, creating it on first use."""
+    cache = current_app.extensions.get(EXTENSION_KEY)
+    if cache is None:
+        cache = current_app.extensions.setdefault(EXTENSION_KEY, ResponseCache(
+            ttl=current_app.config.get("RESPONSE_CACHE_TTL", 30),
+            stale_ttl=current_app.config.get("RESPONSE_CACHE_STALE_TTL", 0),
+            max_entries=current_app.config.get("RESPONSE_CACHE_SIZE", 1024)
+        ))
+    return cache
+
+
+def _respond(entry):
+    response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+def cached_response(view):
+    """Serve a GET view from the response cache, with ETag / If-None-Match support."""
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        cache = get_response_cache()
+        params = tuple(sorted((name, value) for name, value in request.args.items(multi=True) if value != ""))
+        key = (request.endpoint, tuple(sorted(kwargs.items())), params)
+
+        entry, must_refresh = cache.lookup(key)
+        if not must_refresh:
+            return _respond(entry)
+
+        generation = cache.generation
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            cache.release(key)
+            raise
+        if response.status_code not in CACHEABLE_STATUSES:
+            cache.release(key)
+            return response
+        return _respond(cache.store(key, response, generation))
+
+    return decorated
+
+
+@subscribe
+def _invalidate_on_change(machine_ids):
+    if has_app_context():
+        cache = current_app.extensions.get(EXTENSION_KEY)
+        if cache is not None:
+            cache.invalidate()
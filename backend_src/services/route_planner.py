@@ -0,0 +1,294 @@
+"""
+Volunteer Route Planner
+
+Plans a collection round through the machines holding expired food: from a start
+location and a time budget it picks the sites worth visiting, most expired units first,
+and orders them with a nearest-neighbour tour improved by 2-opt.
+
+Travel time is the great-circle (haversine) distance at a fixed speed, plus a fixed
+service time per stop. The round is open: it ends at the last stop.
+
+Distances between machines come from a DistanceMatrix kept per application and per
+process. Each request passes the current coordinates of its sites; only the rows of
+machines that are new to the matrix or have moved since they were cached are computed.
+"""
+
+import threading
+import time
+
+import numpy as np
+from flask import current_app, has_app_context
+
+from models.models import db, Machine
+from services.counters import units_by_machine
+from services.machine_events import subscribe_deleted
+from services.spatial_index import EARTH_RADIUS_KM, haversine_km
+
+EXTENSION_KEY = "route_distance_matrix"
+
+DEFAULT_SPEED_KMH = 30.0
+DEFAULT_SERVICE_MINUTES = 5.0
+MAX_TIME_BUDGET_MINUTES = 24 * 60
+
+# Full 2-opt sweeps over the tour before settling for what has been found
+MAX_TWO_OPT_PASSES = 50
+
+# Seconds a plan may spend from the start of plan_route before 2-opt settles for the
+# tour it has (ROUTE_PLAN_SECONDS); keeps large rounds inside the endpoint's 100 ms target
+DEFAULT_PLAN_SECONDS = 0.06
+
+
+class RouteError(Exception):
+    """Raised when route planning parameters are invalid."""
+
+
+def pairwise_km(lats1, lons1, lats2, lons2):
+    """Great-circle distances in kilometres between two arrays of points, as a matrix."""
+    lat1, lon1 = np.radians(lats1)[:, None], np.radians(lons1)[:, None]
+    lat2, lon2 = np.radians(lats2)[None, :], np.radians(lons2)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class DistanceMatrix:
+    """Cached pairwise distances between machines, recomputed per machine when it moves."""
+
+    def __init__(self, max_sites=2000):
+        """Initialize an empty matrix.
+
+        Args:
+            max_sites: Machines held before the matrix is started afresh
+        """
+        self.max_sites = max_sites
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._slots = {}
+        self._lat = np.empty(0)
+        self._lon = np.empty(0)
+        self._km = np.empty((0, 0))
+        self.computed_rows = 0
+
+    def forget(self, machine_ids):
+        """Drop machines from the matrix (their rows are reused after the next reset)."""
+        with self._lock:
+            for machine_id in machine_ids:
+                self._slots.pop(machine_id, None)
+
+    def submatrix(self, machine_ids, lats, lons):
+        """Distances in kilometres between the given machines at the given coordinates.
+
+        Args:
+            machine_ids: Machine ids
+            lats: Current latitude of each machine
+            lons: Current longitude of each machine
+
+        Returns:
+            Square NumPy array in the order of machine_ids
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        with self._lock:
+            if len(self._slots.keys() | set(machine_ids)) > self.max_sites:
+                self._reset()
+
+            slots = np.fromiter((self._slots.get(machine_id, -1) for machine_id in machine_ids),
+                                dtype=np.int64, count=len(machine_ids))
+            stale = slots < 0
+            known = ~stale
+            stale[known] = (self._lat[slots[known]] != lats[known]) | (self._lon[slots[known]] != lons[known])
+
+            new = np.flatnonzero(slots < 0)
+            if len(new):
+                first = len(self._lat)
+                for offset, position in enumerate(new):
+                    self._slots[machine_ids[position]] = slots[position] = first + offset
+                size = first + len(new)
+                self._lat = np.concatenate([self._lat, np.zeros(len(new))])
+                self._lon = np.concatenate([self._lon, np.zeros(len(new))])
+                grown = np.zeros((size, size))
+                grown[:first, :first] = self._km
+                self._km = grown
+
+            if stale.any():
+                rows = slots[stale]
+                self._lat[rows] = lats[stale]
+                self._lon[rows] = lons[stale]
+                block = pairwise_km(self._lat[rows], self._lon[rows], self._lat, self._lon)
+                self._km[rows, :] = block
+                self._km[:, rows] = block.T
+                self.computed_rows += len(rows)
+
+            return self._km[np.ix_(slots, slots)]
+
+
+def get_distance_matrix():
+    """Return the distance matrix of the current application, creating it on first use."""
+    matrix = current_app.extensions.get(EXTENSION_KEY)
+    if matrix is None:
+        matrix = current_app.extensions.setdefault(EXTENSION_KEY, DistanceMatrix(
+            max_sites=current_app.config.get("ROUTE_MATRIX_MAX_SITES", 2000)
+        ))
+    return matrix
+
+
+@subscribe_deleted
+def _forget_deleted_machines(machine_ids):
+    if has_app_context():
+        matrix = current_app.extensions.get(EXTENSION_KEY)
+        if matrix is not None:
+            matrix.forget(machine_ids)
+
+
+# Tour construction. Node 0 is the start, the last node a zero-distance end that closes
+# the open path, so that 2-opt may also reverse the tail of the round.
+
+def _path_km(km, path):
+    return float(km[path[:-1], path[1:]].sum())
+
+
+def nearest_neighbour(km, nodes):
+    """Order nodes by repeatedly visiting the closest unvisited one, starting from node 0."""
+    path = [0]
+    remaining = np.array(nodes)
+    while len(remaining):
+        closest = int(np.argmin(km[path[-1], remaining]))
+        path.append(int(remaining[closest]))
+        remaining = np.delete(remaining, closest)
+    path.append(len(km) - 1)
+    return np.array(path)
+
+
+def two_opt(km, path, deadline=None):
+    """Reverse segments of the path while that shortens it; the first and last nodes stay put.
+
+    Stops after MAX_TWO_OPT_PASSES passes, or once time.perf_counter() reaches deadline.
+    """
+    path = path.copy()
+    n = len(path)
+    for _ in range(MAX_TWO_OPT_PASSES):
+        improved = False
+        for i in range(1, n - 2):
+            if deadline is not None and time.perf_counter() >= deadline:
+                return path
+            a, b = path[i - 1], path[i]
+            c, d = path[i + 1:n - 1], path[i + 2:n]
+            delta = km[a, c] + km[b, d] - km[a, b] - km[c, d]
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = i + 1 + best
+                path[i:j + 1] = path[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return path
+
+
+def select_sites(km, priorities, budget_km, service_km):
+    """Pick sites in priority order, each inserted where it lengthens the path least, while the budget lasts.
+
+    Returns:
+        Path of node indices (start and end nodes included)
+    """
+    path = np.array([0, len(km) - 1])
+    length = 0.0
+    for node in priorities:
+        detour = km[path[:-1], node] + km[node, path[1:]] - km[path[:-1], path[1:]]
+        position = int(np.argmin(detour))
+        if length + detour[position] + service_km * (len(path) - 1) <= budget_km:
+            path = np.insert(path, position + 1, node)
+            length += float(detour[position])
+    return path
+
+
+def plan_route(lat, lon, time_budget, speed_kmh=DEFAULT_SPEED_KMH, service_minutes=DEFAULT_SERVICE_MINUTES):
+    """Plan a collection round through machines with expired food awaiting removal.
+
+    Args:
+        lat: Start latitude in degrees
+        lon: Start longitude in degrees
+        time_budget: Minutes available for travelling and servicing
+        speed_kmh: Travel speed between sites
+        service_minutes: Minutes spent at each stop
+
+    Returns:
+        Dictionary with the ordered stops and the totals of the round
+
+    Raises:
+        RouteError: If a parameter is out of range
+    """
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise RouteError("Invalid coordinates")
+    if not 0 < time_budget <= MAX_TIME_BUDGET_MINUTES:
+        raise RouteError(f"time_budget must be between 0 and {MAX_TIME_BUDGET_MINUTES} minutes")
+    if not 0 < speed_kmh <= 200 or service_minutes < 0:
+        raise RouteError("Invalid speed_kmh or service_minutes")
+
+    deadline = time.perf_counter() + current_app.config.get("ROUTE_PLAN_SECONDS", DEFAULT_PLAN_SECONDS)
+
+    # Units past their expiry date, swept or not (the count the volunteer endpoints report)
+    expired_units = units_by_machine(expired=True).subquery()
+    sites = db.session.query(
+        Machine.id,
+        Machine.address_description,
+        Machine.location_lat,
+        Machine.location_lon,
+        expired_units.c.units.label("expired_units")
+    ).join(expired_units, Machine.id == expired_units.c.machine_id) \
+        .order_by(expired_units.c.units.desc(), Machine.id) \
+        .limit(current_app.config.get("ROUTE_MAX_SITES", 1000)) \
+        .all()
+
+    stops = []
+    path_km = 0.0
+    if sites:
+        lats = np.array([site.location_lat for site in sites], dtype=float)
+        lons = np.array([site.location_lon for site in sites], dtype=float)
+        from_start = haversine_km(lat, lon, lats, lons)
+
+        # Nodes: 0 start, 1..m sites, m + 1 end (zero distance from everywhere)
+        m = len(sites)
+        km = np.zeros((m + 2, m + 2))
+        km[1:m + 1, 1:m + 1] = get_distance_matrix().submatrix([site.id for site in sites], lats, lons)
+        km[0, 1:m + 1] = km[1:m + 1, 0] = from_start
+
+        # Most expired units first, then the closest
+        priorities = 1 + np.lexsort((from_start, -np.array([site.expired_units for site in sites])))
+        km_per_minute = speed_kmh / 60
+        selected = select_sites(km, priorities, time_budget * km_per_minute, service_minutes * km_per_minute)
+
+        if len(selected) > 2:
+            # The nearest-neighbour tour usually ends up shorter; the insertion path is
+            # the fallback that is known to fit the budget
+            path = two_opt(km, nearest_neighbour(km, selected[1:-1]), deadline)
+            if _path_km(km, path) > _path_km(km, selected):
+                path = min(path, two_opt(km, selected, deadline), key=lambda candidate: _path_km(km, candidate))
+            path_km = _path_km(km, path)
+
+            elapsed = 0.0
+            for order, (previous, node) in enumerate(zip(path[:-2], path[1:-1]), start=1):
+                site = sites[node - 1]
+                leg = float(km[previous, node])
+                elapsed += leg / km_per_minute
+                stops.append({
+                    "order": order,
+                    "machine_id": site.id,
+                    "address": site.address_description,
+                    "location_lat": site.location_lat,
+                    "location_lon": site.location_lon,
+                    "expired_item_count": site.expired_units,
+                    "leg_distance_km": round(leg, 3),
+                    "arrival_minutes": round(elapsed, 1)
+                })
+                elapsed += service_minutes
+
+    return {
+        "start": {"lat": lat, "lon": lon},
+        "time_budget_minutes": time_budget,
+        "total_distance_km": round(path_km, 3),
+        "total_minutes": round(path_km / (speed_kmh / 60) + service_minutes * len(stops), 1),
+        "expired_item_count": sum(stop["expired_item_count"] for stop in stops),
+        "sites_with_expired_food": len(sites),
+        "stops": stops
+    }
@@ -0,0 +1,280 @@
+"""
+Machine Spatial Index
+
+In-memory index of active machines for the nearest-machine locator.
+
+Coordinates and availability are held in NumPy arrays and rows are bucketed into a fixed
+latitude/longitude grid, so radius queries only measure the machines in nearby cells.
+Distances are great-circle (haversine) kilometres, and the k nearest are picked with a
+partial sort.
+
+There is one index per application and per process. It is loaded with a single query
+over machines and their inventory counters and then kept current by reloading only the
+machines that committed transactions report as changed (see services.machine_events).
+It is reloaded in full when the date changes, because items expiring overnight change
+availability without any write, and after max_age seconds to pick up writes made by other
+processes.
+"""
+
+import datetime
+import math
+import threading
+import time
+
+import numpy as np
+from flask import current_app, has_app_context
+
+from models.models import db, Machine
+from services.counters import buckets_table, units_by_machine
+from services.machine_events import subscribe
+
+EARTH_RADIUS_KM = 6371.0088
+EXTENSION_KEY = "machine_spatial_index"
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Great-circle distance in kilometres from one point to arrays of points (degrees)."""
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class MachineSpatialIndex:
+    """Grid-bucketed NumPy index over active machines and their availability."""
+
+    def __init__(self, cell_size_deg=0.5, max_age=300):
+        """Initialize an empty index.
+
+        Args:
+            cell_size_deg: Edge length of a grid cell in degrees
+            max_age: Seconds after which the index is reloaded in full
+        """
+        self.cell_size_deg = cell_size_deg
+        self.max_age = max_age
+        self._lon_cells = math.ceil(360 / cell_size_deg)
+        self._lock = threading.RLock()
+        self._dirty = set()
+        self._clear()
+
+    def _clear(self):
+        self._loaded_on = None
+        self._loaded_at = 0.0
+        self._rows = {}      # machine id -> array row
+        self._free_rows = []
+        self._cells = {}     # grid cell -> set of array rows
+        self._details = {}   # machine id -> fields returned as-is
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._lat = np.zeros(0)
+        self._lon = np.zeros(0)
+        self._space = np.zeros(0, dtype=np.int64)
+        self._food = np.zeros(0, dtype=np.int64)
+        self._live = np.zeros(0, dtype=bool)
+
+    # Maintenance
+
+    def mark_dirty(self, machine_ids):
+        """Schedule machines to be reloaded before the next query."""
+        with self._lock:
+            self._dirty.update(machine_ids)
+
+    def invalidate(self):
+        """Force a full reload before the next query."""
+        with self._lock:
+            self._loaded_on = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _cell(self, lat, lon):
+        lat_cell = math.floor((lat + 90) / self.cell_size_deg)
+        lon_cell = math.floor((lon + 180) / self.cell_size_deg) % self._lon_cells
+        return lat_cell, lon_cell
+
+    def _grow(self):
+        size = max(16, 2 * len(self._ids))
+        extra = size - len(self._ids)
+        self._ids = np.concatenate([self._ids, np.zeros(extra, dtype=np.int64)])
+        self._lat = np.concatenate([self._lat, np.zeros(extra)])
+        self._lon = np.concatenate([self._lon, np.zeros(extra)])
+        self._space = np.concatenate([self._space, np.zeros(extra, dtype=np.int64)])
+        self._food = np.concatenate([self._food, np.zeros(extra, dtype=np.int64)])
+        self._live = np.concatenate([self._live, np.zeros(extra, dtype=bool)])
+        self._free_rows.extend(range(size - 1, size - extra - 1, -1))
+
+    def _remove(self, machine_id):
+        row = self._rows.pop(machine_id, None)
+        if row is None:
+            return
+        cell = self._cell(self._lat[row], self._lon[row])
+        self._cells[cell].discard(row)
+        if not self._cells[cell]:
+            del self._cells[cell]
+        self._live[row] = False
+        self._free_rows.append(row)
+        del self._details[machine_id]
+
+    def _upsert(self, machine):
+        self._remove(machine.id)
+        if not self._free_rows:
+            self._grow()
+        row = self._free_rows.pop()
+        self._rows[machine.id] = row
+        self._ids[row] = machine.id
+        self._lat[row] = machine.location_lat
+        self._lon[row] = machine.location_lon
+        self._space[row] = machine.storage_capacity_max - machine.current_storage_level
+        self._food[row] = machine.available_food
+        self._live[row] = True
+        self._cells.setdefault(self._cell(machine.location_lat, machine.location_lon), set()).add(row)
+        self._details[machine.id] = {
+            "address_description": machine.address_description,
+            "operational_hours": machine.operational_hours
+        }
+
+    def _load(self, machine_ids=None):
+        """Query machines with their available units; all active machines if no ids given."""
+        available = units_by_machine()
+        if machine_ids is not None:
+            available = available.where(buckets_table.c.machine_id.in_(machine_ids))
+        available = available.subquery()
+
+        query = db.session.query(
+            Machine.id,
+            Machine.status,
+            Machine.location_lat,
+            Machine.location_lon,
+            Machine.address_description,
+            Machine.operational_hours,
+            Machine.storage_capacity_max,
+            Machine.current_storage_level,
+            db.func.coalesce(available.c.units, 0).label("available_food")
+        ).outerjoin(available, Machine.id == available.c.machine_id)
+        if machine_ids is None:
+            query = query.filter(Machine.status == "active")
+        else:
+            query = query.filter(Machine.id.in_(machine_ids))
+        return query.all()
+
+    def refresh(self):
+        """Bring the index up to date, reloading in full or just the changed machines."""
+        with self._lock:
+            today = datetime.date.today()
+            if self._loaded_on != today or time.monotonic() - self._loaded_at > self.max_age:
+                self._dirty.clear()
+                machines = self._load()
+                self._clear()
+                for machine in machines:
+                    self._upsert(machine)
+                self._loaded_on = today
+                self._loaded_at = time.monotonic()
+            elif self._dirty:
+                changed, self._dirty = self._dirty, set()
+                for machine_id in changed:
+                    self._remove(machine_id)
+                for machine in self._load(changed):
+                    if machine.status == "active":
+                        self._upsert(machine)
+
+    # Queries
+
+    def _candidate_rows(self, lat, lon, radius_km):
+        """Rows that may lie within radius_km, using the grid when the radius is small."""
+        all_rows = np.flatnonzero(self._live)
+        if radius_km is None:
+            return all_rows
+
+        angular = radius_km / EARTH_RADIUS_KM
+        lat_span = math.degrees(angular)
+        if lat - lat_span <= -90 or lat + lat_span >= 90 or angular >= math.pi / 2:
+            return all_rows
+        # Widest longitude reached by a spherical cap that does not contain a pole
+        ratio = math.sin(angular) / math.cos(math.radians(lat))
+        if ratio >= 1:
+            return all_rows
+        lon_span = math.degrees(math.asin(ratio))
+
+        lat_cells = range(self._cell(lat - lat_span, lon)[0], self._cell(lat + lat_span, lon)[0] + 1)
+        first_lon = math.floor((lon - lon_span + 180) / self.cell_size_deg)
+        last_lon = math.floor((lon + lon_span + 180) / self.cell_size_deg)
+        if last_lon - first_lon + 1 >= self._lon_cells:
+            lon_cells = set(range(self._lon_cells))
+        else:
+            lon_cells = {cell % self._lon_cells for cell in range(first_lon, last_lon + 1)}
+
+        if len(lat_cells) * len(lon_cells) > len(self._cells):
+            rows = [
+                row for (lat_cell, lon_cell), cell_rows in self._cells.items()
+                if lat_cell in lat_cells and lon_cell in lon_cells
+                for row in cell_rows
+            ]
+        else:
+            rows = [
+                row for lat_cell in lat_cells for lon_cell in lon_cells
+                for row in self._cells.get((lat_cell, lon_cell), ())
+            ]
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def nearest(self, lat, lon, limit=20, radius_km=None, filter_type=None):
+        """Find the nearest active machines to a point.
+
+        Args:
+            lat: Latitude in degrees
+            lon: Longitude in degrees
+            limit: Maximum number of machines to return
+            radius_km: Optional search radius in kilometres
+            filter_type: 'donor' for machines with space, 'receiver' for machines with food
+
+        Returns:
+            List of machine dictionaries ordered by distance
+        """
+        self.refresh()
+        with self._lock:
+            rows = self._candidate_rows(lat, lon, radius_km)
+            if filter_type == "donor":
+                rows = rows[self._space[rows] > 0]
+            elif filter_type == "receiver":
+                rows = rows[self._food[rows] > 0]
+
+            distances = haversine_km(lat, lon, self._lat[rows], self._lon[rows])
+            if radius_km is not None:
+                within = distances <= radius_km
+                rows, distances = rows[within], distances[within]
+            if len(rows) > limit:
+                nearest = np.argpartition(distances, limit - 1)[:limit]
+                rows, distances = rows[nearest], distances[nearest]
+            order = np.argsort(distances, kind="stable")
+
+            result = []
+            for row, distance in zip(rows[order], distances[order]):
+                machine_id = int(self._ids[row])
+                result.append({
+                    "id": machine_id,
+                    "location_lat": float(self._lat[row]),
+                    "location_lon": float(self._lon[row]),
+                    "address_description": self._details[machine_id]["address_description"],
+                    "distance": round(float(distance), 3),
+                    "available_space": int(self._space[row]),
+                    "available_food": int(self._food[row]),
+                    "operational_hours": self._details[machine_id]["operational_hours"]
+                })
+            return result
+
+
+def get_machine_index():
+    """Return the spatial index for the current application, creating it on first use."""
+    index = current_app.extensions.get(EXTENSION_KEY)
+    if index is None:
+        index = current_app.extensions.setdefault(EXTENSION_KEY, MachineSpatialIndex(
+            cell_size_deg=current_app.config.get("MACHINE_INDEX_CELL_DEGREES", 0.5),
+            max_age=current_app.config.get("MACHINE_INDEX_MAX_AGE", 300)
+        ))
+    return index
+
+
+@subscribe
+def _mark_changed_machines(machine_ids):
+    if has_app_context():
+        index = current_app.extensions.get(EXTENSION_KEY)
+        if index is not None:
+            index.mark_dirty(machine_ids)
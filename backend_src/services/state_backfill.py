@@ -0,0 +1,171 @@
+"""
+Food Item State Backfill
+
+Online migration of food_items from the boolean lifecycle flags of the released schema
+(is_dispensed, is_expired_removed) to the FoodItem.state column. Lots past their expiry
+date but still in a machine become AVAILABLE, like any other, and the expiry sweeper
+moves them to EXPIRED.
+
+upgrade_schema adds state as a nullable column, so existing rows read NULL, which every
+state-filtered query would leave out. New and updated rows are written with a state
+straight away. backfill_food_item_state walks the NULL rows (found through the
+ix_food_items_state_unset partial index) in primary key order, chunk_size rows per short
+transaction, deriving the state from the old flags; with pause it sleeps between chunks
+to leave room for live traffic. It only touches rows whose state is still NULL, so it can
+be stopped and re-run at any time.
+
+Once no NULL rows are left the inventory counters are repaired from food_items (a
+database from before the counters has none for its existing rows). The old columns are
+left in place (dropping a column rewrites the table); they are no longer read or written.
+
+create_app installs prepare_database, which runs before the application's first request
+(however it is served: `python main.py`, `flask --app main run` or a WSGI server loading
+main:app): create_all, upgrade_schema, then the backfill whenever needs_backfill() finds
+NULL rows. Requests wait until it has finished. Large databases can run the backfill
+ahead of the deploy instead, throttled, with `flask --app main backfill-food-item-state`;
+PREPARE_DATABASE=False turns the start-up step off for deployments that migrate
+separately.
+"""
+
+import logging
+import threading
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from models.models import db, FoodItem, FoodItemState, upgrade_schema
+from services.counters import verify_counters
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEY = "database_prepared"
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Old flags in order of precedence, with the state each one maps to
+LEGACY_FLAGS = (
+    ("is_dispensed", FoodItemState.DISPENSED),
+    ("is_expired_removed", FoodItemState.EXPIRED_REMOVED),
+)
+
+food_items_table = FoodItem.__table__
+
+
+def _legacy_state(flags):
+    """CASE expression deriving the state from the old flag columns that exist."""
+    if not flags:
+        return db.literal(FoodItemState.AVAILABLE)
+    # Unbound columns: the flags are no longer part of the FoodItem table metadata
+    return db.case(
+        *((db.column(name) == db.true(), state) for name, state in LEGACY_FLAGS if name in flags),
+        else_=FoodItemState.AVAILABLE
+    )
+
+
+def needs_backfill():
+    """Whether any food_items row still has no state."""
+    columns = food_items_table.c
+    return db.session.execute(db.select(columns.id).where(columns.state.is_(None)).limit(1)).first() is not None
+
+
+def backfill_batch(state, after, chunk_size):
+    """Set the state of up to chunk_size NULL-state rows with an id above after.
+
+    The caller commits.
+
+    Returns:
+        Tuple of (rows_updated, last_id); last_id is None once nothing is left
+    """
+    columns = food_items_table.c
+    ids = db.session.execute(
+        db.select(columns.id)
+        .where(columns.state.is_(None), columns.id > after)
+        .order_by(columns.id)
+        .limit(chunk_size)
+    ).scalars().all()
+    if not ids:
+        return 0, None
+    updated = db.session.execute(
+        food_items_table.update()
+        .where(columns.id.between(ids[0], ids[-1]), columns.state.is_(None))
+        .values(state=state)
+    ).rowcount
+    return updated, ids[-1]
+
+
+def backfill_food_item_state(chunk_size=DEFAULT_CHUNK_SIZE, pause=0.0):
+    """Derive FoodItem.state for every row written before the column existed.
+
+    Args:
+        chunk_size: Rows updated per transaction
+        pause: Seconds to sleep between chunks
+
+    Returns:
+        Dictionary with the number of rows and chunks backfilled and the number of
+        machines whose counters were repaired
+    """
+    inspector = db.inspect(db.engine)
+    existing = {column["name"] for column in inspector.get_columns(food_items_table.name)}
+    state = _legacy_state([name for name, _ in LEGACY_FLAGS if name in existing])
+
+    rows = chunks = 0
+    after = 0
+    while True:
+        updated, after = backfill_batch(state, after, chunk_size)
+        if after is None:
+            break
+        db.session.commit()
+        rows += updated
+        chunks += 1
+        if pause:
+            time.sleep(pause)
+
+    repaired = set()
+    if rows:
+        repaired = {entry["machine_id"] for entry in verify_counters(repair=True)}
+        db.session.commit()
+    return {"rows": rows, "chunks": chunks, "repaired_machines": len(repaired)}
+
+
+@click.command("backfill-food-item-state")
+@click.option("--chunk-size", type=click.IntRange(1), default=DEFAULT_CHUNK_SIZE, show_default=True,
+              help="Rows updated per transaction.")
+@click.option("--pause", type=click.FloatRange(0), default=0.0, show_default=True,
+              help="Seconds to sleep between chunks.")
+@with_appcontext
+def backfill_food_item_state_command(chunk_size, pause):
+    """Derive food_items.state from the old boolean flags, in chunks."""
+    result = backfill_food_item_state(chunk_size=chunk_size, pause=pause)
+    click.echo(f"Backfilled {result['rows']} row(s) in {result['chunks']} chunk(s).")
+    if result["repaired_machines"]:
+        click.echo(f"Repaired the inventory counters of {result['repaired_machines']} machine(s).")
+
+
+def prepare_database():
+    """Create missing tables, add new columns and indexes, and backfill FoodItem.state."""
+    db.create_all()
+    upgrade_schema(db.engine)
+    if needs_backfill():
+        result = backfill_food_item_state()
+        logger.warning(
+            "Backfilled FoodItem.state for %d row(s) before serving requests; repaired the counters of %d machine(s)",
+            result["rows"], result["repaired_machines"]
+        )
+
+
+def install_database_preparation(app):
+    """Run prepare_database once, before the application's first request, unless PREPARE_DATABASE is False."""
+    if not app.config.get("PREPARE_DATABASE", True):
+        return
+    lock = threading.Lock()
+
+    def prepare():
+        if EXTENSION_KEY in app.extensions:
+            return
+        with lock:
+            if EXTENSION_KEY not in app.extensions:
+                prepare_database()
+                app.extensions[EXTENSION_KEY] = True
+
+    app.before_request(prepare)
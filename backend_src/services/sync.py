@@ -0,0 +1,249 @@
+"""
+Food Sync Services
+
+Bulk reconciliation of a machine's food items for /api/food/sync.
+
+Submitted items are matched against the database with one query, updates are applied as
+one executemany UPDATE and new items as one multi-row INSERT. The machine's storage level
+and inventory counters are adjusted by the net change in units still in the machine rather
+than re-counted.
+
+Ids of lots that have been archived (services.archive) are rejected rather than created
+again.
+
+Each sync stamps the rows it touches with a new Machine.sync_version. A machine that sends
+back the last version it saw (its cursor) receives only the items changed since then.
+"""
+
+import datetime
+from sqlalchemy import bindparam
+from models.models import db, FoodItemState
+from services.inventory import food_items_table, machines_table, next_sync_version, adjust_storage_level
+from services.analytics import DailyStats
+from services.archive import archived_ids
+from services.counters import apply_counter_deltas
+from services.machine_events import record_change
+
+# Maximum number of changed items returned by one sync response
+MAX_CHANGES = 500
+
+
+def _is_active(is_dispensed, is_expired_removed):
+    return not is_dispensed and not is_expired_removed
+
+
+def _state(is_dispensed, is_expired_removed, swept=False):
+    """FoodItem.state for the flags of the sync protocol; swept lots stay EXPIRED while in the machine."""
+    if is_dispensed:
+        return FoodItemState.DISPENSED
+    if is_expired_removed:
+        return FoodItemState.EXPIRED_REMOVED
+    return FoodItemState.EXPIRED if swept else FoodItemState.AVAILABLE
+
+
+def apply_sync(machine_id, items):
+    """Apply a batch of item updates and new items submitted by a machine.
+
+    Items with an id that exists are updated (is_dispensed / is_expired_removed); items
+    without one, or with an id the backend does not know, are created. Ids belonging to
+    another machine or to an archived lot are rejected.
+
+    Args:
+        machine_id: Machine submitting the items
+        items: List of item dictionaries from the request
+
+    Returns:
+        Dictionary with synced, rejected, storage_level and version
+    """
+    if not items:
+        row = db.session.execute(
+            db.select(machines_table.c.current_storage_level, machines_table.c.sync_version)
+            .where(machines_table.c.id == machine_id)
+        ).first()
+        return {"synced": 0, "rejected": [], "storage_level": row.current_storage_level, "version": row.sync_version}
+
+    now = datetime.datetime.utcnow()
+    version = next_sync_version(machine_id)
+
+    item_ids = {item.get("id") for item in items if item.get("id")}
+    existing = {}
+    if item_ids:
+        rows = db.session.execute(
+            db.select(
+                food_items_table.c.id,
+                food_items_table.c.machine_id,
+                food_items_table.c.quantity,
+                food_items_table.c.expiry_date,
+                food_items_table.c.state,
+                food_items_table.c.dispensed_at,
+                food_items_table.c.expired_removed_at,
+                food_items_table.c.expired_at,
+                food_items_table.c.donated_at,
+            ).where(food_items_table.c.id.in_(item_ids))
+        )
+        existing = {row.id: row for row in rows}
+    archived = archived_ids(item_ids - existing.keys())
+
+    updates = {}
+    inserts = []
+    rejected = []
+    synced = 0
+    delta = 0
+    by_expiry = {}
+    dispensed = 0
+    expired_pending = 0
+    stats = DailyStats()
+    for item in items:
+        row = existing.get(item.get("id"))
+        if item.get("id") in archived:
+            rejected.append(item["id"])
+        elif row is not None:
+            if row.machine_id != machine_id:
+                rejected.append(row.id)
+                continue
+            current = updates.get(row.id) or {
+                "b_id": row.id,
+                "is_dispensed": row.state == FoodItemState.DISPENSED,
+                "dispensed_at": row.dispensed_at,
+                "is_expired_removed": row.state == FoodItemState.EXPIRED_REMOVED,
+                "expired_removed_at": row.expired_removed_at,
+            }
+            was_active = _is_active(current["is_dispensed"], current["is_expired_removed"])
+            was_dispensed = current["is_dispensed"]
+            if "is_dispensed" in item:
+                current["is_dispensed"] = bool(item["is_dispensed"])
+                if current["is_dispensed"] and current["dispensed_at"] is None:
+                    current["dispensed_at"] = now
+            if "is_expired_removed" in item:
+                current["is_expired_removed"] = bool(item["is_expired_removed"])
+                if current["is_expired_removed"] and current["expired_removed_at"] is None:
+                    current["expired_removed_at"] = now
+            is_active = _is_active(current["is_dispensed"], current["is_expired_removed"])
+            change = row.quantity * (int(is_active) - int(was_active))
+            delta += change
+            by_expiry[row.expiry_date] = by_expiry.get(row.expiry_date, 0) + change
+            swept = row.state == FoodItemState.EXPIRED or row.expired_at is not None
+            if swept:
+                expired_pending += change
+            current["state"] = _state(current["is_dispensed"], current["is_expired_removed"], swept)
+            if was_active and not is_active:
+                stats.departed(machine_id, now, row.quantity, row.donated_at, removed=not current["is_dispensed"])
+            if current["is_dispensed"] and not was_dispensed:
+                dispensed += row.quantity
+            updates[row.id] = current
+            synced += 1
+        else:
+            try:
+                expiry_date = datetime.datetime.strptime(item.get("expiry_date", ""), "%Y-%m-%d").date()
+                quantity = int(item.get("quantity", 1))
+            except (ValueError, TypeError):
+                continue
+            if quantity < 1:
+                continue
+            is_dispensed = bool(item.get("is_dispensed", False))
+            is_expired_removed = bool(item.get("is_expired_removed", False))
+            inserts.append({
+                "machine_id": machine_id,
+                "quantity": quantity,
+                "expiry_date": expiry_date,
+                "donated_at": now,
+                "state": _state(is_dispensed, is_expired_removed),
+                "dispensed_at": now if is_dispensed else None,
+                "expired_removed_at": now if is_expired_removed else None,
+                "sync_version": version,
+            })
+            stats.donated(machine_id, now, quantity)
+            if not _is_active(is_dispensed, is_expired_removed):
+                stats.departed(machine_id, now, quantity, now, removed=not is_dispensed)
+            if _is_active(is_dispensed, is_expired_removed):
+                delta += quantity
+                by_expiry[expiry_date] = by_expiry.get(expiry_date, 0) + quantity
+            if is_dispensed:
+                dispensed += quantity
+            synced += 1
+
+    if updates:
+        db.session.execute(
+            food_items_table.update()
+            .where(food_items_table.c.id == bindparam("b_id"))
+            .values(sync_version=version),
+            [
+                {key: current[key] for key in ("b_id", "state", "dispensed_at", "expired_removed_at")}
+                for current in updates.values()
+            ]
+        )
+    if inserts:
+        db.session.execute(food_items_table.insert(), inserts)
+
+    storage_level = adjust_storage_level(machine_id, delta)
+    if updates or inserts:
+        apply_counter_deltas(machine_id, by_expiry, dispensed, expired_pending=expired_pending)
+        stats.apply()
+        record_change(db.session, machine_id)
+
+    return {
+        "synced": synced,
+        "rejected": rejected,
+        "storage_level": storage_level,
+        "version": version,
+    }
+
+
+def changes_since(machine_id, since, limit=MAX_CHANGES):
+    """Return a machine's items changed after a sync version.
+
+    Whole versions are returned together, so a batch may exceed limit when one version
+    touched many items.
+
+    Args:
+        machine_id: Machine whose items are read
+        since: Last version the machine has seen
+        limit: Soft cap on the number of items returned
+
+    Returns:
+        Tuple of (list of item dictionaries, cursor, has_more)
+    """
+    columns = food_items_table.c
+    newer = db.select(columns.sync_version).where(
+        columns.machine_id == machine_id,
+        columns.sync_version > since,
+    ).order_by(columns.sync_version)
+
+    last_version = db.session.execute(newer.offset(limit - 1).limit(1)).scalar()
+    latest_version = db.session.execute(
+        db.select(db.func.max(columns.sync_version)).where(columns.machine_id == machine_id)
+    ).scalar() or since
+    if last_version is None:
+        last_version = latest_version
+
+    rows = db.session.execute(
+        db.select(
+            columns.id,
+            columns.quantity,
+            columns.expiry_date,
+            columns.donated_at,
+            columns.state,
+            columns.dispensed_at,
+            columns.expired_removed_at,
+            columns.sync_version,
+        ).where(
+            columns.machine_id == machine_id,
+            columns.sync_version > since,
+            columns.sync_version <= last_version,
+        ).order_by(columns.sync_version, columns.id)
+    )
+    changes = [
+        {
+            "id": row.id,
+            "quantity": row.quantity,
+            "expiry_date": row.expiry_date.isoformat(),
+            "donated_at": row.donated_at.isoformat() if row.donated_at else None,
+            "is_dispensed": row.state == FoodItemState.DISPENSED,
+            "dispensed_at": row.dispensed_at.isoformat() if row.dispensed_at else None,
+            "is_expired_removed": row.state == FoodItemState.EXPIRED_REMOVED,
+            "expired_removed_at": row.expired_removed_at.isoformat() if row.expired_removed_at else None,
+            "version": row.sync_version,
+        }
+        for row in rows
+    ]
+    return changes, max(last_version, since), last_version < latest_version
@@ -0,0 +1,321 @@
+"""
+Telemetry Services
+
+Ingestion, rollup and retention for machine telemetry (temperature, humidity, storage
+readings and any other numeric metric a machine reports).
+
+Raw readings are appended to telemetry_points with one multi-row INSERT per batch. The
+same batch is folded into 1-minute, 1-hour and 1-day rollups (count, sum, min, max per
+bucket) with an upsert per ROLLUP_CHUNK buckets, so rollups are always current and a
+series query never has to aggregate raw rows. Batches are limited to MAX_BATCH_POINTS
+points and MAX_BATCH_READINGS readings.
+
+Each layer is kept for its own retention period. Expired rows are deleted by
+apply_retention, which ingestion runs at most once per TELEMETRY_PRUNE_INTERVAL seconds
+per process and which is also available as `flask --app main prune-telemetry`.
+"""
+
+import datetime
+import math
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models.models import db, TelemetryPoint, TelemetryRollup
+from services.upsert import upsert
+
+points_table = TelemetryPoint.__table__
+rollups_table = TelemetryRollup.__table__
+
+# Rollup bucket sizes in seconds
+RESOLUTIONS = (60, 3600, 86400)
+RAW = 0
+
+# How long each layer is kept (RAW for telemetry_points); override with TELEMETRY_RETENTION
+DEFAULT_RETENTION = {
+    RAW: datetime.timedelta(days=2),
+    60: datetime.timedelta(days=14),
+    3600: datetime.timedelta(days=180),
+    86400: datetime.timedelta(days=1825),
+}
+
+# Limits on a single ingestion batch and on the points returned by one series query
+MAX_BATCH_POINTS = 1000
+MAX_BATCH_READINGS = 10000
+MAX_SERIES_POINTS = 1500
+
+# Point fields that are not metrics
+RESERVED_FIELDS = {"timestamp", "recorded_at", "machine_id"}
+
+# Rollup buckets per upsert statement: 8 bound parameters a row keeps a statement under
+# the 999 of older SQLite builds (and well inside MySQL's max_allowed_packet)
+ROLLUP_CHUNK = 100
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_PRUNED_AT_KEY = "telemetry_pruned_at"
+
+
+class TelemetryError(Exception):
+    """Raised when a telemetry request is malformed."""
+
+
+def parse_timestamp(value, default=None):
+    """Parse an ISO 8601 timestamp into a naive UTC datetime.
+
+    Args:
+        value: Timestamp string; timezone-aware values are converted to UTC
+        default: Returned when value is empty
+
+    Raises:
+        TelemetryError: If the value is not a valid timestamp
+    """
+    if value in (None, ""):
+        return default
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        raise TelemetryError(f"Invalid timestamp: {value}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _metric_value(value):
+    """Numeric value of a reading, or None for readings that are not numbers."""
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)) and math.isfinite(value):
+        return float(value)
+    return None
+
+
+def bucket_start(at, resolution):
+    """Start of the resolution-sized bucket containing a UTC datetime."""
+    seconds = int((at - _EPOCH).total_seconds())
+    return _EPOCH + datetime.timedelta(seconds=seconds - seconds % resolution)
+
+
+def ingest_points(machine_id, points):
+    """Store a batch of telemetry points and fold it into the rollups.
+
+    Each point is a dictionary with an optional "timestamp" (ISO 8601, defaults to now)
+    and any number of metric fields. Numeric and boolean fields become readings; other
+    fields (e.g. door_status strings) are ignored. The caller commits.
+
+    Args:
+        machine_id: Machine that reported the points
+        points: List of point dictionaries
+
+    Returns:
+        Dictionary with the number of readings accepted and points rejected
+
+    Raises:
+        TelemetryError: If the batch is not a list or exceeds MAX_BATCH_POINTS points or
+            MAX_BATCH_READINGS readings (nothing is stored then)
+    """
+    if not isinstance(points, list):
+        raise TelemetryError("points must be a list")
+    if len(points) > MAX_BATCH_POINTS:
+        raise TelemetryError(f"At most {MAX_BATCH_POINTS} points per batch")
+
+    now = datetime.datetime.utcnow()
+    readings = []
+    rejected = 0
+    for point in points:
+        if not isinstance(point, dict):
+            rejected += 1
+            continue
+        try:
+            recorded_at = parse_timestamp(point.get("timestamp", point.get("recorded_at")), now)
+        except TelemetryError:
+            rejected += 1
+            continue
+        for metric, raw_value in point.items():
+            if metric in RESERVED_FIELDS or not isinstance(metric, str) or len(metric) > 50:
+                continue
+            value = _metric_value(raw_value)
+            if value is not None:
+                readings.append({
+                    "machine_id": machine_id,
+                    "metric": metric,
+                    "recorded_at": recorded_at,
+                    "value": value,
+                })
+
+    if len(readings) > MAX_BATCH_READINGS:
+        raise TelemetryError(f"At most {MAX_BATCH_READINGS} readings per batch")
+
+    if readings:
+        db.session.execute(points_table.insert(), readings)
+
+        buckets = {}
+        for reading in readings:
+            for resolution in RESOLUTIONS:
+                key = (reading["metric"], resolution, bucket_start(reading["recorded_at"], resolution))
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = bucket = {
+                        "machine_id": machine_id,
+                        "metric": key[0],
+                        "resolution": resolution,
+                        "bucket_start": key[2],
+                        "count": 0,
+                        "total": 0.0,
+                        "min_value": reading["value"],
+                        "max_value": reading["value"],
+                    }
+                bucket["count"] += 1
+                bucket["total"] += reading["value"]
+                bucket["min_value"] = min(bucket["min_value"], reading["value"])
+                bucket["max_value"] = max(bucket["max_value"], reading["value"])
+
+        columns = rollups_table.c
+        rows = [buckets[key] for key in sorted(buckets)]
+        for start in range(0, len(rows), ROLLUP_CHUNK):
+            upsert(
+                db.session, rollups_table, rows[start:start + ROLLUP_CHUNK],
+                lambda incoming: [
+                    (columns.count, columns.count + incoming["count"]),
+                    (columns.total, columns.total + incoming["total"]),
+                    (columns.min_value, db.case(
+                        (columns.min_value <= incoming["min_value"], columns.min_value), else_=incoming["min_value"]
+                    )),
+                    (columns.max_value, db.case(
+                        (columns.max_value >= incoming["max_value"], columns.max_value), else_=incoming["max_value"]
+                    )),
+                ]
+            )
+
+    return {"accepted": len(readings), "rejected": rejected}
+
+
+def get_retention():
+    """Retention per layer for the current application (RAW and each rollup resolution)."""
+    retention = dict(DEFAULT_RETENTION)
+    retention.update(current_app.config.get("TELEMETRY_RETENTION", {}))
+    return retention
+
+
+def choose_resolution(start, end, now=None):
+    """Pick the rollup resolution for a series query.
+
+    Returns the finest resolution that covers [start, end) in at most MAX_SERIES_POINTS
+    buckets and is still retained at start, falling back to the coarsest.
+    """
+    now = now or datetime.datetime.utcnow()
+    retention = get_retention()
+    span = (end - start).total_seconds()
+    for resolution in RESOLUTIONS:
+        if span / resolution <= MAX_SERIES_POINTS and start >= now - retention[resolution]:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def query_series(machine_id, metric, start, end, resolution=None):
+    """Read one metric of one machine over [start, end).
+
+    Args:
+        machine_id: Machine to read
+        metric: Metric name
+        start: Start of the range (UTC)
+        end: End of the range (UTC)
+        resolution: RAW, one of RESOLUTIONS, or None to choose automatically
+
+    Returns:
+        Tuple of (resolution, points); each point has t, count, avg, min and max
+    """
+    if resolution is None:
+        resolution = choose_resolution(start, end)
+
+    if resolution == RAW:
+        columns = points_table.c
+        rows = db.session.execute(
+            db.select(columns.recorded_at, columns.value)
+            .where(
+                columns.machine_id == machine_id,
+                columns.metric == metric,
+                columns.recorded_at >= start,
+                columns.recorded_at < end,
+            )
+            .order_by(columns.recorded_at)
+            .limit(MAX_SERIES_POINTS)
+        )
+        return resolution, [
+            {"t": row.recorded_at.isoformat(), "count": 1, "avg": row.value, "min": row.value, "max": row.value}
+            for row in rows
+        ]
+
+    columns = rollups_table.c
+    rows = db.session.execute(
+        db.select(columns.bucket_start, columns.count, columns.total, columns.min_value, columns.max_value)
+        .where(
+            columns.machine_id == machine_id,
+            columns.metric == metric,
+            columns.resolution == resolution,
+            columns.bucket_start >= bucket_start(start, resolution),
+            columns.bucket_start < end,
+        )
+        .order_by(columns.bucket_start)
+        .limit(MAX_SERIES_POINTS)
+    )
+    return resolution, [
+        {
+            "t": row.bucket_start.isoformat(),
+            "count": row.count,
+            "avg": row.total / row.count if row.count else None,
+            "min": row.min_value,
+            "max": row.max_value
+        }
+        for row in rows
+    ]
+
+
+def apply_retention(now=None, session=None):
+    """Delete raw points and rollups older than their retention period.
+
+    Returns:
+        Dictionary of layer (RAW or resolution) -> rows deleted
+    """
+    session = session or db.session
+    now = now or datetime.datetime.utcnow()
+    retention = get_retention()
+    deleted = {
+        RAW: session.execute(
+            points_table.delete().where(points_table.c.recorded_at < now - retention[RAW])
+        ).rowcount
+    }
+    for resolution in RESOLUTIONS:
+        deleted[resolution] = session.execute(
+            rollups_table.delete().where(
+                rollups_table.c.resolution == resolution,
+                rollups_table.c.bucket_start < now - retention[resolution],
+            )
+        ).rowcount
+    return deleted
+
+
+def maybe_apply_retention():
+    """Run apply_retention in its own transaction if it has not run recently in this process.
+
+    TELEMETRY_PRUNE_INTERVAL (seconds, default 3600) sets the minimum gap; None disables
+    pruning from the request path.
+    """
+    interval = current_app.config.get("TELEMETRY_PRUNE_INTERVAL", 3600)
+    last = current_app.extensions.get(_PRUNED_AT_KEY)
+    if interval is None or (last is not None and time.monotonic() - last < interval):
+        return None
+    current_app.extensions[_PRUNED_AT_KEY] = time.monotonic()
+    with db.engine.begin() as conn:
+        return apply_retention(session=conn)
+
+
+@click.command("prune-telemetry")
+@with_appcontext
+def prune_telemetry_command():
+    """Delete telemetry older than its retention period."""
+    deleted = apply_retention()
+    db.session.commit()
+    for layer, count in deleted.items():
+        click.echo(f"{'raw' if layer == RAW else f'{layer}s rollups'}: {count} deleted")
@@ -0,0 +1,159 @@
+"""
+Verified Token Cache
+
+Remembers machine tokens that have already been verified, so token_required does not
+decode and check the signature of the same JWT on every call, and the machines known to
+exist, so it does not look the machine up either.
+
+Entries are evicted least-recently-used once the cache is full and expire after a TTL
+(never later than the token's own expiry). All tokens of a machine, and the machine
+itself, are dropped when the machine is re-registered or deleted.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+from services.machine_events import subscribe_deleted
+
+EXTENSION_KEY = "machine_token_cache"
+
+
+class TokenCache:
+    """Bounded, TTL-evicting map of verified token -> machine id, plus the set of existing machines."""
+
+    def __init__(self, max_size=10000, ttl=300):
+        """Initialize an empty cache.
+
+        Args:
+            max_size: Maximum number of tokens held
+            ttl: Seconds a verified token is trusted without re-verification
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # token -> (machine_id, valid_until)
+        self._by_machine = {}           # machine_id -> set of tokens
+        self._machines = OrderedDict()  # machine_id -> valid_until, for machines known to exist
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, token):
+        machine_id, _ = self._entries.pop(token)
+        tokens = self._by_machine.get(machine_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_machine[machine_id]
+
+    def get(self, token):
+        """Return the machine id for a verified token, or None if it must be verified."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            machine_id, valid_until = entry
+            if valid_until <= now:
+                self._drop(token)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return machine_id
+
+    def put(self, token, machine_id, token_expires_at=None):
+        """Remember a verified token.
+
+        Args:
+            token: Encoded JWT
+            machine_id: Machine the token was issued to
+            token_expires_at: The token's exp claim as a Unix timestamp, if any
+        """
+        valid_until = time.time() + self.ttl
+        if token_expires_at is not None:
+            valid_until = min(valid_until, token_expires_at)
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+            self._entries[token] = (machine_id, valid_until)
+            self._by_machine.setdefault(machine_id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def has_machine(self, machine_id):
+        """Whether a machine was recently found to exist (and has not been deleted since)."""
+        now = time.time()
+        with self._lock:
+            valid_until = self._machines.get(machine_id)
+            if valid_until is None:
+                return False
+            if valid_until <= now:
+                del self._machines[machine_id]
+                return False
+            self._machines.move_to_end(machine_id)
+            return True
+
+    def put_machine(self, machine_id):
+        """Remember that a machine exists."""
+        with self._lock:
+            self._machines[machine_id] = time.time() + self.ttl
+            self._machines.move_to_end(machine_id)
+            while len(self._machines) > self.max_size:
+                self._machines.popitem(last=False)
+
+    def invalidate_machine(self, machine_id):
+        """Forget a machine and every cached token issued to it."""
+        with self._lock:
+            self._machines.pop(machine_id, None)
+            for token in list(self._by_machine.get(machine_id, ())):
+                self._drop(token)
+                self.invalidations += 1
+
+    def discard(self, token):
+        """Forget a single token."""
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+                self.invalidations += 1
+
+    def stats(self):
+        """Return cache counters, including the hit rate over all lookups."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "machines": len(self._machines),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def get_token_cache():
+    """Return the token cache for the current application, creating it on first use."""
+    cache = current_app.extensions.get(EXTENSION_KEY)
+    if cache is None:
+        cache = current_app.extensions.setdefault(EXTENSION_KEY, TokenCache(
+            max_size=current_app.config.get("TOKEN_CACHE_SIZE", 10000),
+            ttl=current_app.config.get("TOKEN_CACHE_TTL", 300)
+        ))
+    return cache
+
+
+@subscribe_deleted
+def _forget_deleted_machines(machine_ids):
+    if has_app_context():
+        cache = current_app.extensions.get(EXTENSION_KEY)
+        if cache is not None:
+            for machine_id in machine_ids:
+                cache.invalidate_machine(machine_id)
@@ -0,0 +1,45 @@
+"""
+Upsert Helper
+
+Insert-or-combine for counter and rollup tables, using the database's native upsert
+(INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE) so any number of rows is written with
+one statement.
+"""
+
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+# Dialect name -> insert construct that supports an upsert clause
+UPSERT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+    "mysql": mysql.insert,
+    "mariadb": mysql.insert,
+}
+
+
+def upsert(session, table, rows, set_values):
+    """Insert rows, or combine each with the existing row as set_values describes.
+
+    set_values receives the incoming values of a row (the upsert's "excluded" / "inserted"
+    namespace, or the row dictionary itself) and returns an ordered list of
+    (column, expression).
+    """
+    insert = UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is None:
+        # No native upsert: update each row, inserting those that did not exist yet
+        keys = [column.name for column in table.primary_key]
+        for row in rows:
+            stmt = table.update().where(*(table.c[key] == row[key] for key in keys))
+            values = {column.name: expression for column, expression in set_values(row)}
+            if session.execute(stmt.values(values)).rowcount == 0:
+                session.execute(table.insert().values(row))
+        return
+
+    stmt = insert(table).values(rows)
+    if insert is mysql.insert:
+        stmt = stmt.on_duplicate_key_update(set_values(stmt.inserted))
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(table.primary_key), set_=dict(set_values(stmt.excluded))
+        )
+    session.execute(stmt)
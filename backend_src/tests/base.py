@@ -0,0 +1,180 @@
+"""
+base.py - Shared test case for the backend API tests
+
+Each test gets a fresh application bound to an in-memory SQLite database.
+
+Endpoints whose SQL must not grow with the fleet are checked with the statement_budget
+decorator, which runs the test on seeded datasets of increasing size.
+"""
+
+import datetime
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import has_request_context
+from sqlalchemy import event
+
+# Add backend directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import create_app
+from models.models import db, Machine, MachineCounter, MachineExpiryBucket, FoodItem, FoodItemState
+from services.response_cache import get_response_cache
+from services.spatial_index import get_machine_index
+
+# Fleet sizes the statement budgets are checked on
+DATASET_SIZES = (10, 1000, 10000)
+
+# Rows per seeding insert
+_SEED_CHUNK = 1000
+
+
+def statement_budget(budget, sizes=DATASET_SIZES):
+    """Decorate a BackendTestCase test that makes one request per call.
+
+    The test runs once per dataset size, after the fleet has been seeded up to that many
+    machines (see BackendTestCase.seed_machines) and the in-memory caches were dropped,
+    and the SQL issued by the requests it makes is counted. It fails if any run issues more than budget statements
+    or if a larger fleet needs more statements than the smallest one (an N+1 query).
+    """
+    def decorator(test):
+        @wraps(test)
+        def wrapper(self):
+            counts = {}
+            for size in sizes:
+                self.seed_machines(size)
+                self.drop_caches()
+                with self.count_statements(requests_only=True) as statements:
+                    test(self)
+                counts[size] = statements
+                self.assertLessEqual(
+                    len(statements), budget,
+                    f"{len(statements)} SQL statements with {size} machines, budget is {budget}:\n" + "\n".join(statements)
+                )
+            smallest = len(counts[sizes[0]])
+            grown = {size: len(statements) for size, statements in counts.items() if len(statements) > smallest}
+            self.assertFalse(grown, f"SQL statements grow with the fleet: {smallest} with {sizes[0]} machines, then {grown}")
+        return wrapper
+    return decorator
+
+
+class BackendTestCase(unittest.TestCase):
+    """Base class providing an application, a test client and seeding helpers."""
+
+    DATABASE_URI = "sqlite://"
+
+    def setUp(self):
+        """Create the application and an empty schema."""
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.DATABASE_URI,
+            "TESTING": True,
+            # Tests create the schema, sweep and flush heartbeats themselves
+            "PREPARE_DATABASE": False,
+            "EXPIRY_SWEEPER": False,
+            "HEARTBEAT_FLUSH_THREAD": False
+        })
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Drop the schema and release the application context."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def create_machine(self, **fields):
+        """Insert a machine and return its id."""
+        values = {
+            "location_lat": 34.05,
+            "location_lon": -118.24,
+            "address_description": "Test site",
+            "status": "active",
+            "storage_capacity_max": 100,
+            "current_storage_level": 0,
+            "operational_hours": "24/7"
+        }
+        values.update(fields)
+        machine = Machine(**values)
+        db.session.add(machine)
+        db.session.commit()
+        return machine.id
+
+    def seed_machines(self, total):
+        """Grow the fleet to total machines with bulk inserts.
+
+        Every seeded machine holds one available lot; every tenth also holds an expired
+        lot that the expiry sweeper has already moved to expired-pending-removal. The
+        inventory counters are written to match; call drop_caches before reading them.
+        """
+        start = db.session.query(db.func.count(Machine.id)).scalar()
+        today = datetime.date.today()
+        now = datetime.datetime.utcnow()
+        for first in range(start, total, _SEED_CHUNK):
+            numbers = range(first, min(first + _SEED_CHUNK, total))
+            machines = [{
+                "location_lat": 33.5 + (n % 100) * 0.01,
+                "location_lon": -118.7 + (n // 100) * 0.01,
+                "address_description": f"Seeded site {n}",
+                "status": "active",
+                "storage_capacity_max": 100,
+                "current_storage_level": 3 if n % 10 == 0 else 2,
+                "operational_hours": "24/7",
+                "last_heartbeat": now
+            } for n in numbers]
+            db.session.execute(db.insert(Machine), machines)
+            ids = db.session.scalars(
+                db.select(Machine.id).order_by(Machine.id.desc()).limit(len(machines))
+            ).all()
+            expired = [machine_id for machine_id in ids if machine_id % 10 == 0]
+
+            db.session.execute(db.insert(FoodItem), [{
+                "machine_id": machine_id, "quantity": 2, "donated_at": now,
+                "expiry_date": today + datetime.timedelta(days=3), "state": FoodItemState.AVAILABLE
+            } for machine_id in ids] + [{
+                "machine_id": machine_id, "quantity": 1, "donated_at": now,
+                "expiry_date": today - datetime.timedelta(days=1), "state": FoodItemState.EXPIRED, "expired_at": now
+            } for machine_id in expired])
+            db.session.execute(db.insert(MachineExpiryBucket), [{
+                "machine_id": machine_id, "expiry_date": today + datetime.timedelta(days=3), "units": 2
+            } for machine_id in ids] + [{
+                "machine_id": machine_id, "expiry_date": today - datetime.timedelta(days=1), "units": 1
+            } for machine_id in expired])
+            db.session.execute(db.insert(MachineCounter), [{
+                "machine_id": machine_id, "dispensed_today": 0, "expired_pending": 1
+            } for machine_id in expired])
+        db.session.commit()
+
+    def drop_caches(self):
+        """Forget cached responses and the spatial index, so the next request queries."""
+        get_response_cache().invalidate()
+        get_machine_index().invalidate()
+
+    @contextmanager
+    def count_statements(self, requests_only=False):
+        """Collect the SQL statements issued inside the block into the yielded list.
+
+        With requests_only, statements issued by the test itself (outside a request
+        handled by the test client) are left out.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not requests_only or has_request_context():
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    def auth_headers(self, machine_id):
+        """Authenticate a machine through the compatibility API and return request headers."""
+        response = self.client.post("/api/machine/auth", json={"machine_id": machine_id})
+        self.assertEqual(response.status_code, 200)
+        return {"Authorization": f"Bearer {response.get_json()['token']}"}
@@ -0,0 +1,103 @@
+"""
+test_analytics.py - Tests for the daily analytics rollups and /api/analytics/daily
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, MachineDailyStats, User
+from services.analytics import rebuild_daily_stats
+
+
+class TestDailyAnalytics(BackendTestCase):
+    """Every write path keeps the rollups in step; reports read only the rollup table."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+        self.today = datetime.utcnow().date()
+
+    def stats(self, machine_id=None):
+        row = db.session.get(MachineDailyStats, (machine_id or self.machine_id, self.today))
+        db.session.refresh(row)
+        return {name: getattr(row, name) for name in
+                ("donated_units", "dispensed_units", "expired_removed_units", "dwell_units")}
+
+    def test_write_paths_update_todays_rollup(self):
+        expiry = (date.today() + timedelta(days=3)).isoformat()
+        self.client.post("/api/food/donate", json={"expiry_date": expiry, "quantity": 5}, headers=self.headers)
+        self.client.post("/api/food/collect", json={"quantity": 2}, headers=self.headers)
+        self.assertEqual(self.stats(), {"donated_units": 5, "dispensed_units": 2, "expired_removed_units": 0, "dwell_units": 2})
+
+        old = FoodItem(machine_id=self.machine_id, expiry_date=date.today() - timedelta(days=1), quantity=3,
+                       donated_at=datetime.utcnow() - timedelta(hours=2))
+        orm = FoodItem(machine_id=self.machine_id, expiry_date=date.today() - timedelta(days=1), quantity=1)
+        synced = FoodItem(machine_id=self.machine_id, expiry_date=date.today(), quantity=4)
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add_all([old, orm, synced, volunteer])
+        db.session.commit()
+        self.assertEqual(self.stats()["donated_units"], 13)
+
+        self.client.post("/api/maintenance/expired", json={"food_item_ids": [old.id]}, headers=self.headers)
+        self.client.post(f"/api/volunteer/food_item/{orm.id}/mark_removed", json={"volunteer_id": volunteer.id})
+        self.client.post("/api/food/sync", headers=self.headers, json={"items": [
+            {"id": synced.id, "is_dispensed": True},
+            {"expiry_date": expiry, "quantity": 2},
+        ]})
+        self.assertEqual(self.stats(), {"donated_units": 15, "dispensed_units": 6, "expired_removed_units": 4, "dwell_units": 10})
+
+        row = self.client.get("/api/analytics/daily").get_json()[0]
+        self.assertEqual(row["machine_id"], self.machine_id)
+        self.assertEqual(row["day"], self.today.isoformat())
+        # 3 units spent two hours in the machine, the other 7 about no time at all
+        self.assertAlmostEqual(row["mean_time_in_machine_seconds"], 3 * 7200 / 10, delta=5)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        expiry = (date.today() + timedelta(days=3)).isoformat()
+        for quantity in (3, 4):
+            self.client.post("/api/food/donate", json={"expiry_date": expiry, "quantity": quantity}, headers=self.headers)
+        self.client.post("/api/food/collect", json={"quantity": 5}, headers=self.headers)
+        incremental = self.client.get("/api/analytics/daily").get_json()
+
+        db.session.execute(MachineDailyStats.__table__.delete())
+        self.assertEqual(rebuild_daily_stats(), 1)
+        db.session.commit()
+        self.assertEqual(self.client.get("/api/analytics/daily").get_json(), incremental)
+
+    def test_fleet_report_reads_only_rollups(self):
+        other = self.create_machine()
+        yesterday = self.today - timedelta(days=1)
+        db.session.add_all([
+            MachineDailyStats(machine_id=self.machine_id, day=yesterday, donated_units=4, dispensed_units=2,
+                              expired_removed_units=0, dwell_seconds=100.0, dwell_units=2),
+            MachineDailyStats(machine_id=other, day=yesterday, donated_units=1, dispensed_units=1,
+                              expired_removed_units=1, dwell_seconds=500.0, dwell_units=2),
+        ])
+        db.session.commit()
+
+        with self.count_statements() as statements:
+            response = self.client.get("/api/analytics/daily", query_string={
+                "start": yesterday.isoformat(), "end": self.today.isoformat(), "group_by": "day"
+            })
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("food_items", statements[0])
+        self.assertEqual(response.get_json(), [{
+            "day": yesterday.isoformat(), "donated_units": 5, "dispensed_units": 3,
+            "expired_removed_units": 1, "mean_time_in_machine_seconds": 150.0
+        }])
+
+        only_other = self.client.get("/api/analytics/daily", query_string={
+            "start": yesterday.isoformat(), "machine_id": other
+        }).get_json()
+        self.assertEqual([row["machine_id"] for row in only_other], [other])
+
+    def test_invalid_queries(self):
+        for query in ({"start": "yesterday"}, {"group_by": "week"},
+                      {"start": "2024-01-02", "end": "2024-01-01"}, {"start": "2023-01-01", "end": "2024-06-01"}):
+            self.assertEqual(self.client.get("/api/analytics/daily", query_string=query).status_code, 400, query)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+test_archive.py - Tests for moving finished food items into food_items_archive
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemArchive, FoodItemState, MachineDailyStats
+from services.analytics import rebuild_daily_stats
+from services.archive import archive_finished_items
+from services.counters import verify_counters
+
+
+class TestArchive(BackendTestCase):
+    """Old finished lots leave food_items in batches; history reads still see them."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        long_ago = datetime.utcnow() - timedelta(days=40)
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        expiry = date.today() + timedelta(days=3)
+        lots = [
+            FoodItem(machine_id=self.machine_id, expiry_date=expiry, quantity=2, donated_at=long_ago,
+                     state=FoodItemState.DISPENSED, dispensed_at=long_ago)
+            for _ in range(5)
+        ] + [
+            FoodItem(machine_id=self.machine_id, expiry_date=expiry, donated_at=long_ago,
+                     state=FoodItemState.EXPIRED_REMOVED, expired_removed_at=long_ago),
+            # Finished recently, and still in the machine
+            FoodItem(machine_id=self.machine_id, expiry_date=expiry, donated_at=long_ago,
+                     state=FoodItemState.DISPENSED, dispensed_at=yesterday),
+            FoodItem(machine_id=self.machine_id, expiry_date=expiry, quantity=3, donated_at=long_ago),
+        ]
+        db.session.add_all(lots)
+        db.session.commit()
+        self.ids = [lot.id for lot in lots]
+
+    def history(self):
+        return self.client.get("/api/export/food_items").get_data(as_text=True)
+
+    def test_archives_old_finished_lots_in_batches(self):
+        exported = self.history()
+        listed = self.client.get(f"/api/machines/{self.machine_id}/food_items", query_string={"state": "all"}).get_json()
+        rollups = rebuild_daily_stats()
+        mismatches = verify_counters()
+
+        self.assertEqual(archive_finished_items(timedelta(days=30), batch_size=4), {"lots": 6, "batches": 2})
+        self.assertEqual(db.session.scalars(db.select(FoodItem.id).order_by(FoodItem.id)).all(), self.ids[6:])
+        archived = db.session.get(FoodItemArchive, self.ids[5])
+        self.assertEqual((archived.state, archived.machine_id), (FoodItemState.EXPIRED_REMOVED, self.machine_id))
+        self.assertIsNotNone(archived.archived_at)
+        self.assertEqual(verify_counters(), mismatches)
+
+        # History reads span both tables
+        self.assertEqual(self.history(), exported)
+        self.assertEqual(self.client.get(
+            f"/api/machines/{self.machine_id}/food_items", query_string={"state": "all"}
+        ).get_json(), listed)
+        page = self.client.get(f"/api/machines/{self.machine_id}/food_items",
+                               query_string={"state": "all", "after": self.ids[3], "limit": 2})
+        self.assertEqual([item["id"] for item in page.get_json()], self.ids[4:6])
+        self.assertEqual(page.headers["X-Next-After"], str(self.ids[5]))
+        self.assertEqual(rebuild_daily_stats(), rollups)
+        dispensed = db.session.scalar(db.select(db.func.sum(MachineDailyStats.dispensed_units)))
+        self.assertEqual(dispensed, 11)
+
+        self.assertEqual(archive_finished_items(timedelta(days=30)), {"lots": 0, "batches": 0})
+
+    def test_sync_rejects_archived_ids(self):
+        archive_finished_items(timedelta(days=30))
+        response = self.client.post("/api/food/sync", json={"items": [{"id": self.ids[0], "is_dispensed": True}]},
+                                    headers=self.auth_headers(self.machine_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["rejected_items"], [self.ids[0]])
+        self.assertEqual(db.session.scalar(db.select(db.func.count()).select_from(FoodItem)), 2)
+
+    def donate(self):
+        response = self.client.post("/api/food/donate", json={
+            "quantity": 1, "expiry_date": (date.today() + timedelta(days=2)).isoformat()
+        }, headers=self.auth_headers(self.machine_id))
+        self.assertEqual(response.status_code, 200, response.get_json())
+        return response.get_json()["lot_id"]
+
+    def finish_last_lot(self):
+        # Make the highest id an old finished lot
+        lot = db.session.get(FoodItem, self.ids[-1])
+        lot.state = FoodItemState.DISPENSED
+        lot.dispensed_at = datetime.utcnow() - timedelta(days=40)
+        db.session.commit()
+
+    def test_archived_ids_are_not_reused(self):
+        self.finish_last_lot()
+        self.assertEqual(archive_finished_items(timedelta(days=30))["lots"], 7)
+        new_id = self.donate()
+        self.assertGreater(new_id, self.ids[-1])
+
+        listed = self.client.get(f"/api/machines/{self.machine_id}/food_items", query_string={"state": "all"}).get_json()
+        ids = [item["id"] for item in listed]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(archive_finished_items(timedelta(days=30)), {"lots": 0, "batches": 0})
+
+    def test_keeps_the_highest_id_without_autoincrement(self):
+        # food_items as created before it used AUTOINCREMENT
+        create = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'food_items'")).scalar()
+        db.session.execute(db.text("ALTER TABLE food_items RENAME TO food_items_old"))
+        db.session.execute(db.text(create.replace("AUTOINCREMENT", "")))
+        db.session.execute(db.text("INSERT INTO food_items SELECT * FROM food_items_old"))
+        db.session.execute(db.text("DROP TABLE food_items_old"))
+        db.session.commit()
+        self.finish_last_lot()
+
+        self.assertEqual(archive_finished_items(timedelta(days=30))["lots"], 6)
+        self.assertIsNotNone(db.session.get(FoodItem, self.ids[-1]))
+        self.assertGreater(self.donate(), self.ids[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
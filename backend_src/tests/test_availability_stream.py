@@ -0,0 +1,104 @@
+"""
+test_availability_stream.py - Tests for the /api/public/stream server-sent events
+"""
+
+import json
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine
+from services.availability_stream import get_availability_stream
+
+
+class TestAvailabilityStream(BackendTestCase):
+    """Committed changes become filtered, resumable availability events."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(STREAM_KEEPALIVE=0.01, STREAM_MAX_DURATION=0.05)
+        self.stream = get_availability_stream()
+
+    def read_events(self, query="", last_event_id=0):
+        """Read the stream until it ends and return (event, id, data) tuples."""
+        headers = {} if last_event_id is None else {"Last-Event-ID": str(last_event_id)}
+        response = self.client.get(f"/api/public/stream{query}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = []
+        for block in response.get_data(as_text=True).split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if line and not line.startswith(":"))
+            if "event" in fields:
+                events.append((fields["event"], int(fields["id"]), json.loads(fields["data"])))
+        return events
+
+    def donate(self, machine_id, quantity):
+        response = self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": (date.today() + timedelta(days=3)).isoformat(), "quantity": quantity}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_commits_publish_deltas(self):
+        machine_id = self.create_machine(storage_capacity_max=10)
+        self.donate(machine_id, 4)
+        self.client.post("/api/food/collect", json={"quantity": 1}, headers=self.auth_headers(machine_id))
+        self.client.put(f"/api/machines/{machine_id}/status", json={"status": "maintenance"})
+
+        events = self.read_events()
+        self.assertEqual([event for event, _, _ in events], ["status", "availability", "availability", "status"])
+        self.assertEqual([event_id for _, event_id, _ in events], [1, 2, 3, 4])
+        self.assertEqual(events[1][2], {
+            "machine_id": machine_id, "available_items": 4, "available_space": 6, "status": "active"
+        })
+        self.assertEqual(events[3][2]["status"], "maintenance")
+        self.assertEqual(events[3][2]["available_items"], 3)
+
+    def test_unchanged_machines_are_not_published(self):
+        machine_id = self.create_machine()
+        self.client.put(f"/api/machines/{machine_id}/status", json={"status": "active"})
+        self.client.post(f"/api/machines/{machine_id}/heartbeat")
+        self.assertEqual(self.stream.last_id, 1)
+
+    def test_topic_and_bbox_filters(self):
+        near = self.create_machine(location_lat=34.0, location_lon=-118.0)
+        far = self.create_machine(location_lat=40.7, location_lon=-74.0)
+        self.donate(near, 1)
+        self.donate(far, 1)
+
+        events = self.read_events("?topic=availability&bbox=-119,33,-117,35")
+        self.assertEqual([data["machine_id"] for _, _, data in events], [near, near])
+        self.assertEqual(self.read_events("?topic=status,removed&bbox=-75,40,-73,41")[0][2]["machine_id"], far)
+
+        self.assertEqual(self.client.get("/api/public/stream?topic=weather").status_code, 400)
+        self.assertEqual(self.client.get("/api/public/stream?bbox=1,2,3").status_code, 400)
+        self.assertEqual(self.client.get("/api/public/stream", headers={"Last-Event-ID": "x"}).status_code, 400)
+
+    def test_resume_from_last_event_id(self):
+        machine_id = self.create_machine()
+        self.donate(machine_id, 1)
+        self.donate(machine_id, 2)
+        events = self.read_events(last_event_id=2)
+        self.assertEqual([(event_id, data["available_items"]) for _, event_id, data in events], [(3, 3)])
+        self.assertEqual(self.read_events(last_event_id=3), [])
+
+        # A new connection without Last-Event-ID only gets events from now on
+        self.assertEqual(self.read_events(last_event_id=None), [])
+
+    def test_reset_when_events_are_gone(self):
+        machine_id = self.create_machine()
+        self.stream._events = type(self.stream._events)(self.stream._events, maxlen=2)
+        for _ in range(3):
+            self.donate(machine_id, 1)
+        self.assertEqual(self.read_events(last_event_id=1)[0][:2], ("reset", 4))
+        self.assertEqual(self.read_events(last_event_id=99)[0][:2], ("reset", 4))
+
+    def test_deleted_machine_publishes_removal(self):
+        machine_id = self.create_machine()
+        db.session.delete(db.session.get(Machine, machine_id))
+        db.session.commit()
+        self.assertEqual(self.read_events()[-1], ("removed", 2, {"machine_id": machine_id, "status": "removed"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+test_bulk_removal.py - Tests for POST /api/volunteer/food_items/mark_removed
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState, Machine, MachineDailyStats, User
+from services.counters import machine_counts, verify_counters
+from services.expiry_sweeper import sweep_expired
+
+
+class TestBulkRemoval(BackendTestCase):
+    """One request removes lots across machines and reports an outcome per lot."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_ids = [self.create_machine(), self.create_machine()]
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(volunteer)
+        db.session.commit()
+        self.volunteer_id = volunteer.id
+
+    def add_lot(self, machine_id, quantity, days_to_expiry=-1, **fields):
+        lot = FoodItem(machine_id=machine_id, expiry_date=date.today() + timedelta(days=days_to_expiry),
+                       quantity=quantity, **fields)
+        db.session.add(lot)
+        if not fields:
+            db.session.get(Machine, machine_id).current_storage_level += quantity
+        db.session.commit()
+        return lot.id
+
+    def remove(self, item_ids, volunteer_id=None):
+        return self.client.post("/api/volunteer/food_items/mark_removed", json={
+            "volunteer_id": volunteer_id or self.volunteer_id, "food_item_ids": item_ids
+        })
+
+    def test_removes_lots_across_machines(self):
+        first, second = self.machine_ids
+        lots = [self.add_lot(first, 2), self.add_lot(first, 3, days_to_expiry=-2), self.add_lot(second, 4)]
+        kept = self.add_lot(first, 5, days_to_expiry=3)
+        dispensed = self.add_lot(second, 1, state=FoodItemState.DISPENSED, dispensed_at=datetime.utcnow())
+        sweep_expired()
+
+        response = self.remove(lots + [dispensed, 999999, lots[0]])
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body["removed_count"], 3)
+        self.assertEqual(body["results"], [
+            {"food_item_id": lots[0], "status": "removed"},
+            {"food_item_id": lots[1], "status": "removed"},
+            {"food_item_id": lots[2], "status": "removed"},
+            {"food_item_id": dispensed, "status": "already_dispensed"},
+            {"food_item_id": 999999, "status": "not_found"},
+        ])
+        self.assertEqual(body["machines"], [
+            {"machine_id": first, "new_storage_level": 5},
+            {"machine_id": second, "new_storage_level": 0},
+        ])
+
+        db.session.expire_all()
+        item = db.session.get(FoodItem, lots[1])
+        self.assertEqual(item.state, FoodItemState.EXPIRED_REMOVED)
+        self.assertEqual(item.expired_removed_by_volunteer_id, self.volunteer_id)
+        self.assertEqual(item.sync_version, db.session.get(Machine, first).sync_version)
+        self.assertNotEqual(db.session.get(FoodItem, kept).state, FoodItemState.EXPIRED_REMOVED)
+        self.assertEqual(machine_counts(first)["expired_pending"], 0)
+        self.assertEqual(machine_counts(first)["available"], 5)
+        self.assertEqual(db.session.get(MachineDailyStats, (second, datetime.utcnow().date())).expired_removed_units, 4)
+        self.assertEqual(verify_counters(), [])
+
+        again = self.remove([lots[0]]).get_json()
+        self.assertEqual((again["results"][0]["status"], again["machines"]), ("already_removed", []))
+
+    def test_statement_count_does_not_grow_with_the_batch(self):
+        few = [self.add_lot(self.machine_ids[0], 1)]
+        many = [self.add_lot(machine_id, 1) for machine_id in self.machine_ids for _ in range(20)]
+        counts = []
+        for item_ids in (few, many):
+            with self.count_statements() as statements:
+                self.assertEqual(self.remove(item_ids).status_code, 200)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_rejects_invalid_requests(self):
+        lot = self.add_lot(self.machine_ids[0], 1)
+        other = User(username="admin", password_hash="x", role="admin")
+        db.session.add(other)
+        db.session.commit()
+
+        self.assertEqual(self.remove([lot], volunteer_id=other.id).status_code, 401)
+        for item_ids in ([], "1,2", [lot, "x"], [True], list(range(1, 502))):
+            self.assertEqual(self.remove(item_ids).status_code, 400, item_ids)
+        self.assertEqual(self.client.post("/api/volunteer/food_items/mark_removed", json={"food_item_ids": [lot]}).status_code, 400)
+        db.session.expire_all()
+        self.assertNotEqual(db.session.get(FoodItem, lot).state, FoodItemState.EXPIRED_REMOVED)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+test_collect.py - Tests for first-expired-first-out dispensing
+
+Covers the compatibility /api/food/collect endpoint and /api/machines/<id>/dispense_food.
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem, FoodItemState
+
+
+class TestCollect(BackendTestCase):
+    """Test cases for the FEFO collect engine."""
+
+    def donate(self, machine_id, quantity, days_to_expiry):
+        expiry = (date.today() + timedelta(days=days_to_expiry)).isoformat()
+        response = self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": expiry, "quantity": quantity}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()["lot_id"]
+
+    def test_collect_takes_soonest_lots_first(self):
+        machine_id = self.create_machine()
+        late_lot = self.donate(machine_id, 2, days_to_expiry=9)
+        early_lot = self.donate(machine_id, 2, days_to_expiry=1)
+
+        response = self.client.post(
+            "/api/food/collect", json={"quantity": 2}, headers=self.auth_headers(machine_id)
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body["items_dispensed"], [early_lot])
+        self.assertEqual(body["quantity_dispensed"], 2)
+        self.assertEqual(body["new_storage_level"], 2)
+        self.assertNotEqual(db.session.get(FoodItem, late_lot).state, FoodItemState.DISPENSED)
+
+    def test_collect_splits_a_partially_used_lot(self):
+        machine_id = self.create_machine()
+        lot_id = self.donate(machine_id, 5, days_to_expiry=2)
+
+        response = self.client.post(
+            "/api/food/collect", json={"quantity": 2}, headers=self.auth_headers(machine_id)
+        )
+        self.assertEqual(response.status_code, 200)
+        split_id = response.get_json()["items_dispensed"][0]
+
+        lot = db.session.get(FoodItem, lot_id)
+        split = db.session.get(FoodItem, split_id)
+        self.assertEqual((lot.quantity, lot.state), (3, FoodItemState.AVAILABLE))
+        self.assertEqual((split.quantity, split.state), (2, FoodItemState.DISPENSED))
+        self.assertEqual(split.expiry_date, lot.expiry_date)
+        self.assertEqual(db.session.get(Machine, machine_id).current_storage_level, 3)
+
+    def test_collect_returns_what_is_available(self):
+        machine_id = self.create_machine()
+        self.donate(machine_id, 1, days_to_expiry=1)
+        self.donate(machine_id, 2, days_to_expiry=2)
+        headers = self.auth_headers(machine_id)
+
+        response = self.client.post("/api/food/collect", json={"quantity": 10}, headers=headers)
+        self.assertEqual(response.get_json()["quantity_dispensed"], 3)
+        self.assertEqual(response.get_json()["new_storage_level"], 0)
+
+        response = self.client.post("/api/food/collect", json={"quantity": 1}, headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_dispense_food_dispenses_one_unit(self):
+        machine_id = self.create_machine()
+        lot_id = self.donate(machine_id, 4, days_to_expiry=3)
+
+        response = self.client.post(f"/api/machines/{machine_id}/dispense_food")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["new_storage_level"], 3)
+        self.assertEqual(db.session.get(FoodItem, lot_id).quantity, 3)
+
+
+class TestConcurrentCollect(BackendTestCase):
+    """Concurrent collections against a file-backed database."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.DATABASE_URI = f"sqlite:///{os.path.join(self.tmpdir.name, 'collect.db')}"
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def test_parallel_collects_never_share_units(self):
+        machine_id = self.create_machine()
+        expiry = date.today() + timedelta(days=2)
+        db.session.add_all([FoodItem(machine_id=machine_id, expiry_date=expiry, quantity=1) for _ in range(20)])
+        db.session.get(Machine, machine_id).current_storage_level = 20
+        db.session.commit()
+        headers = self.auth_headers(machine_id)
+
+        barrier = threading.Barrier(4)
+        results = []
+
+        def worker():
+            client = self.app.test_client()
+            barrier.wait()
+            for _ in range(4):
+                response = client.post("/api/food/collect", json={"quantity": 2}, headers=headers)
+                if response.status_code == 200:
+                    results.append(response.get_json()["items_dispensed"])
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        dispensed = [item_id for batch in results for item_id in batch]
+        self.assertEqual(len(dispensed), len(set(dispensed)))
+        db.session.expire_all()
+        self.assertEqual(FoodItem.query.filter_by(state=FoodItemState.DISPENSED).count(), len(dispensed))
+        self.assertEqual(
+            db.session.get(Machine, machine_id).current_storage_level,
+            20 - len(dispensed)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
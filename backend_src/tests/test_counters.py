@@ -0,0 +1,184 @@
+"""
+test_counters.py - Tests for the per-machine inventory counters and their verification
+"""
+
+import os
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem, FoodItemState, MachineCounter, MachineExpiryBucket, User
+from services import counters
+from services.counters import machine_counts, verify_counters
+from services.upsert import UPSERT_INSERTS
+
+
+class TestInventoryCounters(BackendTestCase):
+    """Write paths keep the counters equal to what food_items implies."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+        self.soon = date.today() + timedelta(days=2)
+        self.later = date.today() + timedelta(days=5)
+
+    def donate(self, quantity, expiry):
+        response = self.client.post(
+            f"/api/machines/{self.machine_id}/report_donation",
+            json={"expiry_date": expiry.isoformat(), "quantity": quantity}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()["lot_id"]
+
+    def assert_no_drift(self):
+        self.assertEqual(verify_counters(), [])
+
+    def test_donate_and_collect(self):
+        self.donate(3, self.soon)
+        self.donate(4, self.later)
+        self.assertEqual(machine_counts(self.machine_id)["buckets"], [
+            {"expiry_date": self.soon.isoformat(), "units": 3},
+            {"expiry_date": self.later.isoformat(), "units": 4},
+        ])
+
+        response = self.client.post("/api/food/collect", json={"quantity": 5}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        counts = machine_counts(self.machine_id)
+        self.assertEqual(counts["available"], 2)
+        self.assertEqual(counts["dispensed_today"], 5)
+        self.assertEqual(counts["buckets"], [{"expiry_date": self.later.isoformat(), "units": 2}])
+        self.assert_no_drift()
+
+    def test_removal_and_sync(self):
+        expired = FoodItem(machine_id=self.machine_id, expiry_date=date.today() - timedelta(days=1), quantity=2)
+        db.session.add(expired)
+        db.session.get(Machine, self.machine_id).current_storage_level = 2
+        db.session.commit()
+        self.assertEqual(machine_counts(self.machine_id)["expired"], 2)
+
+        lot_id = self.donate(3, self.soon)
+        self.client.post("/api/maintenance/expired", json={"food_item_ids": [expired.id]}, headers=self.headers)
+        self.client.post("/api/food/sync", json={"items": [
+            {"id": lot_id, "is_dispensed": True},
+            {"expiry_date": self.later.isoformat(), "quantity": 6},
+        ]}, headers=self.headers)
+
+        counts = machine_counts(self.machine_id)
+        self.assertEqual((counts["available"], counts["expired"], counts["dispensed_today"]), (6, 0, 3))
+        self.assert_no_drift()
+
+    def test_orm_changes_are_counted(self):
+        lot_id = self.donate(2, self.soon)
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(volunteer)
+        db.session.commit()
+
+        self.client.post(f"/api/volunteer/food_item/{lot_id}/mark_removed", json={"volunteer_id": volunteer.id})
+        self.assertEqual(machine_counts(self.machine_id)["available"], 0)
+
+        lot = FoodItem(machine_id=self.machine_id, expiry_date=self.soon, quantity=4)
+        db.session.add(lot)
+        db.session.commit()
+        lot.expiry_date = self.later
+        db.session.commit()
+        self.assertEqual(machine_counts(self.machine_id)["buckets"], [{"expiry_date": self.later.isoformat(), "units": 4}])
+
+        db.session.delete(lot)
+        db.session.get(Machine, self.machine_id).current_storage_level = 0
+        db.session.commit()
+        self.assertEqual(machine_counts(self.machine_id)["buckets"], [])
+        self.assert_no_drift()
+
+    def test_dispensed_today_restarts_each_day(self):
+        self.donate(3, self.soon)
+        db.session.add(MachineCounter(
+            machine_id=self.machine_id, dispensed_on=date.today() - timedelta(days=1), dispensed_today=9
+        ))
+        db.session.commit()
+        self.assertEqual(machine_counts(self.machine_id)["dispensed_today"], 0)
+
+        self.client.post("/api/food/collect", json={"quantity": 2}, headers=self.headers)
+        self.assertEqual(machine_counts(self.machine_id)["dispensed_today"], 2)
+
+    def test_dispensed_today_follows_the_local_date(self):
+        # Fourteen hours ahead of UTC the two dates differ for most of the day
+        self.addCleanup(time.tzset)
+        with mock.patch.dict(os.environ, {"TZ": "Etc/GMT-14"}):
+            time.tzset()
+            self.donate(3, self.soon)
+            self.client.post("/api/food/collect", json={"quantity": 2}, headers=self.headers)
+            self.assertEqual(db.session.get(MachineCounter, self.machine_id).dispensed_on, date.today())
+            self.assertEqual(machine_counts(self.machine_id)["dispensed_today"], 2)
+            self.assert_no_drift()
+
+    def test_fallback_without_native_upsert(self):
+        with mock.patch.dict(UPSERT_INSERTS, clear=True):
+            self.donate(3, self.soon)
+            self.donate(1, self.soon)
+            self.client.post("/api/food/collect", json={"quantity": 4}, headers=self.headers)
+        self.assertEqual(machine_counts(self.machine_id)["dispensed_today"], 4)
+        self.assert_no_drift()
+
+    def test_get_machine_reports_counts(self):
+        self.donate(3, self.soon)
+        body = self.client.get(f"/api/machines/{self.machine_id}").get_json()
+        self.assertEqual(body["available_food_count"], 3)
+        self.assertEqual(body["expired_food_count"], 0)
+        self.assertEqual(body["dispensed_today"], 0)
+
+
+class TestVerifyCounters(BackendTestCase):
+    """Drift between the counters and food_items is reported and repaired."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.expiry = date.today() + timedelta(days=3)
+        db.session.add_all([
+            FoodItem(machine_id=self.machine_id, expiry_date=self.expiry, quantity=3),
+            FoodItem(
+                machine_id=self.machine_id, expiry_date=self.expiry, quantity=1,
+                state=FoodItemState.DISPENSED, dispensed_at=datetime.utcnow()
+            ),
+        ])
+        db.session.get(Machine, self.machine_id).current_storage_level = 3
+        db.session.commit()
+
+    def corrupt(self):
+        db.session.execute(counters.buckets_table.update().values(units=7))
+        db.session.execute(counters.counters_table.delete())
+        db.session.get(Machine, self.machine_id).current_storage_level = 10
+        db.session.commit()
+
+    def test_detects_and_repairs_drift(self):
+        self.assertEqual(verify_counters(), [])
+        self.corrupt()
+
+        drift = verify_counters(repair=True)
+        self.assertEqual({entry["counter"] for entry in drift}, {
+            f"units expiring {self.expiry.isoformat()}", "dispensed_today", "current_storage_level"
+        })
+        db.session.commit()
+
+        self.assertEqual(verify_counters(), [])
+        self.assertEqual(db.session.get(MachineExpiryBucket, (self.machine_id, self.expiry)).units, 3)
+        self.assertEqual(db.session.get(Machine, self.machine_id).current_storage_level, 3)
+
+    def test_cli_command(self):
+        runner = self.app.test_cli_runner()
+        self.assertEqual(runner.invoke(args=["verify-counters"]).exit_code, 0)
+
+        self.corrupt()
+        self.assertEqual(runner.invoke(args=["verify-counters"]).exit_code, 1)
+        result = runner.invoke(args=["verify-counters", "--repair"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Repaired 1 machine(s).", result.output)
+        self.assertEqual(verify_counters(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+test_donation.py - Tests for lot-based donation ingestion
+
+Covers /api/machines/<id>/report_donation and the compatibility /api/food/donate endpoint.
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem
+
+
+class TestDonationIngestion(BackendTestCase):
+    """Test cases for donation ingestion."""
+
+    def setUp(self):
+        super().setUp()
+        self.expiry = (date.today() + timedelta(days=3)).isoformat()
+
+    def test_donation_is_stored_as_one_lot(self):
+        machine_id = self.create_machine()
+        response = self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": self.expiry, "quantity": 50}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["new_storage_level"], 50)
+
+        lots = FoodItem.query.filter_by(machine_id=machine_id).all()
+        self.assertEqual(len(lots), 1)
+        self.assertEqual(lots[0].quantity, 50)
+        self.assertEqual(response.get_json()["lot_id"], lots[0].id)
+        self.assertEqual(db.session.get(Machine, machine_id).current_storage_level, 50)
+
+    def test_compat_donation_is_stored_as_one_lot(self):
+        machine_id = self.create_machine(current_storage_level=10)
+        response = self.client.post(
+            "/api/food/donate",
+            json={"expiry_date": self.expiry, "quantity": 5},
+            headers=self.auth_headers(machine_id)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["new_storage_level"], 15)
+        self.assertEqual(FoodItem.query.filter_by(machine_id=machine_id).count(), 1)
+
+    def test_overflowing_donation_writes_nothing(self):
+        machine_id = self.create_machine(storage_capacity_max=10, current_storage_level=8)
+        response = self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": self.expiry, "quantity": 3}
+        )
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(FoodItem.query.count(), 0)
+        self.assertEqual(db.session.get(Machine, machine_id).current_storage_level, 8)
+
+    def test_donation_to_full_or_inactive_machine_is_rejected(self):
+        full_id = self.create_machine(storage_capacity_max=10, current_storage_level=10)
+        inactive_id = self.create_machine(status="maintenance")
+
+        response = self.client.post(
+            f"/api/machines/{full_id}/report_donation",
+            json={"expiry_date": self.expiry, "quantity": 1}
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.get_json()["error"], "Machine storage is full")
+
+        response = self.client.post(
+            "/api/food/donate",
+            json={"expiry_date": self.expiry, "quantity": 1},
+            headers=self.auth_headers(inactive_id)
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.get_json()["error"], "Machine not active")
+
+        response = self.client.post(
+            "/api/machines/999/report_donation",
+            json={"expiry_date": self.expiry, "quantity": 1}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_quantity_is_rejected(self):
+        machine_id = self.create_machine()
+        for quantity in (0, -3):
+            response = self.client.post(
+                f"/api/machines/{machine_id}/report_donation",
+                json={"expiry_date": self.expiry, "quantity": quantity}
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json(), {"error": "quantity must be a positive integer"})
+            response = self.client.post(
+                "/api/food/donate",
+                json={"expiry_date": self.expiry, "quantity": quantity},
+                headers=self.auth_headers(machine_id)
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json(), {"error": "quantity must be a positive integer"})
+        self.assertEqual(FoodItem.query.count(), 0)
+
+    def test_lot_quantities_are_counted_as_units(self):
+        machine_id = self.create_machine()
+        self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": self.expiry, "quantity": 7}
+        )
+        response = self.client.get(f"/api/machines/{machine_id}")
+        self.assertEqual(response.get_json()["available_food_count"], 7)
+
+        response = self.client.get("/api/public/machines_for_receivers")
+        self.assertEqual(response.get_json()[0]["available_food_items"], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+test_engine_profiles.py - Tests for the environment-selected database engine profiles
+"""
+
+import os
+import tempfile
+import unittest
+
+from config import ConfigError, database_config
+from main import create_app
+from models.models import db
+
+
+class TestEngineProfiles(unittest.TestCase):
+    """database_config builds per-profile settings and SQLite pragmas are applied on connect."""
+
+    def test_default_profile_is_tuned_sqlite(self):
+        config = database_config({})
+        self.assertEqual(config["DATABASE_PROFILE"], "sqlite")
+        self.assertEqual(config["SQLALCHEMY_DATABASE_URI"], "sqlite:///exes_food.db")
+        self.assertEqual(config["SQLITE_PRAGMAS"]["journal_mode"], "WAL")
+        self.assertEqual(config["SQLITE_PRAGMAS"]["synchronous"], "NORMAL")
+
+    def test_mysql_profile_sizes_the_pool(self):
+        config = database_config({
+            "DATABASE_PROFILE": "mysql",
+            "DATABASE_URL": "mysql+pymysql://app:secret@db/exes",
+            "DB_POOL_SIZE": "15"
+        })
+        options = config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.assertEqual(config["SQLALCHEMY_DATABASE_URI"], "mysql+pymysql://app:secret@db/exes")
+        self.assertEqual(options["pool_size"], 15)
+        self.assertEqual(options["max_overflow"], 20)
+        self.assertEqual(options["pool_recycle"], 1800)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(config["SQLITE_PRAGMAS"], {})
+
+    def test_invalid_environment_is_rejected(self):
+        with self.assertRaises(ConfigError):
+            database_config({"DATABASE_PROFILE": "oracle"})
+        with self.assertRaises(ConfigError):
+            database_config({"DATABASE_PROFILE": "mysql"})
+        with self.assertRaises(ConfigError):
+            database_config({"SQLITE_BUSY_TIMEOUT_MS": "soon"})
+
+    def pragmas_for(self, profile):
+        with tempfile.TemporaryDirectory() as tmp:
+            uri = f"sqlite:///{os.path.join(tmp, 'profile.db')}"
+            app = create_app(database_config({"DATABASE_PROFILE": profile, "DATABASE_URL": uri}))
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    values = {
+                        name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+                        for name in ("journal_mode", "busy_timeout", "synchronous")
+                    }
+                db.engine.dispose()
+        return values
+
+    def test_sqlite_pragmas_applied_on_connect(self):
+        # synchronous: 1 = NORMAL, 2 = FULL
+        self.assertEqual(self.pragmas_for("sqlite"), {"journal_mode": "wal", "busy_timeout": 5000, "synchronous": 1})
+        self.assertEqual(self.pragmas_for("sqlite-plain")["journal_mode"], "delete")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+test_expiry_sweeper.py - Tests for moving expired lots into expired-pending-removal
+"""
+
+import time
+import unittest
+from datetime import date, datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState, Machine, MachineCounter, User
+from services.counters import machine_counts, verify_counters
+from services.expiry_sweeper import EXTENSION_KEY, ExpirySweeper, install_expiry_sweeper, sweep_expired
+
+
+class TestExpirySweeper(BackendTestCase):
+    """The sweeper moves expired lots in batches and keeps expired_pending in step."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.other_machine_id = self.create_machine()
+
+    def add_lot(self, quantity, days_to_expiry=-1, machine_id=None, **fields):
+        lot = FoodItem(
+            machine_id=machine_id or self.machine_id,
+            expiry_date=date.today() + timedelta(days=days_to_expiry),
+            quantity=quantity,
+            **fields
+        )
+        db.session.add(lot)
+        if not fields:
+            db.session.get(Machine, lot.machine_id).current_storage_level += quantity
+        db.session.commit()
+        return lot.id
+
+    def pending(self, machine_id=None):
+        counter = db.session.get(MachineCounter, machine_id or self.machine_id)
+        return counter.expired_pending if counter else 0
+
+    def test_sweeps_in_batches_and_counts_per_machine(self):
+        expired = [self.add_lot(2) for _ in range(3)]
+        self.add_lot(4, machine_id=self.other_machine_id)
+        fresh = self.add_lot(5, days_to_expiry=0)
+        dispensed = self.add_lot(1, state=FoodItemState.DISPENSED, dispensed_at=datetime.utcnow())
+
+        result = sweep_expired(batch_size=2)
+        self.assertEqual(result, {"lots": 4, "units": 10, "machines": 2, "batches": 2})
+        self.assertEqual((self.pending(), self.pending(self.other_machine_id)), (6, 4))
+        self.assertTrue(all(db.session.get(FoodItem, item_id).state == FoodItemState.EXPIRED for item_id in expired))
+        self.assertIsNotNone(db.session.get(FoodItem, expired[0]).expired_at)
+        self.assertNotEqual(db.session.get(FoodItem, fresh).state, FoodItemState.EXPIRED)
+        self.assertNotEqual(db.session.get(FoodItem, dispensed).state, FoodItemState.EXPIRED)
+        self.assertEqual(machine_counts(self.machine_id)["expired_pending"], 6)
+        self.assertEqual(verify_counters(), [])
+
+        # Nothing left until the next day boundary
+        self.assertEqual(sweep_expired()["lots"], 0)
+        self.assertEqual(sweep_expired(today=date.today() + timedelta(days=1))["units"], 5)
+
+    def test_volunteer_endpoints_list_lots_past_their_date(self):
+        lot_id = self.add_lot(3)
+        self.add_lot(5, days_to_expiry=0)
+        expected = [{"machine_id": self.machine_id, "address": "Test site", "expired_item_count": 3}]
+
+        # Listed before the sweeper reaches them, with the count GET /api/machines/<id> reports
+        for _ in range(2):
+            machines = self.client.get("/api/volunteer/machines_with_expired_food").get_json()
+            self.assertEqual(machines, expected)
+            items = self.client.get(f"/api/volunteer/machine/{self.machine_id}/expired_items").get_json()
+            self.assertEqual([item["food_item_id"] for item in items], [lot_id])
+            machine = self.client.get(f"/api/machines/{self.machine_id}").get_json()
+            self.assertEqual(machine["expired_food_count"], 3)
+            sweep_expired()
+
+    def test_every_removal_path_releases_pending_units(self):
+        orm_lot, core_lot, synced_lot = self.add_lot(1), self.add_lot(2), self.add_lot(4)
+        sweep_expired()
+        self.assertEqual(self.pending(), 7)
+
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(volunteer)
+        db.session.commit()
+        self.client.post(f"/api/volunteer/food_item/{orm_lot}/mark_removed", json={"volunteer_id": volunteer.id})
+        self.assertEqual(self.pending(), 6)
+
+        headers = self.auth_headers(self.machine_id)
+        self.client.post("/api/maintenance/expired", json={"food_item_ids": [core_lot]}, headers=headers)
+        self.assertEqual(self.pending(), 4)
+
+        self.client.post("/api/food/sync", json={"items": [{"id": synced_lot, "is_expired_removed": True}]}, headers=headers)
+        db.session.expire_all()
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.client.get("/api/volunteer/machines_with_expired_food").get_json()["message"][:2], "No")
+        self.assertEqual(verify_counters(), [])
+
+    def test_verify_counters_detects_pending_drift(self):
+        self.add_lot(2)
+        sweep_expired()
+        db.session.get(MachineCounter, self.machine_id).expired_pending = 9
+        db.session.commit()
+        drift = verify_counters(repair=True)
+        self.assertEqual([(entry["counter"], entry["expected"], entry["actual"]) for entry in drift], [("expired_pending", 2, 9)])
+        db.session.commit()
+        self.assertEqual(verify_counters(), [])
+
+    def test_background_sweeper_and_cli(self):
+        self.add_lot(2)
+        sweeper = ExpirySweeper(self.app, batch_size=10)
+        self.assertEqual(sweeper.run_once()["units"], 2)
+
+        self.add_lot(1)
+        result = self.app.test_cli_runner().invoke(args=["sweep-expired", "--batch-size", "5"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Swept 1 lot(s), 1 unit(s) in 1 machine(s)", result.output)
+        db.session.expire_all()
+        self.assertEqual(self.pending(), 3)
+
+    def test_first_request_starts_the_sweeper(self):
+        self.add_lot(2)
+        self.app.config["EXPIRY_SWEEPER"] = True
+        install_expiry_sweeper(self.app)
+        self.client.get("/api/volunteer/machines_with_expired_food")
+        sweeper = self.app.extensions[EXTENSION_KEY]
+        try:
+            deadline = time.monotonic() + 5
+            while sweeper.last_result is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            sweeper.stop(timeout=5)
+        self.assertEqual(sweeper.last_result["units"], 2)
+        self.client.get("/api/volunteer/machines_with_expired_food")
+        self.assertIs(self.app.extensions[EXTENSION_KEY], sweeper)
+
+    def test_disabled_sweeper_is_logged(self):
+        with self.assertLogs("services.expiry_sweeper", level="WARNING") as logs:
+            install_expiry_sweeper(self.app)
+        self.assertIn("sweep-expired", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+test_export.py - Tests for the streaming food item history export
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState
+from services.export import iter_history_chunks
+
+
+class TestHistoryExport(BackendTestCase):
+    """Test cases for /api/export/food_items and the export-food-items command."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.other_id = self.create_machine()
+        self.old = datetime(2024, 1, 10, 12, 0)
+        self.recent = datetime(2024, 3, 5, 8, 30)
+        db.session.add_all([
+            FoodItem(machine_id=self.machine_id, expiry_date=date(2024, 1, 20), quantity=2, donated_at=self.old),
+            FoodItem(
+                machine_id=self.machine_id, expiry_date=date(2024, 1, 20), donated_at=self.old,
+                state=FoodItemState.DISPENSED, dispensed_at=self.recent
+            ),
+            FoodItem(machine_id=self.other_id, expiry_date=date(2024, 3, 9), donated_at=self.recent),
+        ])
+        db.session.commit()
+
+    def export(self, **params):
+        response = self.client.get("/api/export/food_items", query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export().get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1]["dispensed_at"], self.recent.isoformat())
+        self.assertEqual(rows[0]["quantity"], 2)
+
+    def test_csv_with_filters(self):
+        response = self.export(
+            format="csv", start=(self.recent - timedelta(days=1)).isoformat(), machine_id=self.machine_id
+        )
+        self.assertEqual(response.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        # Only the item dispensed inside the range; the other machine's item is filtered out
+        self.assertEqual([row["dispensed_at"] for row in rows], [self.recent.isoformat()])
+
+    def test_gzip(self):
+        response = self.export(gzip=1, end=self.old.isoformat())
+        self.assertEqual(response.mimetype, "application/gzip")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.headers["Content-Disposition"], "attachment; filename=food_items.ndjson.gz")
+        self.assertEqual(gzip.decompress(response.get_data()), b"")
+
+        body = gzip.decompress(self.export(gzip="true").get_data()).decode()
+        self.assertEqual(len(body.splitlines()), 3)
+
+    def test_rows_are_read_in_chunks(self):
+        self.assertEqual([len(chunk) for chunk in iter_history_chunks(chunk_size=2)], [2, 1])
+
+    def test_rejects_invalid_parameters(self):
+        self.assertEqual(self.client.get("/api/export/food_items?format=xml").status_code, 400)
+        self.assertEqual(self.client.get("/api/export/food_items?start=soon").status_code, 400)
+
+    def test_cli_command(self):
+        fd, path = tempfile.mkstemp(suffix=".csv.gz")
+        os.close(fd)
+        try:
+            result = self.app.test_cli_runner().invoke(args=[
+                "export-food-items", "--format", "csv", "--gzip", "--machine", str(self.other_id), "-o", path
+            ])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with gzip.open(path, "rt") as exported:
+                self.assertEqual(len(list(csv.DictReader(exported))), 1)
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+test_heartbeats.py - Tests for buffered heartbeat ingestion and the liveness API
+"""
+
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine
+from services.heartbeats import get_heartbeat_buffer
+
+
+class TestHeartbeatBuffer(BackendTestCase):
+    """Heartbeats are coalesced in memory and written in batches."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config["HEARTBEAT_FLUSH_INTERVAL"] = 3600
+        self.machine_ids = [self.create_machine(last_heartbeat=None) for _ in range(3)]
+        self.buffer = get_heartbeat_buffer()
+
+    def machine_updates(self, statements):
+        return [statement for statement in statements if statement.startswith("UPDATE machines")]
+
+    def test_heartbeats_are_buffered_until_flush(self):
+        with self.count_statements() as statements:
+            for _ in range(5):
+                for machine_id in self.machine_ids:
+                    response = self.client.post(f"/api/machines/{machine_id}/heartbeat", json={})
+                    self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.machine_updates(statements), [])
+        self.assertEqual(self.buffer.stats()["pending"], 3)
+
+        with self.count_statements() as statements:
+            self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(len(self.machine_updates(statements)), 1)
+
+        db.session.expire_all()
+        self.assertTrue(all(db.session.get(Machine, machine_id).last_heartbeat for machine_id in self.machine_ids))
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+
+    def test_flushes_once_interval_has_passed(self):
+        self.buffer.flush_interval = 0
+        self.client.post(f"/api/machines/{self.machine_ids[0]}/heartbeat", json={})
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+        self.assertIsNotNone(db.session.get(Machine, self.machine_ids[0]).last_heartbeat)
+
+    def test_background_thread_flushes_without_another_heartbeat(self):
+        self.buffer.flush_interval = 0.05
+        self.buffer.start()
+        try:
+            self.client.post(f"/api/machines/{self.machine_ids[0]}/heartbeat", json={})
+            deadline = time.monotonic() + 5
+            while self.buffer.stats()["pending"] and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            self.buffer.stop()
+        db.session.expire_all()
+        self.assertIsNotNone(db.session.get(Machine, self.machine_ids[0]).last_heartbeat)
+
+    def test_stop_flushes_what_is_buffered(self):
+        self.buffer.start()
+        self.buffer.record(self.machine_ids[1])
+        self.buffer.stop()
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+        self.assertIsNotNone(db.session.get(Machine, self.machine_ids[1]).last_heartbeat)
+
+    def test_never_moves_heartbeat_backwards(self):
+        machine_id = self.machine_ids[0]
+        now = datetime.utcnow()
+        self.buffer.record(machine_id, now)
+        self.buffer.record(machine_id, now - timedelta(minutes=5))
+        self.buffer.flush()
+        self.buffer.record(machine_id, now - timedelta(minutes=1))
+        self.buffer.flush()
+
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Machine, machine_id).last_heartbeat, now)
+
+    def test_status_update_only_writes_changes(self):
+        headers = self.auth_headers(self.machine_ids[0])
+        with self.count_statements() as statements:
+            response = self.client.post("/api/machine/status", json={"error_code": None}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.machine_updates(statements), [])
+        self.assertIn(self.machine_ids[0], self.buffer.pending())
+
+
+class TestLiveness(BackendTestCase):
+    """The liveness API merges buffered heartbeats with stored ones."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config["HEARTBEAT_FLUSH_INTERVAL"] = 3600
+        old = datetime.utcnow() - timedelta(hours=1)
+        self.stale_id = self.create_machine(last_heartbeat=old)
+        self.live_id = self.create_machine(last_heartbeat=old)
+
+    def test_buffered_heartbeat_counts_as_alive(self):
+        self.client.post(f"/api/machines/{self.live_id}/heartbeat", json={})
+
+        response = self.client.get("/api/machines/liveness?stale_after=60")
+        self.assertEqual(response.status_code, 200)
+        alive = {machine["id"]: machine["alive"] for machine in response.get_json()}
+        self.assertEqual(alive, {self.stale_id: False, self.live_id: True})
+
+        body = self.client.get(f"/api/machines/{self.live_id}").get_json()
+        self.assertEqual(body["last_heartbeat"], get_heartbeat_buffer().pending()[self.live_id].isoformat())
+
+    def test_rejects_invalid_stale_after(self):
+        self.assertEqual(self.client.get("/api/machines/liveness?stale_after=soon").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+test_nearest.py - Tests for the nearest-machine locator and its spatial index
+"""
+
+import random
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem
+from services.response_cache import get_response_cache
+from services.spatial_index import get_machine_index, haversine_km
+
+
+class TestHaversine(unittest.TestCase):
+    """Distance calculation tests."""
+
+    def test_known_distance(self):
+        # Los Angeles to San Francisco is roughly 559 km
+        distance = haversine_km(34.0522, -118.2437, np.array([37.7749]), np.array([-122.4194]))[0]
+        self.assertAlmostEqual(distance, 559, delta=2)
+
+    def test_antimeridian(self):
+        distance = haversine_km(0, 179.9, np.array([0.0]), np.array([-179.9]))[0]
+        self.assertAlmostEqual(distance, 22.24, delta=0.1)
+
+
+class TestNearestMachines(BackendTestCase):
+    """Test cases for /api/location/nearest."""
+
+    def nearest(self, **params):
+        response = self.client.get("/api/location/nearest", query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_orders_by_distance_and_limits(self):
+        far_id = self.create_machine(location_lat=37.77, location_lon=-122.42)
+        near_id = self.create_machine(location_lat=34.06, location_lon=-118.25)
+        self.create_machine(location_lat=34.05, location_lon=-118.24, status="inactive")
+
+        body = self.nearest(lat=34.05, lon=-118.24)
+        self.assertEqual([machine["id"] for machine in body], [near_id, far_id])
+        self.assertLess(body[0]["distance"], 2)
+
+        body = self.nearest(lat=34.05, lon=-118.24, limit=1)
+        self.assertEqual([machine["id"] for machine in body], [near_id])
+
+        body = self.nearest(lat=34.05, lon=-118.24, radius=100)
+        self.assertEqual([machine["id"] for machine in body], [near_id])
+
+    def test_filters_use_availability(self):
+        full_id = self.create_machine(storage_capacity_max=5, current_storage_level=5)
+        empty_id = self.create_machine()
+        db.session.add(FoodItem(machine_id=full_id, expiry_date=date.today() + timedelta(days=1), quantity=5))
+        db.session.commit()
+
+        self.assertEqual([m["id"] for m in self.nearest(filter="donor")], [empty_id])
+        receivers = self.nearest(filter="receiver")
+        self.assertEqual([m["id"] for m in receivers], [full_id])
+        self.assertEqual(receivers[0]["available_food"], 5)
+
+    def test_rejects_invalid_parameters(self):
+        for params in ({"lat": 91}, {"lon": "x"}, {"limit": 0}, {"radius": -1}):
+            response = self.client.get("/api/location/nearest", query_string=params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_grid_matches_brute_force(self):
+        rng = random.Random(7)
+        points = {}
+        for _ in range(300):
+            lat, lon = rng.uniform(33, 35), rng.uniform(-119, -117)
+            points[self.create_machine(location_lat=lat, location_lon=lon)] = (lat, lon)
+
+        for _ in range(10):
+            lat, lon, radius = rng.uniform(33, 35), rng.uniform(-119, -117), rng.uniform(5, 80)
+            distances = {
+                machine_id: haversine_km(lat, lon, np.array([p[0]]), np.array([p[1]]))[0]
+                for machine_id, p in points.items()
+            }
+            expected = sorted(
+                (machine_id for machine_id, d in distances.items() if d <= radius),
+                key=distances.get
+            )[:50]
+            body = self.nearest(lat=lat, lon=lon, radius=radius, limit=50)
+            self.assertEqual([machine["id"] for machine in body], expected)
+
+    def test_index_refreshes_changed_machines_only(self):
+        machine_id = self.create_machine()
+        self.assertEqual(self.nearest()[0]["available_food"], 0)
+
+        with self.count_statements() as statements:
+            self.nearest()
+        self.assertEqual(statements, [])
+
+        expiry = (date.today() + timedelta(days=2)).isoformat()
+        self.client.post(
+            f"/api/machines/{machine_id}/report_donation",
+            json={"expiry_date": expiry, "quantity": 4}
+        )
+        body = self.nearest()
+        self.assertEqual(body[0]["available_food"], 4)
+        self.assertEqual(body[0]["available_space"], 96)
+
+        new_id = self.create_machine(location_lat=34.0501, location_lon=-118.2401)
+        self.assertEqual({m["id"] for m in self.nearest()}, {machine_id, new_id})
+
+        db.session.get(Machine, new_id).status = "maintenance"
+        db.session.commit()
+        self.assertEqual([m["id"] for m in self.nearest()], [machine_id])
+
+    def test_no_op_status_report_is_not_a_change(self):
+        machine_id = self.create_machine()
+        headers = self.auth_headers(machine_id)
+        self.nearest()
+        invalidations = get_response_cache().stats()["invalidations"]
+
+        for _ in range(3):
+            response = self.client.post("/api/machine/status", json={"available_space": 0}, headers=headers)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_response_cache().stats()["invalidations"], invalidations)
+        self.assertFalse(get_machine_index()._dirty)
+        with self.count_statements() as statements:
+            self.nearest()
+        self.assertEqual(statements, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+test_pagination.py - Tests for keyset-paginated item listings
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState
+from services.expiry_sweeper import sweep_expired
+from services.pagination import NEXT_CURSOR_HEADER
+
+
+class TestItemListings(BackendTestCase):
+    """Test cases for /api/machines/<id>/food_items and the volunteer expired listing."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        today = date.today()
+        lots = [FoodItem(machine_id=self.machine_id, expiry_date=today + timedelta(days=2)) for _ in range(7)]
+        lots += [FoodItem(machine_id=self.machine_id, expiry_date=today - timedelta(days=1)) for _ in range(4)]
+        lots += [FoodItem(machine_id=self.machine_id, expiry_date=today, state=FoodItemState.DISPENSED) for _ in range(3)]
+        db.session.add_all(lots)
+        db.session.commit()
+
+    def walk(self, url, **params):
+        """Follow the cursor header through every page and return the ids and page count."""
+        ids, pages, after = [], 0, None
+        while True:
+            query = dict(params, **({"after": after} if after else {}))
+            response = self.client.get(url, query_string=query)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item.get("id", item.get("food_item_id")) for item in response.get_json())
+            pages += 1
+            after = response.headers.get(NEXT_CURSOR_HEADER)
+            if after is None:
+                return ids, pages
+
+    def test_pages_through_available_items(self):
+        ids, pages = self.walk(f"/api/machines/{self.machine_id}/food_items", limit=3)
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(pages, 3)
+
+    def test_state_filter(self):
+        expired, _ = self.walk(f"/api/machines/{self.machine_id}/food_items", state="expired")
+        everything, _ = self.walk(f"/api/machines/{self.machine_id}/food_items", state="all", limit=5)
+        self.assertEqual(len(expired), 4)
+        self.assertEqual(len(everything), 14)
+
+    def test_volunteer_expired_items(self):
+        sweep_expired()
+        ids, pages = self.walk(f"/api/volunteer/machine/{self.machine_id}/expired_items", limit=2)
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(pages, 2)
+
+    def test_volunteer_expired_items_are_unpaged_by_default(self):
+        lots = [FoodItem(machine_id=self.machine_id, expiry_date=date.today() - timedelta(days=2)) for _ in range(60)]
+        db.session.add_all(lots)
+        db.session.commit()
+        url = f"/api/volunteer/machine/{self.machine_id}/expired_items"
+        response = self.client.get(url)
+        self.assertEqual(len(response.get_json()), 64)
+        self.assertNotIn(NEXT_CURSOR_HEADER, response.headers)
+
+        # Paged as soon as a cursor or page size is given
+        response = self.client.get(url, query_string={"after": lots[0].id - 1})
+        self.assertEqual(len(response.get_json()), 50)
+        self.assertIn(NEXT_CURSOR_HEADER, response.headers)
+        self.assertEqual(self.client.get(url, query_string={"limit": 0}).status_code, 400)
+
+    def test_available_excludes_unswept_lots_past_their_date(self):
+        available, _ = self.walk(f"/api/machines/{self.machine_id}/food_items", state="available")
+        expired, _ = self.walk(f"/api/machines/{self.machine_id}/food_items", state="expired")
+        self.assertEqual((len(available), len(expired)), (7, 4))
+        sweep_expired()
+        self.assertEqual(self.walk(f"/api/machines/{self.machine_id}/food_items", state="expired")[0], expired)
+
+    def test_page_cost_does_not_grow_with_history(self):
+        url = f"/api/machines/{self.machine_id}/food_items"
+        with self.count_statements() as few:
+            self.client.get(url, query_string={"limit": 2})
+        db.session.add_all([
+            FoodItem(machine_id=self.machine_id, expiry_date=date.today(), state=FoodItemState.DISPENSED) for _ in range(200)
+        ])
+        db.session.commit()
+        with self.count_statements() as many:
+            response = self.client.get(url, query_string={"limit": 2, "state": "all"})
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertEqual(len(few), len(many))
+
+    def test_rejects_invalid_parameters(self):
+        url = f"/api/machines/{self.machine_id}/food_items"
+        self.assertEqual(self.client.get(url, query_string={"limit": 0}).status_code, 400)
+        self.assertEqual(self.client.get(url, query_string={"after": "x"}).status_code, 400)
+        response = self.client.get(url, query_string={"after": -1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["error"], "after must not be negative")
+        response = self.client.get(url, query_string={"limit": 1000})
+        self.assertEqual(response.get_json()["error"], "limit must be between 1 and 500")
+        self.assertEqual(self.client.get(url, query_string={"state": "gone"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/machines/999/food_items").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+test_public_routes.py - Tests for the public locator endpoints
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState
+
+
+class TestMachinesForReceivers(BackendTestCase):
+    """Test cases for /api/public/machines_for_receivers."""
+
+    def seed(self, machine_count):
+        """Create machines holding one fresh lot each, plus one unavailable lot."""
+        expiry = date.today() + timedelta(days=2)
+        for _ in range(machine_count):
+            machine_id = self.create_machine()
+            db.session.add_all([
+                FoodItem(machine_id=machine_id, expiry_date=expiry, quantity=3),
+                FoodItem(machine_id=machine_id, expiry_date=expiry, quantity=5, state=FoodItemState.DISPENSED),
+            ])
+        db.session.commit()
+
+    def test_counts_available_units_per_machine(self):
+        self.seed(2)
+        inactive_id = self.create_machine(status="maintenance")
+        db.session.add(FoodItem(machine_id=inactive_id, expiry_date=date.today(), quantity=1))
+        empty_id = self.create_machine()
+        db.session.add(FoodItem(
+            machine_id=empty_id, expiry_date=date.today() - timedelta(days=1), quantity=1
+        ))
+        db.session.commit()
+
+        response = self.client.get("/api/public/machines_for_receivers")
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(len(body), 2)
+        self.assertTrue(all(machine["available_food_items"] == 3 for machine in body))
+
+    def test_statement_count_does_not_grow_with_machines(self):
+        self.seed(3)
+        with self.count_statements() as few:
+            self.client.get("/api/public/machines_for_receivers")
+
+        self.seed(60)
+        with self.count_statements() as many:
+            response = self.client.get("/api/public/machines_for_receivers")
+
+        self.assertEqual(len(response.get_json()), 63)
+        self.assertEqual(len(few), 1)
+        self.assertEqual(len(many), len(few))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+"""
+test_query_plans.py - Query plan regression tests for FoodItem access paths
+
+Each test drives an endpoint through the test client, captures the statements it issues
+and runs EXPLAIN QUERY PLAN on every one that reads food_items (including the WHERE of
+UPDATE ... RETURNING statements, which replace SELECTs on some paths). A plan that scans the
+food_items or food_items_archive table itself (rather than searching it or scanning an
+index) fails the test.
+
+Locator and summary endpoints answer from the inventory counters and must not read
+food_items at all.
+"""
+
+import re
+import unittest
+from datetime import date, timedelta
+
+from sqlalchemy import event, text
+
+from tests.base import BackendTestCase
+from models.models import db, User, FoodItem, FoodItemState
+from services.archive import archive_finished_items
+from services.expiry_sweeper import sweep_expired
+
+TABLE_SCAN = re.compile(r"\bSCAN (food_items(_archive)?|food_items(_archive)? AS \w+)$")
+
+
+class TestFoodItemQueryPlans(BackendTestCase):
+    """Every hot FoodItem query must be answered through an index."""
+
+    def setUp(self):
+        super().setUp()
+        today = date.today()
+        self.machine_id = self.create_machine()
+        self.other_machine_id = self.create_machine(location_lat=35.0)
+        lots = []
+        for machine_id in (self.machine_id, self.other_machine_id):
+            for offset in range(-3, 10):
+                lots.append(FoodItem(machine_id=machine_id, expiry_date=today + timedelta(days=offset), quantity=2))
+            lots.append(FoodItem(machine_id=machine_id, expiry_date=today, quantity=1, state=FoodItemState.DISPENSED))
+        db.session.add_all(lots)
+        self.volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(self.volunteer)
+        db.session.commit()
+        self.expired_id = FoodItem.query.filter(FoodItem.expiry_date < today).first().id
+        sweep_expired()
+        db.session.execute(text("ANALYZE"))
+
+    def capture_reads(self, call):
+        """Run call() and return its response and the food_items statements it issued."""
+        captured = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            verb = statement.lstrip().split(None, 1)[0].upper()
+            if verb in ("SELECT", "UPDATE") and "food_items" in statement and not executemany:
+                captured.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = call()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        self.assertLess(response.status_code, 500)
+        return response, captured
+
+    def assert_counter_only(self, call):
+        """Run call() and check that it does not touch food_items."""
+        response, captured = self.capture_reads(call)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([statement for statement, _ in captured], [])
+
+    def assert_indexed(self, call):
+        """Run call() and check the plan of every food_items read it issues."""
+        _, captured = self.capture_reads(call)
+        self.assertTrue(captured, "endpoint issued no food_items query")
+
+        with db.engine.connect() as conn:
+            for statement, parameters in captured:
+                plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+                details = [row[-1] for row in plan]
+                scans = [detail for detail in details if TABLE_SCAN.search(detail)]
+                self.assertEqual(scans, [], f"full table scan in plan {details} for:\n{statement}")
+
+    def test_machines_for_receivers(self):
+        self.assert_counter_only(lambda: self.client.get("/api/public/machines_for_receivers"))
+
+    def test_nearest_machines(self):
+        self.assert_counter_only(lambda: self.client.get("/api/location/nearest"))
+
+    def test_machines_with_expired_food(self):
+        self.assert_counter_only(lambda: self.client.get("/api/volunteer/machines_with_expired_food"))
+
+    def test_expired_items_in_machine(self):
+        self.assert_indexed(
+            lambda: self.client.get(f"/api/volunteer/machine/{self.machine_id}/expired_items")
+        )
+
+    def test_get_machine(self):
+        self.assert_counter_only(lambda: self.client.get(f"/api/machines/{self.machine_id}"))
+
+    def test_machine_food_items(self):
+        for state in ("available", "expired", "all"):
+            self.assert_indexed(lambda: self.client.get(
+                f"/api/machines/{self.machine_id}/food_items", query_string={"state": state, "after": 3, "limit": 5}
+            ))
+
+    def test_available_food_items_can_use_the_partial_index(self):
+        # SQLite only accepts INDEXED BY a partial index whose predicate the WHERE implies
+        _, captured = self.capture_reads(lambda: self.client.get(
+            f"/api/machines/{self.machine_id}/food_items", query_string={"state": "available"}
+        ))
+        with db.engine.connect() as conn:
+            for statement, parameters in captured:
+                forced = statement.replace("FROM food_items", "FROM food_items INDEXED BY ix_food_items_state_available", 1)
+                plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {forced}", parameters).all()
+                self.assertIn("ix_food_items_state_available", plan[0][-1])
+
+    def test_dispense_food(self):
+        self.assert_indexed(lambda: self.client.post(f"/api/machines/{self.machine_id}/dispense_food"))
+
+    def test_collect(self):
+        headers = self.auth_headers(self.machine_id)
+        self.assert_indexed(
+            lambda: self.client.post("/api/food/collect", json={"quantity": 3}, headers=headers)
+        )
+
+    def test_remove_expired(self):
+        headers = self.auth_headers(self.machine_id)
+        self.assert_indexed(lambda: self.client.post(
+            "/api/maintenance/expired", json={"food_item_ids": [self.expired_id]}, headers=headers
+        ))
+
+    def test_sync(self):
+        headers = self.auth_headers(self.machine_id)
+        expiry = (date.today() + timedelta(days=4)).isoformat()
+        self.assert_indexed(lambda: self.client.post(
+            "/api/food/sync",
+            json={"items": [{"id": self.expired_id, "is_expired_removed": True}, {"expiry_date": expiry}]},
+            headers=headers
+        ))
+
+    def test_export_streams_without_sorting(self):
+        archive_finished_items(timedelta(days=0))
+        # Enough live lots for the planner's estimates to resemble a real inventory (on a
+        # handful of rows SQLite may prefer to sort)
+        db.session.add_all([
+            FoodItem(machine_id=machine_id, expiry_date=date.today(), quantity=1)
+            for machine_id in (self.machine_id, self.other_machine_id) for _ in range(100)
+        ])
+        db.session.commit()
+        db.session.execute(text("ANALYZE"))
+
+        for query_string in ({}, {"start": "2000-01-01T00:00:00"}, {"machine_id": self.machine_id}):
+            response, captured = self.capture_reads(lambda: self.client.get(
+                "/api/export/food_items", query_string=query_string, buffered=True
+            ))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(captured), 2)
+            with db.engine.connect() as conn:
+                for statement, parameters in captured:
+                    details = [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+                    self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", details, statement)
+
+    def test_mark_removed(self):
+        self.assert_indexed(lambda: self.client.post(
+            f"/api/volunteer/food_item/{self.expired_id}/mark_removed",
+            json={"volunteer_id": self.volunteer.id}
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
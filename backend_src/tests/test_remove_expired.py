@@ -0,0 +1,87 @@
+"""
+test_remove_expired.py - Tests for bulk expired food removal at /api/maintenance/expired
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem, FoodItemState
+
+
+class TestRemoveExpired(BackendTestCase):
+    """Test cases for /api/maintenance/expired."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+
+    def add_lot(self, quantity, machine_id=None, **fields):
+        lot = FoodItem(
+            machine_id=machine_id or self.machine_id,
+            expiry_date=date.today() - timedelta(days=1),
+            quantity=quantity,
+            **fields
+        )
+        db.session.add(lot)
+        db.session.commit()
+        return lot.id
+
+    def remove(self, food_item_ids):
+        return self.client.post(
+            "/api/maintenance/expired", json={"food_item_ids": food_item_ids}, headers=self.headers
+        )
+
+    def test_removes_lots_and_lowers_storage_level_by_units(self):
+        first, second, kept = self.add_lot(3), self.add_lot(2), self.add_lot(4)
+        db.session.get(Machine, self.machine_id).current_storage_level = 9
+        db.session.commit()
+
+        body = self.remove([first, second]).get_json()
+        self.assertEqual(body["removed_item_ids"], [first, second])
+        self.assertEqual(body["removed_count"], 2)
+        self.assertEqual(body["removed_quantity"], 5)
+        self.assertEqual(body["current_storage_level"], 4)
+
+        lot = db.session.get(FoodItem, first)
+        self.assertEqual(lot.state, FoodItemState.EXPIRED_REMOVED)
+        self.assertIsNotNone(lot.expired_removed_at)
+        self.assertNotEqual(db.session.get(FoodItem, kept).state, FoodItemState.EXPIRED_REMOVED)
+
+    def test_reports_only_items_that_changed_state(self):
+        removable = self.add_lot(1)
+        dispensed = self.add_lot(1, state=FoodItemState.DISPENSED)
+        already_removed = self.add_lot(1, state=FoodItemState.EXPIRED_REMOVED)
+        foreign = self.add_lot(1, machine_id=self.create_machine())
+        db.session.get(Machine, self.machine_id).current_storage_level = 1
+        db.session.commit()
+
+        body = self.remove([removable, dispensed, already_removed, foreign, 99999]).get_json()
+        self.assertEqual(body["removed_item_ids"], [removable])
+        self.assertEqual(body["unchanged_item_ids"], sorted([dispensed, already_removed, foreign, 99999]))
+        self.assertEqual(body["current_storage_level"], 0)
+        self.assertNotEqual(db.session.get(FoodItem, foreign).state, FoodItemState.EXPIRED_REMOVED)
+
+        body = self.remove([removable]).get_json()
+        self.assertEqual(body["removed_count"], 0)
+        self.assertEqual(body["current_storage_level"], 0)
+
+    def test_rejects_malformed_ids(self):
+        self.assertEqual(self.remove("1,2").status_code, 400)
+        self.assertEqual(self.remove([1, "2"]).status_code, 400)
+        self.assertEqual(self.remove([True]).status_code, 400)
+
+    def test_statement_count_does_not_grow_with_items(self):
+        small = [self.add_lot(1) for _ in range(3)]
+        large = [self.add_lot(1) for _ in range(40)]
+
+        with self.count_statements() as few:
+            self.remove(small)
+        with self.count_statements() as many:
+            self.remove(large)
+        self.assertEqual(len(few), len(many))
+
+
+if __name__ == "__main__":
+    unittest.main()
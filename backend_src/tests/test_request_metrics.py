@@ -0,0 +1,92 @@
+"""
+test_request_metrics.py - Tests for the per-request metrics middleware and /metrics
+"""
+
+import re
+import unittest
+
+from tests.base import BackendTestCase
+from services.request_metrics import _statement_shape
+from services.token_cache import get_token_cache
+
+
+class TestRequestMetrics(BackendTestCase):
+    """Every request is recorded per endpoint, with its SQL statements and response size."""
+
+    def metric(self, text, name, **labels):
+        pattern = name + r"\{" + ",".join(f'{key}="{re.escape(str(value))}"' for key, value in labels.items()) + r"\} (\S+)"
+        match = re.search(pattern, text)
+        self.assertIsNotNone(match, f"{name} {labels} not in /metrics")
+        return float(match.group(1))
+
+    def test_metrics_are_recorded_per_endpoint(self):
+        for _ in range(3):
+            self.create_machine()
+        for _ in range(2):
+            self.assertEqual(self.client.get("/api/public/machines_for_donors").status_code, 200)
+        self.assertEqual(self.client.get("/api/public/machines_for_receivers").status_code, 404)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+
+        endpoint = "public_bp.get_machines_for_donors"
+        self.assertEqual(self.metric(text, "http_requests_total", endpoint=endpoint, method="GET", status=200), 2)
+        self.assertEqual(self.metric(text, "http_request_duration_seconds_count", endpoint=endpoint, method="GET"), 2)
+        self.assertGreaterEqual(self.metric(text, "http_request_sql_statements_sum", endpoint=endpoint, method="GET"), 1)
+        self.assertEqual(self.metric(text, "http_request_sql_statements_bucket", endpoint=endpoint, method="GET", le="+Inf"), 2)
+        self.assertGreater(self.metric(text, "http_response_size_bytes_sum", endpoint=endpoint, method="GET"), 0)
+        self.assertIn("# TYPE http_request_sql_duration_seconds histogram", text)
+        self.assertEqual(self.metric(text, "http_requests_total", endpoint="public_bp.get_machines_for_receivers", method="GET", status=404), 1)
+
+    def test_token_cache_stats_are_exported(self):
+        machine_id = self.create_machine()
+        for _ in range(3):
+            self.client.post("/api/machine/status", json={}, headers=self.auth_headers(machine_id))
+        stats = get_token_cache().stats()
+        self.assertGreater(stats["hits"], 0)
+
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn("# TYPE machine_token_cache_lookups_total counter", text)
+        self.assertEqual(self.metric(text, "machine_token_cache_lookups_total", result="hit"), stats["hits"])
+        self.assertEqual(self.metric(text, "machine_token_cache_lookups_total", result="miss"), stats["misses"])
+        self.assertEqual(float(re.search(r"^machine_token_cache_evictions_total (\S+)$", text, re.M).group(1)), 0)
+        self.assertAlmostEqual(float(re.search(r"^machine_token_cache_hit_ratio (\S+)$", text, re.M).group(1)), stats["hit_rate"])
+
+    def test_slow_requests_are_logged_with_grouped_statements(self):
+        self.app.config["SLOW_REQUEST_THRESHOLD"] = 0
+        self.create_machine()
+        with self.assertLogs("services.request_metrics", level="WARNING") as logs:
+            self.client.get("/api/public/machines_for_donors")
+        message = logs.output[-1]
+        self.assertIn("GET /api/public/machines_for_donors (public_bp.get_machines_for_donors)", message)
+        self.assertRegex(message, r"[1-9]\d* SQL statements")
+        self.assertRegex(message, r"1x [\d.]+ ms  SELECT .* FROM machines")
+
+    def test_slow_request_log_shortens_batched_statements(self):
+        self.app.config["SLOW_REQUEST_THRESHOLD"] = 0
+        self.app.config["TELEMETRY_PRUNE_INTERVAL"] = None
+        headers = self.auth_headers(self.create_machine())
+        points = [{"timestamp": f"2026-01-01T00:{minute:02d}:00", "temperature": 1.0} for minute in range(60)]
+        with self.assertLogs("services.request_metrics", level="WARNING") as logs:
+            self.client.post("/api/machine/telemetry", json={"points": points}, headers=headers)
+        lines = logs.output[-1].splitlines()[1:]
+        self.assertTrue(all(len(line) < 250 for line in lines), max(lines, key=len))
+        self.assertTrue(any("VALUES (?, ?, ?, ?, ?, ?, ?, ?), ..." in line for line in lines))
+
+        # Multi-row statements of different sizes are grouped together
+        self.assertEqual(
+            _statement_shape("INSERT INTO t (a) VALUES (?), (?) ON CONFLICT DO NOTHING"),
+            _statement_shape("INSERT INTO t (a)\nVALUES (?), (?), (?) ON CONFLICT DO NOTHING")
+        )
+        self.assertEqual(_statement_shape("SELECT a FROM t WHERE id IN (?, ?)"), "SELECT a FROM t WHERE id IN (...)")
+
+    def test_slow_request_log_can_be_disabled(self):
+        self.app.config["SLOW_REQUEST_THRESHOLD"] = None
+        with self.assertNoLogs("services.request_metrics"):
+            self.client.get("/api/public/machines_for_donors")
+
+
+if __name__ == "__main__":
+    unittest.main()
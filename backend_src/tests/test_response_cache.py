@@ -0,0 +1,105 @@
+"""
+test_response_cache.py - Tests for the cached public locator responses
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem
+from services.response_cache import get_response_cache
+
+
+class TestResponseCache(BackendTestCase):
+    """Locator responses are cached, revalidated with ETags and invalidated by writes."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        db.session.add(FoodItem(machine_id=self.machine_id, expiry_date=date.today() + timedelta(days=2), quantity=2))
+        db.session.commit()
+
+    def test_repeated_requests_are_served_from_cache(self):
+        for url in ("/api/public/machines_for_receivers", "/api/public/machines_for_donors",
+                    "/api/location/nearest?lat=34&lon=-118&limit=5"):
+            first = self.client.get(url)
+            with self.count_statements() as statements:
+                second = self.client.get(url)
+            self.assertEqual(statements, [], url)
+            self.assertEqual(second.get_data(), first.get_data())
+            self.assertEqual(second.headers["ETag"], first.headers["ETag"])
+
+    def test_parameter_order_does_not_matter(self):
+        self.client.get("/api/location/nearest?lat=34&lon=-118")
+        with self.count_statements() as statements:
+            self.client.get("/api/location/nearest?lon=-118&lat=34&radius=")
+        self.assertEqual(statements, [])
+
+    def test_if_none_match_returns_304(self):
+        etag = self.client.get("/api/public/machines_for_receivers").headers["ETag"]
+        response = self.client.get("/api/public/machines_for_receivers", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+
+    def test_writes_invalidate(self):
+        first = self.client.get("/api/public/machines_for_receivers")
+        self.client.post(
+            f"/api/machines/{self.machine_id}/report_donation",
+            json={"expiry_date": (date.today() + timedelta(days=3)).isoformat(), "quantity": 3}
+        )
+        second = self.client.get("/api/public/machines_for_receivers", headers={"If-None-Match": first.headers["ETag"]})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.get_json()[0]["available_food_items"], 5)
+
+        self.client.put(f"/api/machines/{self.machine_id}/status", json={"status": "maintenance"})
+        self.assertEqual(self.client.get("/api/public/machines_for_donors").status_code, 404)
+
+    def test_heartbeat_status_reports_do_not_clear_the_cache(self):
+        headers = self.auth_headers(self.machine_id)
+        urls = ("/api/public/machines_for_receivers", "/api/public/machines_for_donors",
+                "/api/location/nearest?lat=34&lon=-118")
+        for url in urls:
+            self.client.get(url)
+        before = get_response_cache().stats()
+
+        for _ in range(5):
+            status = self.client.post("/api/machine/status", json={"temperature": 4.0}, headers=headers)
+            self.assertEqual(status.status_code, 200)
+            for url in urls:
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+        after = get_response_cache().stats()
+        self.assertEqual(after["hits"] - before["hits"], 5 * len(urls))
+        self.assertEqual(after["misses"], before["misses"])
+        self.assertEqual(after["invalidations"], before["invalidations"])
+
+        # A report that does change the machine still invalidates
+        self.client.post("/api/machine/status", json={"error_code": "E1"}, headers=headers)
+        self.assertEqual(self.client.get("/api/public/machines_for_donors").status_code, 404)
+
+    def test_stale_copy_served_while_another_request_refreshes(self):
+        cache = get_response_cache()
+        cache.stale_ttl = 60
+        first = self.client.get("/api/public/machines_for_receivers")
+        cache.invalidate()
+        for entry in cache._entries.values():
+            entry.refreshing = True
+
+        with self.count_statements() as statements:
+            stale = self.client.get("/api/public/machines_for_receivers")
+        self.assertEqual(statements, [])
+        self.assertEqual(stale.get_data(), first.get_data())
+        self.assertEqual(cache.stats()["stale_hits"], 1)
+
+        cache.stale_ttl = 0
+        with self.count_statements() as statements:
+            self.client.get("/api/public/machines_for_receivers")
+        self.assertNotEqual(statements, [])
+
+    def test_errors_are_not_cached(self):
+        self.client.get("/api/location/nearest?lat=100")
+        self.assertEqual(get_response_cache().stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
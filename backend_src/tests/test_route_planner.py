@@ -0,0 +1,136 @@
+"""
+test_route_planner.py - Tests for the volunteer collection route planner
+"""
+
+import random
+import statistics
+import time
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, Machine, MachineExpiryBucket
+from services.route_planner import get_distance_matrix, nearest_neighbour, two_opt
+
+
+class TestRoutePlanner(BackendTestCase):
+    """Rounds visit the sites with the most expired units that fit the time budget, in a short order."""
+
+    def add_site(self, lat, lon, expired):
+        machine_id = self.create_machine(location_lat=lat, location_lon=lon)
+        self.add_expired_lot(machine_id, expired)
+        return machine_id
+
+    def add_expired_lot(self, machine_id, quantity):
+        db.session.add(FoodItem(machine_id=machine_id, expiry_date=date.today() - timedelta(days=1), quantity=quantity))
+        db.session.commit()
+
+    def route(self, **query):
+        params = {"lat": 34.0, "lon": -118.0, "speed_kmh": 60, "service_minutes": 0}
+        params.update(query)
+        response = self.client.get("/api/volunteer/route", query_string=params)
+        self.assertEqual(response.status_code, 200, response.get_json())
+        return response.get_json()
+
+    def test_visits_sites_in_a_short_order(self):
+        # Sites along a line east of the start, created out of order
+        ids = {lon: self.add_site(34.0, lon, expired=1) for lon in (-117.7, -117.9, -117.6, -117.8)}
+        route = self.route(time_budget=600)
+        self.assertEqual([stop["machine_id"] for stop in route["stops"]],
+                         [ids[lon] for lon in (-117.9, -117.8, -117.7, -117.6)])
+        self.assertEqual([stop["order"] for stop in route["stops"]], [1, 2, 3, 4])
+        # 0.4 degrees of longitude at 34N, one minute per kilometre
+        self.assertAlmostEqual(route["total_distance_km"], 36.9, delta=0.2)
+        self.assertEqual(route["total_minutes"], route["stops"][-1]["arrival_minutes"])
+        self.assertEqual(route["expired_item_count"], 4)
+
+    def test_time_budget_prefers_sites_with_most_expired_units(self):
+        near_few = self.add_site(34.0, -117.95, expired=1)
+        far_many = self.add_site(34.0, -117.8, expired=9)
+        self.add_site(34.0, -116.0, expired=20)
+
+        # Neither the far site with 20 units nor (after the one with 9) the near one fits
+        route = self.route(time_budget=20, service_minutes=1)
+        self.assertEqual([stop["machine_id"] for stop in route["stops"]], [far_many])
+        self.assertLessEqual(route["total_minutes"], 20)
+        self.assertEqual(route["sites_with_expired_food"], 3)
+
+        route = self.route(time_budget=25, service_minutes=1)
+        self.assertEqual([stop["machine_id"] for stop in route["stops"]], [near_few, far_many])
+
+    def test_distance_matrix_is_recomputed_only_for_moved_machines(self):
+        for lon in (-117.9, -117.8, -117.7):
+            moved = self.add_site(34.0, lon, expired=2)
+        matrix = get_distance_matrix()
+        self.route(time_budget=600)
+        self.assertEqual(matrix.computed_rows, 3)
+
+        self.add_site(34.1, -117.9, expired=1)
+        self.add_expired_lot(moved, 3)
+        self.route(time_budget=600)
+        self.assertEqual(matrix.computed_rows, 4)
+
+        db.session.get(Machine, moved).location_lat = 34.2
+        db.session.commit()
+        route = self.route(time_budget=600)
+        self.assertEqual(matrix.computed_rows, 5)
+        self.assertIn(moved, [stop["machine_id"] for stop in route["stops"]])
+
+    def test_two_opt_removes_crossings(self):
+        # Start (0,0), a square of sites, and the zero-distance end node
+        points = np.array([(0, 0), (0, 1), (1, 1), (1, 0), (0, 1.8)], dtype=float)
+        km = np.zeros((6, 6))
+        km[:5, :5] = np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))
+        crossing = np.array([0, 2, 1, 3, 4, 5])
+        improved = two_opt(km, crossing)
+        self.assertLess(km[improved[:-1], improved[1:]].sum(), km[crossing[:-1], crossing[1:]].sum())
+        self.assertEqual((improved[0], improved[-1]), (0, 5))
+        self.assertEqual(nearest_neighbour(km, [1, 2, 3, 4]).tolist(), [0, 1, 4, 2, 3, 5])
+
+    def test_two_opt_stops_at_the_deadline(self):
+        points = np.array([(0, 0), (0, 1), (1, 1), (1, 0), (0, 1.8)], dtype=float)
+        km = np.zeros((6, 6))
+        km[:5, :5] = np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))
+        crossing = np.array([0, 2, 1, 3, 4, 5])
+        self.assertEqual(two_opt(km, crossing, deadline=time.perf_counter()).tolist(), crossing.tolist())
+
+    def test_large_round_fits_the_latency_budget(self):
+        # Every one of 500 sites reachable: the worst case for 2-opt (see benchmarks/bench_route_planner.py)
+        rng = random.Random(1)
+        machines = [
+            Machine(location_lat=34.05 + rng.uniform(-0.3, 0.3), location_lon=-118.25 + rng.uniform(-0.3, 0.3))
+            for _ in range(500)
+        ]
+        db.session.add_all(machines)
+        db.session.flush()
+        yesterday = date.today() - timedelta(days=1)
+        db.session.add_all([
+            MachineExpiryBucket(machine_id=machine.id, expiry_date=yesterday, units=rng.randint(1, 20)) for machine in machines
+        ])
+        db.session.commit()
+
+        query = {"lat": 34.05, "lon": -118.25, "time_budget": 1440, "speed_kmh": 200, "service_minutes": 0.5}
+        self.assertEqual(len(self.route(**query)["stops"]), 500)
+        samples = []
+        for _ in range(3):
+            start = time.perf_counter()
+            self.route(**query)
+            samples.append(time.perf_counter() - start)
+        self.assertLess(statistics.median(samples), 0.1)
+
+    def test_invalid_parameters(self):
+        for query in ({}, {"lat": 34, "lon": -118}, {"lat": 95, "lon": 0, "time_budget": 60},
+                      {"lat": 34, "lon": -118, "time_budget": 0}, {"lat": 34, "lon": -118, "time_budget": "soon"},
+                      {"lat": 34, "lon": -118, "time_budget": 60, "speed_kmh": -5}):
+            self.assertEqual(self.client.get("/api/volunteer/route", query_string=query).status_code, 400, query)
+
+    def test_no_sites(self):
+        self.create_machine()
+        route = self.route(time_budget=60)
+        self.assertEqual((route["stops"], route["total_distance_km"], route["sites_with_expired_food"]), ([], 0.0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
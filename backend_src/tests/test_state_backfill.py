@@ -0,0 +1,97 @@
+"""
+test_state_backfill.py - Tests for the chunked FoodItem.state backfill
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, FoodItem, FoodItemState
+from services.counters import machine_counts, verify_counters
+from services.expiry_sweeper import sweep_expired
+from services.state_backfill import backfill_food_item_state, install_database_preparation, needs_backfill
+
+
+class TestStateBackfill(BackendTestCase):
+    """Rows written before the state column existed get their state from the old flags."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        # The flags of the released food_items schema, upgraded with a NULL state column
+        for column in ("is_dispensed BOOLEAN", "is_expired_removed BOOLEAN"):
+            db.session.execute(db.text(f"ALTER TABLE food_items ADD COLUMN {column}"))
+        db.session.commit()
+
+    def add_legacy_lot(self, is_dispensed=False, is_expired_removed=False, expired=False):
+        return db.session.execute(db.text(
+            "INSERT INTO food_items (machine_id, quantity, expiry_date, state, is_dispensed, is_expired_removed, "
+            "sync_version) VALUES (:machine_id, 1, :expiry, NULL, :dispensed, :removed, 0)"
+        ), {
+            "machine_id": self.machine_id, "expiry": date.today() + timedelta(days=-1 if expired else 2),
+            "dispensed": is_dispensed, "removed": is_expired_removed
+        }).lastrowid
+
+    def states(self):
+        return dict(db.session.execute(db.select(FoodItem.id, FoodItem.state)).all())
+
+    def test_backfills_in_chunks_from_the_old_flags(self):
+        expected = {
+            self.add_legacy_lot(): FoodItemState.AVAILABLE,
+            # Past its date but never swept: the sweeper moves it to EXPIRED later
+            self.add_legacy_lot(expired=True): FoodItemState.AVAILABLE,
+            self.add_legacy_lot(is_dispensed=True): FoodItemState.DISPENSED,
+            self.add_legacy_lot(is_expired_removed=True, expired=True): FoodItemState.EXPIRED_REMOVED,
+            self.add_legacy_lot(): FoodItemState.AVAILABLE,
+        }
+        db.session.add(FoodItem(machine_id=self.machine_id, expiry_date=date.today(), state=FoodItemState.DISPENSED))
+        db.session.commit()
+        written = db.session.scalar(db.select(FoodItem.id).order_by(FoodItem.id.desc()).limit(1))
+
+        self.assertTrue(needs_backfill())
+
+        result = backfill_food_item_state(chunk_size=2)
+        self.assertEqual((result["rows"], result["chunks"], result["repaired_machines"]), (5, 3, 1))
+        self.assertFalse(needs_backfill())
+        db.session.expire_all()
+        self.assertEqual(self.states(), {**expected, written: FoodItemState.DISPENSED})
+
+        listed = self.client.get(f"/api/machines/{self.machine_id}/food_items", query_string={"state": "all"}).get_json()
+        self.assertEqual(len(listed), 6)
+        # The counters now include the backfilled lots still in the machine
+        self.assertEqual(verify_counters(), [])
+        self.assertEqual(machine_counts(self.machine_id)["available"], 2)
+        self.assertEqual(machine_counts(self.machine_id)["expired"], 1)
+        self.assertEqual(sweep_expired()["lots"], 1)
+        self.assertEqual(machine_counts(self.machine_id)["expired_pending"], 1)
+
+        # Re-running finds nothing left to do
+        self.assertEqual(backfill_food_item_state(chunk_size=2), {"rows": 0, "chunks": 0, "repaired_machines": 0})
+
+    def test_first_request_backfills_first(self):
+        available = self.add_legacy_lot()
+        self.add_legacy_lot(is_dispensed=True)
+        db.session.commit()
+        self.app.config["PREPARE_DATABASE"] = True
+        install_database_preparation(self.app)
+
+        with self.assertLogs("services.state_backfill", level="WARNING"):
+            listed = self.client.get(f"/api/machines/{self.machine_id}/food_items").get_json()
+        self.assertEqual([item["id"] for item in listed], [available])
+        self.assertFalse(needs_backfill())
+        self.assertEqual(machine_counts(self.machine_id)["available"], 1)
+
+        with self.assertNoLogs("services.state_backfill"):
+            self.client.get(f"/api/machines/{self.machine_id}/food_items")
+
+    def test_preparation_can_be_disabled(self):
+        self.add_legacy_lot()
+        db.session.commit()
+        self.app.config["PREPARE_DATABASE"] = False
+        install_database_preparation(self.app)
+        self.client.get(f"/api/machines/{self.machine_id}/food_items")
+        self.assertTrue(needs_backfill())
+
+
+if __name__ == "__main__":
+    unittest.main()
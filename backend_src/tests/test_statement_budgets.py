@@ -0,0 +1,119 @@
+"""
+test_statement_budgets.py - SQL statement budgets of the blueprint endpoints
+
+Each test makes one request on fleets of 10, 1,000 and 10,000 machines (see
+tests.base.statement_budget). A budget failure lists the statements the request issued.
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase, statement_budget
+from models.models import db, FoodItem, FoodItemState, Machine, User
+
+
+class TestStatementBudgets(BackendTestCase):
+    """The number of SQL statements per request is bounded and independent of the fleet size."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(volunteer)
+        db.session.commit()
+        self.volunteer_id = volunteer.id
+        # Stock for the collect test
+        db.session.add(FoodItem(machine_id=self.machine_id, quantity=50, expiry_date=date.today() + timedelta(days=5)))
+        db.session.get(Machine, self.machine_id).current_storage_level = 50
+        db.session.commit()
+
+    def get(self, path, **query):
+        response = self.client.get(path, query_string=query, headers=self.headers)
+        self.assertLess(response.status_code, 400, response.get_data(as_text=True))
+        return response
+
+    def post(self, path, json):
+        response = self.client.post(path, json=json, headers=self.headers)
+        self.assertLess(response.status_code, 400, response.get_data(as_text=True))
+        return response
+
+    # Public locator
+
+    @statement_budget(1)
+    def test_machines_for_donors(self):
+        self.get("/api/public/machines_for_donors")
+
+    @statement_budget(1)
+    def test_machines_for_receivers(self):
+        self.get("/api/public/machines_for_receivers")
+
+    @statement_budget(1)
+    def test_nearest_machines(self):
+        self.get("/api/location/nearest", lat=34.0, lon=-118.2, filter="receiver")
+
+    # Machine API
+
+    @statement_budget(5)
+    def test_machine_status(self):
+        self.post("/api/machine/status", {"available_space": 0, "temperature": 4.5})
+
+    @statement_budget(5)
+    def test_donate(self):
+        self.post("/api/food/donate", {"quantity": 2, "expiry_date": (date.today() + timedelta(days=2)).isoformat()})
+
+    @statement_budget(10)
+    def test_collect(self):
+        self.post("/api/food/collect", {"quantity": 1})
+
+    @statement_budget(6)
+    def test_sync(self):
+        self.post("/api/food/sync", {"items": [{"expiry_date": (date.today() + timedelta(days=2)).isoformat(), "quantity": 1}]})
+
+    # Machine management
+
+    @statement_budget(3)
+    def test_machine_details(self):
+        self.get(f"/api/machines/{self.machine_id}")
+
+    @statement_budget(2)
+    def test_machine_food_items(self):
+        self.get("/api/machines/10/food_items", state="all")
+
+    # Volunteers
+
+    @statement_budget(1)
+    def test_machines_with_expired_food(self):
+        self.get("/api/volunteer/machines_with_expired_food", limit=50)
+
+    @statement_budget(2)
+    def test_expired_items(self):
+        self.get("/api/volunteer/machine/10/expired_items")
+
+    @statement_budget(12)
+    def test_mark_removed(self):
+        lot_id = db.session.scalar(db.select(FoodItem.id).where(
+            FoodItem.state == FoodItemState.EXPIRED
+        ).limit(1))
+        self.post(f"/api/volunteer/food_item/{lot_id}/mark_removed", {"volunteer_id": self.volunteer_id})
+
+    @statement_budget(9)
+    def test_bulk_mark_removed(self):
+        lot_ids = db.session.scalars(db.select(FoodItem.id).where(
+            FoodItem.state == FoodItemState.EXPIRED
+        ).limit(40)).all()
+        self.post("/api/volunteer/food_items/mark_removed", {"volunteer_id": self.volunteer_id, "food_item_ids": lot_ids})
+
+    @statement_budget(1)
+    def test_collection_route(self):
+        self.get("/api/volunteer/route", lat=33.9, lon=-118.5, time_budget=120)
+
+    # Reports
+
+    @statement_budget(1)
+    def test_daily_analytics(self):
+        self.get("/api/analytics/daily", group_by="day")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+test_sync.py - Tests for bulk food sync and the delta sync cursor
+"""
+
+import unittest
+from datetime import date, timedelta
+
+from tests.base import BackendTestCase
+from models.models import db, Machine, FoodItem, FoodItemState, User
+from services.sync import changes_since
+
+
+class TestFoodSync(BackendTestCase):
+    """Test cases for /api/food/sync."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+        self.expiry = (date.today() + timedelta(days=3)).isoformat()
+
+    def sync(self, items, **extra):
+        response = self.client.post(
+            "/api/food/sync", json=dict(items=items, **extra), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def donate(self, quantity):
+        response = self.client.post(
+            f"/api/machines/{self.machine_id}/report_donation",
+            json={"expiry_date": self.expiry, "quantity": quantity}
+        )
+        return response.get_json()["lot_id"]
+
+    def test_updates_and_inserts_adjust_storage_level(self):
+        first, second = self.donate(3), self.donate(2)
+        body = self.sync([
+            {"id": first, "is_dispensed": True},
+            {"id": second, "is_expired_removed": False},
+            {"expiry_date": self.expiry, "quantity": 4},
+            {"expiry_date": "not a date"},
+        ])
+        self.assertEqual(body["synced_items"], 3)
+        self.assertEqual(body["current_storage_level"], 6)
+
+        lot = db.session.get(FoodItem, first)
+        self.assertEqual(lot.state, FoodItemState.DISPENSED)
+        self.assertIsNotNone(lot.dispensed_at)
+        self.assertEqual(db.session.get(Machine, self.machine_id).current_storage_level, 6)
+        self.assertEqual(FoodItem.query.filter_by(machine_id=self.machine_id).count(), 3)
+
+    def test_items_of_other_machines_are_rejected(self):
+        other_id = self.create_machine()
+        foreign = FoodItem(machine_id=other_id, expiry_date=date.today(), quantity=1)
+        db.session.add(foreign)
+        db.session.commit()
+
+        body = self.sync([{"id": foreign.id, "is_dispensed": True}])
+        self.assertEqual(body["rejected_items"], [foreign.id])
+        self.assertNotEqual(db.session.get(FoodItem, foreign.id).state, FoodItemState.DISPENSED)
+
+    def test_statement_count_does_not_grow_with_items(self):
+        small = [self.donate(1) for _ in range(3)]
+        large = [self.donate(1) for _ in range(40)]
+
+        with self.count_statements() as few:
+            self.sync([{"id": item_id, "is_dispensed": True} for item_id in small]
+                      + [{"expiry_date": self.expiry}] * 3)
+        with self.count_statements() as many:
+            self.sync([{"id": item_id, "is_dispensed": True} for item_id in large]
+                      + [{"expiry_date": self.expiry}] * 40)
+        self.assertEqual(len(few), len(many))
+
+    def test_cursor_returns_only_new_changes(self):
+        old_lot = self.donate(1)
+        cursor = self.sync([], since=0)["cursor"]
+
+        new_lot = self.donate(2)
+        volunteer = User(username="vol", password_hash="x", role="volunteer")
+        db.session.add(volunteer)
+        db.session.commit()
+        self.client.post(f"/api/volunteer/food_item/{old_lot}/mark_removed", json={"volunteer_id": volunteer.id})
+
+        body = self.sync([], since=cursor)
+        self.assertEqual({change["id"] for change in body["changes"]}, {old_lot, new_lot})
+        self.assertTrue(next(c for c in body["changes"] if c["id"] == old_lot)["is_expired_removed"])
+        self.assertFalse(body["has_more"])
+
+        body = self.sync([], since=body["cursor"])
+        self.assertEqual(body["changes"], [])
+
+    def test_changes_are_paged_by_version(self):
+        lots = [self.donate(1) for _ in range(5)]
+        seen = []
+        cursor, has_more = 0, True
+        while has_more:
+            changes, cursor, has_more = changes_since(self.machine_id, cursor, limit=2)
+            self.assertLessEqual(len(changes), 2)
+            seen.extend(change["id"] for change in changes)
+        self.assertEqual(seen, lots)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+test_telemetry.py - Tests for telemetry ingestion, rollups and retention
+"""
+
+import math
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from tests.base import BackendTestCase
+from models.models import db, TelemetryPoint, TelemetryRollup
+from services.telemetry import MAX_BATCH_POINTS, MAX_BATCH_READINGS, ROLLUP_CHUNK, apply_retention
+from services.upsert import UPSERT_INSERTS
+
+
+class TestTelemetry(BackendTestCase):
+    """Test cases for /api/machine/telemetry and /api/machines/<id>/telemetry."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config["TELEMETRY_PRUNE_INTERVAL"] = None
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+        self.hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+    def send(self, points):
+        return self.client.post("/api/machine/telemetry", json={"points": points}, headers=self.headers)
+
+    def at(self, minutes):
+        return (self.hour + timedelta(minutes=minutes)).isoformat()
+
+    def series(self, **params):
+        response = self.client.get(f"/api/machines/{self.machine_id}/telemetry", query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_batches_are_rolled_up(self):
+        body = self.send([
+            {"timestamp": self.at(0), "temperature": 4.0, "humidity": 40, "door_status": "CLOSED"},
+            {"timestamp": self.at(0.5), "temperature": 6.0},
+            {"timestamp": "yesterday", "temperature": 1.0},
+        ]).get_json()
+        self.assertEqual((body["accepted_readings"], body["rejected_points"]), (3, 1))
+        self.send([{"timestamp": self.at(30), "temperature": 2.0}])
+
+        minute = db.session.get(TelemetryRollup, (self.machine_id, "temperature", 60, self.hour))
+        self.assertEqual((minute.count, minute.total, minute.min_value, minute.max_value), (2, 10.0, 4.0, 6.0))
+        hour = db.session.get(TelemetryRollup, (self.machine_id, "temperature", 3600, self.hour))
+        self.assertEqual((hour.count, hour.min_value, hour.max_value), (3, 2.0, 6.0))
+        self.assertEqual(TelemetryPoint.query.count(), 4)
+
+    def test_week_is_served_from_hourly_rollups(self):
+        self.send([{"timestamp": self.at(minutes), "temperature": 5.0} for minutes in range(0, 120, 10)])
+
+        with self.count_statements() as statements:
+            body = self.series(
+                metric="temperature", start=(self.hour - timedelta(days=6)).isoformat(),
+                end=(self.hour + timedelta(days=1)).isoformat()
+            )
+        self.assertEqual(body["resolution"], 3600)
+        self.assertEqual([point["count"] for point in body["points"]], [6, 6])
+        self.assertEqual(body["points"][0]["avg"], 5.0)
+        self.assertFalse(any("telemetry_points" in statement for statement in statements))
+
+    def test_raw_resolution(self):
+        self.send([{"timestamp": self.at(1), "humidity": 41.5}])
+        body = self.series(metric="humidity", resolution="raw", start=self.hour.isoformat())
+        self.assertEqual(body["points"], [
+            {"t": self.at(1), "count": 1, "avg": 41.5, "min": 41.5, "max": 41.5}
+        ])
+
+    def test_statement_count_does_not_grow_with_batch(self):
+        with self.count_statements() as few:
+            self.send([{"timestamp": self.at(0), "temperature": 1.0}])
+        with self.count_statements() as many:
+            self.send([{"timestamp": self.at(minutes), "temperature": 1.0, "humidity": 2.0}
+                       for minutes in range(0, 200, 5)])
+        self.assertEqual(len(few), len(many))
+
+    def test_rollups_are_upserted_in_chunks(self):
+        with self.count_statements() as statements:
+            response = self.send([{"timestamp": self.at(minutes), "temperature": 1.0, "humidity": 2.0}
+                                  for minutes in range(500)])
+        self.assertEqual(response.status_code, 200)
+        upserts = [statement for statement in statements if statement.startswith("INSERT INTO telemetry_rollups")]
+        self.assertEqual(len(upserts), math.ceil(TelemetryRollup.query.count() / ROLLUP_CHUNK))
+        # Within the bound parameter limit of older SQLite builds
+        self.assertLessEqual(max(statement.count("?") for statement in upserts), 999)
+
+    def test_oversized_batches_are_rejected(self):
+        self.assertEqual(self.send([{"temperature": 1.0}] * (MAX_BATCH_POINTS + 1)).status_code, 400)
+        point = {f"sensor_{index}": 1.0 for index in range(MAX_BATCH_READINGS // 10 + 1)}
+        response = self.send([point] * 10)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["error"], f"At most {MAX_BATCH_READINGS} readings per batch")
+        self.assertEqual(TelemetryPoint.query.count(), 0)
+
+    def test_fallback_without_native_upsert(self):
+        with mock.patch.dict(UPSERT_INSERTS, clear=True):
+            self.send([{"timestamp": self.at(0), "temperature": 3.0}])
+            self.send([{"timestamp": self.at(0), "temperature": 7.0}])
+        rollup = db.session.get(TelemetryRollup, (self.machine_id, "temperature", 86400, self.hour.replace(hour=0)))
+        self.assertEqual((rollup.count, rollup.min_value, rollup.max_value), (2, 3.0, 7.0))
+
+    def test_retention(self):
+        old = datetime.utcnow() - timedelta(days=30)
+        self.send([
+            {"timestamp": old.isoformat(), "temperature": 3.0},
+            {"timestamp": self.at(0), "temperature": 3.0},
+        ])
+        deleted = apply_retention()
+        db.session.commit()
+
+        self.assertEqual(deleted[0], 1)
+        self.assertEqual(deleted[60], 1)
+        self.assertEqual(deleted[3600], 0)
+        self.assertEqual(TelemetryPoint.query.count(), 1)
+
+    def test_ingestion_prunes_periodically(self):
+        self.app.config["TELEMETRY_PRUNE_INTERVAL"] = 0
+        old = datetime.utcnow() - timedelta(days=30)
+        self.send([{"timestamp": old.isoformat(), "temperature": 3.0}])
+        self.send([{"timestamp": self.at(0), "temperature": 3.0}])
+        self.assertEqual(TelemetryPoint.query.count(), 1)
+
+    def test_status_report_is_recorded(self):
+        self.client.post(
+            "/api/machine/status", json={"temperature": 4.5, "door_status": "OPEN"}, headers=self.headers
+        )
+        self.assertEqual([(point.metric, point.value) for point in TelemetryPoint.query], [("temperature", 4.5)])
+
+    def test_invalid_status_telemetry_is_reported(self):
+        with self.assertLogs("routes.machine_compatibility", level="WARNING") as logs:
+            response = self.client.post(
+                "/api/machine/status", json={"temperature": 4.5, "timestamp": "yesterday"}, headers=self.headers
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["telemetry_error"], "Invalid timestamp: yesterday")
+        self.assertIn("Invalid timestamp: yesterday", logs.output[0])
+        self.assertEqual(TelemetryPoint.query.count(), 0)
+
+    def test_rejects_malformed_requests(self):
+        self.assertEqual(self.send("not a list").status_code, 400)
+        self.assertEqual(self.send([{}] * 1001).status_code, 400)
+        url = f"/api/machines/{self.machine_id}/telemetry"
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, query_string={"metric": "t", "resolution": "5"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/machines/999/telemetry?metric=t").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+test_token_cache.py - Tests for the verified-token cache used by token_required
+"""
+
+import time
+import unittest
+from unittest import mock
+
+from tests.base import BackendTestCase
+from models.models import db, Machine
+from routes import machine_compatibility
+from services.token_cache import TokenCache, get_token_cache
+
+
+class TestTokenCache(unittest.TestCase):
+    """Unit tests for TokenCache."""
+
+    def test_hit_and_miss_counters(self):
+        cache = TokenCache()
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("a"), 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+
+    def test_entries_expire(self):
+        cache = TokenCache(ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2, token_expires_at=time.time() - 1)
+        self.assertIsNone(cache.get("b"))
+        with mock.patch("services.token_cache.time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate_machine(self):
+        cache = TokenCache()
+        cache.put("a", 1)
+        cache.put("b", 1)
+        cache.put("c", 2)
+        cache.put_machine(1)
+        cache.put_machine(2)
+        cache.invalidate_machine(1)
+        self.assertFalse(cache.has_machine(1))
+        self.assertTrue(cache.has_machine(2))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 2)
+
+
+class TestTokenRequired(BackendTestCase):
+    """Integration tests for token_required with the cache."""
+
+    def setUp(self):
+        super().setUp()
+        self.machine_id = self.create_machine()
+        self.headers = self.auth_headers(self.machine_id)
+
+    def get_config(self):
+        return self.client.get("/api/machine/config", headers=self.headers)
+
+    def test_token_is_decoded_once(self):
+        with mock.patch.object(machine_compatibility.jwt, "decode", wraps=machine_compatibility.jwt.decode) as decode:
+            for _ in range(3):
+                self.assertEqual(self.get_config().status_code, 200)
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(get_token_cache().stats()["hits"], 2)
+
+    def test_machine_is_loaded_once_per_request(self):
+        self.get_config()
+        with self.count_statements() as statements:
+            response = self.client.post(
+                "/api/food/collect", json={"quantity": 1}, headers=self.headers
+            )
+        self.assertEqual(response.status_code, 404)
+        machine_selects = [s for s in statements if s.lstrip().startswith("SELECT") and "FROM machines" in s]
+        self.assertEqual(len(machine_selects), 1)
+
+    def test_machine_existence_is_cached(self):
+        self.get_config()
+        with self.count_statements() as statements:
+            response = self.client.post("/api/machine/telemetry", json={"points": [{"temperature": 4.0}]},
+                                        headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in statements if "FROM machines" in s])
+
+        # Handlers that need the row still load it, once
+        with self.count_statements() as statements:
+            self.assertEqual(self.client.put("/api/machine/config", json={"operational_hours": "9-5"},
+                                             headers=self.headers).status_code, 200)
+        self.assertEqual(len([s for s in statements if "FROM machines" in s]), 1)
+        self.assertEqual(db.session.get(Machine, self.machine_id).operational_hours, "9-5")
+
+    def test_machine_deleted_elsewhere_is_rejected(self):
+        self.get_config()
+        # Removed without going through the ORM, so the cache still lists the machine
+        db.session.execute(db.delete(Machine).where(Machine.id == self.machine_id))
+        db.session.commit()
+        self.assertEqual(self.get_config().status_code, 401)
+        self.assertEqual(get_token_cache().stats()["machines"], 0)
+
+    def test_reregistration_invalidates_tokens(self):
+        self.get_config()
+        self.client.post("/api/machine/register", json={"machine_id": self.machine_id, "location_lat": 1.0})
+        self.assertEqual(get_token_cache().stats()["size"], 0)
+        self.assertEqual(self.get_config().status_code, 200)
+
+    def test_deleted_machine_is_rejected_and_invalidated(self):
+        self.get_config()
+        db.session.delete(db.session.get(Machine, self.machine_id))
+        db.session.commit()
+        self.assertEqual(get_token_cache().stats()["size"], 0)
+        self.assertEqual(self.get_config().status_code, 401)
+
+    def test_invalid_token_is_not_cached(self):
+        response = self.client.get("/api/machine/config", headers={"Authorization": "Bearer nope"})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(get_token_cache().stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
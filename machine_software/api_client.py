@@ -15,18 +15,22 @@ logger = logging.getLogger("ExesMachine.APIClient")
 class APIClient:
     """Client for communicating with the central backend server."""
     
-    def __init__(self, machine_id, base_url="http://localhost:5000/api"):
+    def __init__(self, machine_id, base_url="http://localhost:5000/api", http=None):
         """Initialize the API client.
         
         Args:
             machine_id: Unique identifier for this machine
             base_url: Base URL for the backend API
+            http: Object with requests-style get/post/put/delete methods, e.g. a
+                  requests.Session (defaults to the requests module)
         """
         self.machine_id = machine_id
         self.base_url = base_url
+        self.http = http or requests
         self.logger = logging.getLogger(f"ExesMachine.APIClient.{machine_id}")
         self.auth_token = None
         self.offline_queue = []
+        self.sync_cursor = None  # Last sync version received from the backend
         
         # Try to authenticate on initialization
         self.authenticate()
@@ -36,7 +40,7 @@ class APIClient:
         self.logger.info(f"Authenticating machine {self.machine_id} with backend")
         
         try:
-            response = requests.post(
+            response = self.http.post(
                 f"{self.base_url}/machine/auth",
                 json={"machine_id": self.machine_id}
             )
@@ -76,13 +80,13 @@ class APIClient:
         
         try:
             if method == "GET":
-                response = requests.get(url, headers=self._get_headers())
+                response = self.http.get(url, headers=self._get_headers())
             elif method == "POST":
-                response = requests.post(url, headers=self._get_headers(), json=data)
+                response = self.http.post(url, headers=self._get_headers(), json=data)
             elif method == "PUT":
-                response = requests.put(url, headers=self._get_headers(), json=data)
+                response = self.http.put(url, headers=self._get_headers(), json=data)
             elif method == "DELETE":
-                response = requests.delete(url, headers=self._get_headers())
+                response = self.http.delete(url, headers=self._get_headers())
             else:
                 self.logger.error(f"Unsupported HTTP method: {method}")
                 return None
@@ -178,18 +182,47 @@ class APIClient:
         
         return self._handle_request("POST", "machine/status", data)
     
+    def send_telemetry(self, points):
+        """Send a batch of sensor readings to the backend server.
+        
+        Args:
+            points: List of readings, each a dict with a "timestamp" and numeric
+                    fields such as temperature and humidity
+            
+        Returns:
+            Response data or None on failure
+        """
+        self.logger.info(f"Sending {len(points)} telemetry points")
+        
+        return self._handle_request("POST", "machine/telemetry", {"points": points})
+    
     # Food item management
     
     def sync_food_items(self, items):
-        """Sync food items with the backend server."""
+        """Sync food items with the backend server.
+        
+        Only items changed since the previous sync need to be sent. Once a cursor has been
+        received, the response also carries the items changed on the backend since then.
+        
+        Args:
+            items: List of changed food items
+            
+        Returns:
+            Response data or None on failure
+        """
         self.logger.info(f"Syncing {len(items)} food items with backend")
         
         data = {
             "machine_id": self.machine_id,
             "items": items
         }
+        if self.sync_cursor is not None:
+            data["since"] = self.sync_cursor
         
-        return self._handle_request("POST", "food/sync", data)
+        result = self._handle_request("POST", "food/sync", data)
+        if result and "cursor" in result:
+            self.sync_cursor = result["cursor"]
+        return result
     
     def report_donation(self, donation_data):
         """Report a new donation to the backend server."""
@@ -250,13 +283,15 @@ class APIClient:
     
     # Location services
     
-    def get_nearest_machines(self, latitude, longitude, filter_type=None):
+    def get_nearest_machines(self, latitude, longitude, filter_type=None, limit=None, radius_km=None):
         """Get the nearest machines to a location.
         
         Args:
             latitude: Latitude coordinate
             longitude: Longitude coordinate
             filter_type: Optional filter ('donor' for machines with space, 'receiver' for machines with food)
+            limit: Optional maximum number of machines to return
+            radius_km: Optional search radius in kilometres
             
         Returns:
             List of nearby machines or None on failure
@@ -266,6 +301,10 @@ class APIClient:
         endpoint = f"location/nearest?lat={latitude}&lon={longitude}"
         if filter_type:
             endpoint += f"&filter={filter_type}"
+        if limit:
+            endpoint += f"&limit={limit}"
+        if radius_km:
+            endpoint += f"&radius={radius_km}"
         
         return self._handle_request("GET", endpoint)
     